@@ -25,7 +25,7 @@ from gitlab_ci_fargate_runner.gitlab_ci_fargate_runner_stack import (
     GitlabCiFargateRunnerStack,
 )
 
-from task_definitions.task_definition_stack import TaskDefinitionStack
+from task_definitions.task_definition_stack import TaskDefinitionStack, runner_environment
 
 # Check for required variable
 
@@ -58,8 +58,6 @@ env = cdk.Environment(
 for k,v in props.get("tags",{}).items():
     cdk.Tags.of(app).add(key=k,value=v)
 
-if app.node.try_get_context("DockerImageName"):
-    props["task_definition"]["docker_image_name"] = app.node.try_get_context("DockerImageName")
 if app.node.try_get_context("Memory"):
     props["task_definition"]["memory"] = app.node.try_get_context("Memory")
 if app.node.try_get_context("CPU"):
@@ -68,21 +66,77 @@ if app.node.try_get_context("TaskManagedPolicies"):
     props["task_definition"]["managed_policies"] = app.node.try_get_context("TaskManagedPolicies").split(",")
 if app.node.try_get_context("TaskInlinePolicy"):
     props["task_definition"]["iam_policy_template"] = app.node.try_get_context("TaskInlinePolicy")
-if app.node.try_get_context("TaskDefinitionStackName"):
-    props["task_definition"]["stack_name"] = app.node.try_get_context("TaskDefinitionStackName")
-else:
-    props["task_definition"]["stack_name"] = f"{props['task_definition']['docker_image_name']}TaskDefinitionStack"
 
-TaskDefinitionStack(
-    app, props["task_definition"]["stack_name"], env=env, props=props.get("task_definition")
-)
+# Only synthesize the requested stacks, by stack name, image name or "bastion"
+selected_stacks = app.node.try_get_context("Stacks") or os.getenv("CDK_STACKS")
+selected_stacks = set(selected_stacks.split(",")) if selected_stacks else None
+
+
+def is_selected(*names):
+    return selected_stacks is None or any(name in selected_stacks for name in names)
+
+
+# Reference the published images whose sources did not change (see gitlab_ci_fargate_runner/assets.py)
+skip_unchanged_assets = str(
+    app.node.try_get_context("SkipUnchangedAssets") or os.getenv("CDK_SKIP_UNCHANGED_ASSETS", "false")
+).lower() in ("1", "true", "yes")
+props["task_definition"]["skip_unchanged_assets"] = skip_unchanged_assets
+props["bastion"]["skip_unchanged_assets"] = skip_unchanged_assets
+
+# One task definition stack, and one runner, per docker image
+docker_images = props["task_definition"].pop("docker_images", None) or [
+    {"name": props["task_definition"]["docker_image_name"]}
+]
+if app.node.try_get_context("DockerImageName"):
+    docker_images = [{"name": app.node.try_get_context("DockerImageName")}]
+
+runner_images = []
+for docker_image in docker_images:
+    image_props = {**props["task_definition"], **docker_image}
+    image_props["docker_image_name"] = image_props.pop("name")
+    image_name = image_props["docker_image_name"]
+
+    if image_props.get("log_group_name") and len(docker_images) > 1 and "log_group_name" not in docker_image:
+        image_props["log_group_name"] = f'{image_props["log_group_name"].rstrip("/")}/{image_name}/'
+
+    if app.node.try_get_context("TaskDefinitionStackName") and len(docker_images) == 1:
+        image_props["stack_name"] = app.node.try_get_context("TaskDefinitionStackName")
+    elif not docker_image.get("stack_name"):
+        image_props["stack_name"] = f"{image_name}TaskDefinitionStack"
+
+    # The EFS workspace and the build of the warmed images run in the VPC of the runner
+    efs_props = image_props.get("efs", {})
+    if efs_props.get("enabled") or image_props.get("warmed_images", {}).get("enabled"):
+        image_props["VpcId"] = props["bastion"]["VpcId"]
+        image_props["gitlab_server"] = props["bastion"]["gitlab_server"]
+
+    if is_selected(image_props["stack_name"], image_name):
+        TaskDefinitionStack(
+            app, image_props["stack_name"], env=env, props=image_props
+        )
+
+    # A single image keeps the runner tags, otherwise jobs select an image by its tags
+    runner_tags = props["bastion"].get("runner_tags") if len(docker_images) == 1 else image_name
+    runner_images.append({
+        "name": image_name,
+        "task_definition": image_name,
+        "default_size": image_props.get("default_size"),
+        "sizes": list(image_props.get("sizes") or {}),
+        "tags": docker_image.get("runner_tags", runner_tags),
+        "environment": runner_environment(image_props, env.account, env.region),
+        "efs": bool(efs_props.get("enabled")),
+        "efs_projects": efs_props.get("projects", []),
+    })
+
+props["bastion"]["runner_images"] = runner_images
 
 if app.node.try_get_context("BastionStackName"):
     props["bastion"]["stack_name"] = app.node.try_get_context("BastionStackName")
 else:
     props["bastion"]["stack_name"] = f'{props["app_name"]}BastionStack'
 
-GitlabCiFargateRunnerStack(
-    app, props["bastion"]["stack_name"], env=env, props=props.get("bastion")
-)
+if is_selected(props["bastion"]["stack_name"], "bastion"):
+    GitlabCiFargateRunnerStack(
+        app, props["bastion"]["stack_name"], env=env, props=props.get("bastion")
+    )
 app.synth()
@@ -0,0 +1,140 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Build the CI images of docker_images and report, for each of them, the
+# figures that drive the start time of a Fargate task:
+# - compressed size: gzip size of the image layers, close to what is pulled
+#   from ECR
+# - layers: number of layers of the image
+# - sshd ready: seconds from `docker run` to the first SSH banner
+#
+# Usage: benchmarks/image_benchmark.sh [image ...]
+#   Without argument, every image of docker_images is measured.
+#
+# Environment variables:
+# - GITLAB_RUNNER_VERSION (optional): defaults to the version of
+#   config/app.yml-example (14.5.1)
+# - ARCH (optional): architecture of the images, amd64 or arm64 (defaults to
+#   amd64). Another architecture than the host one needs qemu (binfmt_misc)
+# - BENCHMARK_RUNS (optional): number of starts averaged per image
+#   (defaults to 3)
+# - BENCHMARK_TIMEOUT (optional): seconds to wait for sshd (defaults to 60)
+# - BENCHMARK_OUTPUT (optional): file where a CSV copy of the report is written
+# -----------------------------------------------------------------------------
+
+set -euo pipefail
+
+REPO_DIR=$(cd "$(dirname "$0")/.." && pwd)
+IMAGES_DIR=${REPO_DIR}/docker_images
+GITLAB_RUNNER_VERSION=${GITLAB_RUNNER_VERSION:-14.5.1}
+ARCH=${ARCH:-amd64}
+BENCHMARK_RUNS=${BENCHMARK_RUNS:-3}
+BENCHMARK_TIMEOUT=${BENCHMARK_TIMEOUT:-60}
+BENCHMARK_OUTPUT=${BENCHMARK_OUTPUT:-}
+
+WORK_DIR=$(mktemp -d)
+trap 'rm -rf "${WORK_DIR}"' EXIT
+
+###############################################################################
+# Print the current time in milliseconds.
+###############################################################################
+now_ms() {
+    echo $(($(date +%s%N) / 1000000))
+}
+
+###############################################################################
+# Build an image from the shared docker_images context.
+#
+# Arguments:
+#   $1 - Name of the image folder
+###############################################################################
+build_image() {
+    docker build --quiet \
+        --file "${IMAGES_DIR}/$1/Dockerfile" \
+        --build-arg GITLAB_RUNNER_VERSION="${GITLAB_RUNNER_VERSION}" \
+        --build-arg ARCH="${ARCH}" \
+        --tag "fargate-ci-benchmark/$1" \
+        "${IMAGES_DIR}" >/dev/null
+}
+
+###############################################################################
+# Start a container of the image and print the milliseconds it took for sshd
+# to send its banner.
+#
+# Arguments:
+#   $1 - Name of the image folder
+###############################################################################
+time_sshd_ready() {
+    local started_at container port deadline
+
+    started_at=$(now_ms)
+    container=$(docker run --detach --publish 127.0.0.1::22 \
+        --env SSH_PUBLIC_KEY="$(cat "${WORK_DIR}/id.pub")" \
+        "fargate-ci-benchmark/$1")
+    port=$(docker port "${container}" 22/tcp | head -n 1 | cut -d: -f2)
+    deadline=$((started_at + BENCHMARK_TIMEOUT * 1000))
+
+    until timeout 1 bash -c "exec 3<>/dev/tcp/127.0.0.1/${port} && head -c 4 <&3" 2>/dev/null | grep -q SSH-; do
+        if [ "$(now_ms)" -ge ${deadline} ]; then
+            docker rm --force "${container}" >/dev/null
+            echo "sshd of $1 not ready after ${BENCHMARK_TIMEOUT}s" >&2
+            return 1
+        fi
+        sleep 0.05
+    done
+    echo $(($(now_ms) - started_at))
+    docker rm --force "${container}" >/dev/null
+}
+
+###############################################################################
+# Measure an image and print its report line.
+#
+# Arguments:
+#   $1 - Name of the image folder
+###############################################################################
+measure_image() {
+    local size layers total=0 run ready
+
+    build_image "$1"
+    size=$(docker save "fargate-ci-benchmark/$1" | gzip -c | wc -c)
+    layers=$(docker image inspect --format '{{len .RootFS.Layers}}' "fargate-ci-benchmark/$1")
+    for run in $(seq "${BENCHMARK_RUNS}"); do
+        ready=$(time_sshd_ready "$1")
+        total=$((total + ready))
+    done
+    awk -v image="$1" -v size="${size}" -v layers="${layers}" -v total="${total}" -v runs="${BENCHMARK_RUNS}" \
+        'BEGIN { printf "%s,%.1f,%s,%.2f\n", image, size / 1048576, layers, total / runs / 1000 }'
+}
+
+if [ $# -eq 0 ]; then
+    set -- $(find "${IMAGES_DIR}" -mindepth 2 -maxdepth 2 -name Dockerfile -printf '%h\n' | xargs -n 1 basename | sort)
+fi
+
+ssh-keygen -q -t ed25519 -N "" -f "${WORK_DIR}/id"
+
+echo "image,compressed_mb,layers,sshd_ready_s" > "${WORK_DIR}/report.csv"
+for image in "$@"; do
+    measure_image "${image}" >> "${WORK_DIR}/report.csv"
+done
+
+column -t -s, "${WORK_DIR}/report.csv"
+if [ -n "${BENCHMARK_OUTPUT}" ]; then
+    cp "${WORK_DIR}/report.csv" "${BENCHMARK_OUTPUT}"
+fi
@@ -0,0 +1,321 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Load test of a runner task against local stand-ins of GitLab and AWS.
+
+Usage: python benchmarks/load_test.py [--jobs 50] [--concurrent 10] [--cpu 256] [--memory 512]
+
+Run from the root of the repository, on a Linux host with Docker. The runner
+image of gitlab_ci_fargate_runner/docker_fargate_driver runs its real
+docker-entrypoint.sh, templates and fargate-driver.sh, limited to the cpu and
+memory of the runner task, against:
+
+- tests/fakes/gitlab_api.py: registration of the runners and the jobs API,
+  where the synthetic jobs are queued
+- tests/fakes/aws_api.py: the task metadata endpoint of the runner, the ECS
+  RunTask/DescribeTasks/StopTask API and S3, reached through an aws shim
+  adding --endpoint-url in front of the AWS CLI of the image
+
+The CI tasks are placed by fargate-driver.sh (FARGATE_SUBNETS), the Fargate
+driver itself only talks to the real ECS API. Every task started by the fake
+ECS API is one container of the CI image (--ci-image), shared by all the
+jobs, where the key of the task is authorized.
+
+The report gives the pickup latency of the jobs (queued to handed out to the
+runner), their duration, the stage timings written by fargate-driver.sh as
+EMF records, and the CPU and memory used by the runner container. Raise
+--concurrent until the pickup latency or the stage timings degrade to find
+the ceiling of `concurrent` for a runner `cpu` and `memory`.
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tests.fakes.aws_api import FakeAws  # noqa: E402
+from tests.fakes.gitlab_api import FakeGitlab  # noqa: E402
+
+RUNNER_IMAGE = "fargate-runner-load-test/runner"
+CI_IMAGE = "fargate-runner-load-test/ci"
+AWS_CLI = "/usr/local/aws-cli/v2/current/bin/aws"
+MEMORY_UNITS = {"B": 1 / 1048576, "KiB": 1 / 1024, "kB": 1 / 1024, "MiB": 1,
+                "MB": 1, "GiB": 1024, "GB": 1024}
+
+
+def docker(*args, **kwargs):
+    """Run a docker command, return its stripped output."""
+    return subprocess.run(
+        ["docker", *args], check=True, capture_output=True, text=True, **kwargs).stdout.strip()
+
+
+def percentiles(values):
+    """Median, 95th percentile and maximum of the values, None without values."""
+    if not values:
+        return {"p50": None, "p95": None, "max": None}
+    values = sorted(values)
+    return {
+        "p50": statistics.median(values),
+        "p95": values[max(int(round(0.95 * len(values))) - 1, 0)],
+        "max": values[-1],
+    }
+
+
+def parse_memory(value):
+    """MiB of a docker stats memory value, ex: 12.5MiB."""
+    number, unit = re.match(r"([\d.]+)\s*([A-Za-z]+)", value).groups()
+    return float(number) * MEMORY_UNITS[unit]
+
+
+def parse_stats_line(line):
+    """CPU percent and memory MiB of a `docker stats` line "<cpu>%\\t<used> / <limit>"."""
+    cpu, memory = line.split("\t")
+    return float(cpu.rstrip("%")), parse_memory(memory.split("/")[0].strip())
+
+
+def parse_stage_metrics(lines):
+    """Stage durations in seconds by step, from the EMF records of fargate-driver.sh."""
+    durations = {}
+    for line in lines:
+        if not line.startswith("{") or '"StageDuration"' not in line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        durations.setdefault(record.get("Step") or record.get("Stage"), []).append(
+            record["StageDuration"] / 1000)
+    return durations
+
+
+def job_latencies(jobs):
+    """Pickup latencies and durations in seconds of the jobs of FakeGitlab."""
+    pickup = [job["picked_at"] - job["queued_at"] for job in jobs if job["picked_at"]]
+    duration = [job["finished_at"] - job["picked_at"] for job in jobs if job["finished_at"]]
+    return pickup, duration
+
+
+def build_images(args):
+    docker("build", "--quiet",
+           "--build-arg", f"GITLAB_RUNNER_VERSION={args.gitlab_runner_version}",
+           "--build-arg", f"ARCH={args.arch}",
+           "--tag", RUNNER_IMAGE, "gitlab_ci_fargate_runner/docker_fargate_driver")
+    docker("build", "--quiet",
+           "--build-arg", f"GITLAB_RUNNER_VERSION={args.gitlab_runner_version}",
+           "--build-arg", f"ARCH={args.arch}",
+           "--file", f"docker_images/{args.ci_image}/Dockerfile",
+           "--tag", CI_IMAGE, "docker_images")
+
+
+def authorize_task_key(container):
+    """on_run_task callback authorizing the SSH key of a task in the CI container."""
+    def on_run_task(task, overrides):
+        for container_override in overrides.get("containerOverrides", []):
+            for variable in container_override.get("environment", []):
+                if variable["name"] == "SSH_PUBLIC_KEY":
+                    subprocess.run(
+                        ["docker", "exec", "-i", container, "sh", "-c",
+                         "cat >> /root/.ssh/authorized_keys"],
+                        input=variable["value"] + "\n", text=True, check=True)
+    return on_run_task
+
+
+def write_aws_shim(directory, aws_url):
+    """aws command sending the ECS and S3 calls to the fake AWS endpoint."""
+    path = os.path.join(directory, "aws")
+    with open(path, "w") as shim:
+        shim.write(
+            "#!/bin/sh\n"
+            'case "$1" in\n'
+            f'    ecs|s3|s3api) exec {AWS_CLI} --endpoint-url {aws_url} "$@" ;;\n'
+            "esac\n"
+            f'exec {AWS_CLI} "$@"\n')
+    os.chmod(path, 0o755)
+    return path
+
+
+def start_runner(args, gitlab, aws, ci_port, shim):
+    """Start the runner container on the host network, return its id."""
+    environment = {
+        "GITLAB_URL": gitlab.url,
+        "GITLAB_REGISTRATION_TOKEN": "fake-registration-token",
+        "RUNNER_IMAGES": json.dumps([{"name": "load-test", "task_definition": "load-test",
+                                      "tags": "load-test"}]),
+        "RUNNER_CONCURRENT": str(args.concurrent),
+        "ECS_CONTAINER_METADATA_URI_V4": aws.metadata_url,
+        "FARGATE_CLUSTER": "fake-cluster",
+        "FARGATE_REGION": "us-east-1",
+        "FARGATE_SECURITY_GROUP": "sg-fake",
+        "FARGATE_SUBNET_MAP": json.dumps({"us-east-1a": "subnet-fake"}),
+        "FARGATE_SUBNETS": "subnet-fake",
+        "SSH_PORT": str(ci_port),
+        "CACHE_BUCKET": "fake-cache",
+        "CACHE_BUCKET_REGION": "us-east-1",
+        "CACHE_SERVER_ADDRESS": aws.url.split("//", 1)[1],
+        "CACHE_INSECURE": "true",
+        "AWS_ACCESS_KEY_ID": "fake",
+        "AWS_SECRET_ACCESS_KEY": "fake",
+        "AWS_DEFAULT_REGION": "us-east-1",
+    }
+    options = []
+    for name, value in environment.items():
+        options += ["--env", f"{name}={value}"]
+    return docker(
+        "run", "--detach", "--network", "host",
+        "--cpus", str(args.cpu / 1024), "--memory", f"{args.memory}m",
+        "--volume", f"{shim}:/usr/local/sbin/aws:ro",
+        *options, RUNNER_IMAGE)
+
+
+def sample_stats(container, samples, stop):
+    """Append the CPU and memory of the container to samples every second."""
+    while not stop.is_set():
+        try:
+            samples.append(parse_stats_line(docker(
+                "stats", "--no-stream", "--format", "{{.CPUPerc}}\t{{.MemUsage}}", container)))
+        except (subprocess.CalledProcessError, ValueError, AttributeError):
+            pass
+        stop.wait(1)
+
+
+def wait_for(condition, timeout, message):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError(message)
+        time.sleep(0.5)
+
+
+def run(args):
+    """Run the load test, return the report."""
+    containers = []
+    stop = threading.Event()
+    samples = []
+    try:
+        ci_container = docker(
+            "run", "--detach", "--publish", "127.0.0.1::22",
+            "--env", "SSH_PUBLIC_KEY=", CI_IMAGE)
+        containers.append(ci_container)
+        ci_port = int(docker("port", ci_container, "22/tcp").splitlines()[0].rsplit(":", 1)[1])
+
+        with FakeGitlab() as gitlab, FakeAws(
+                provisioning_seconds=args.provisioning_seconds,
+                pull_seconds=args.pull_seconds,
+                on_run_task=authorize_task_key(ci_container)) as aws, \
+                tempfile.TemporaryDirectory() as work_dir:
+            runner = start_runner(args, gitlab, aws, ci_port, write_aws_shim(work_dir, aws.url))
+            containers.append(runner)
+            sampler = threading.Thread(target=sample_stats, args=(runner, samples, stop), daemon=True)
+            sampler.start()
+
+            started_at = time.monotonic()
+            wait_for(lambda: "/api/v4/jobs/request" in gitlab.requests, args.timeout,
+                     "the runner did not request jobs")
+            ready_at = time.monotonic()
+
+            for _ in range(args.jobs):
+                gitlab.add_job(script=[args.script])
+                if args.rate:
+                    time.sleep(1 / args.rate)
+            wait_for(lambda: all(job["finished_at"] for job in gitlab.jobs.values()),
+                     args.timeout, "the jobs did not finish")
+            finished_at = time.monotonic()
+            stop.set()
+
+            jobs = list(gitlab.jobs.values())
+            pickup, duration = job_latencies(jobs)
+            logs = subprocess.run(["docker", "logs", runner], capture_output=True, text=True)
+            stages = parse_stage_metrics((logs.stdout + logs.stderr).splitlines())
+            run_task_calls = sum(1 for _, action in aws.calls if action == "RunTask")
+    finally:
+        stop.set()
+        for container in containers:
+            subprocess.run(["docker", "rm", "--force", container], capture_output=True)
+
+    return {
+        "jobs": args.jobs,
+        "concurrent": args.concurrent,
+        "cpu": args.cpu,
+        "memory": args.memory,
+        "runner_ready_seconds": ready_at - started_at,
+        "jobs_per_minute": 60 * len(duration) / (finished_at - ready_at),
+        "failed_jobs": sum(1 for job in jobs if job["state"] != "success"),
+        "run_task_calls": run_task_calls,
+        "pickup_seconds": percentiles(pickup),
+        "job_seconds": percentiles(duration),
+        "stage_seconds": {step: percentiles(values) for step, values in sorted(stages.items())},
+        "runner_cpu_percent": percentiles([cpu for cpu, _ in samples]),
+        "runner_memory_mib": percentiles([memory for _, memory in samples]),
+    }
+
+
+def print_report(report):
+    print(f"{report['jobs']} jobs, concurrent {report['concurrent']}, "
+          f"runner {report['cpu']} cpu / {report['memory']} MiB")
+    print(f"runner ready in {report['runner_ready_seconds']:.1f}s, "
+          f"{report['jobs_per_minute']:.1f} jobs/min, {report['failed_jobs']} failed, "
+          f"{report['run_task_calls']} RunTask calls")
+    print(f"{'':<28}{'p50':>10}{'p95':>10}{'max':>10}")
+    rows = [("pickup (s)", report["pickup_seconds"]), ("job (s)", report["job_seconds"])]
+    rows += [(f"stage {step} (s)", values) for step, values in report["stage_seconds"].items()]
+    rows += [("runner cpu (%)", report["runner_cpu_percent"]),
+             ("runner memory (MiB)", report["runner_memory_mib"])]
+    for name, values in rows:
+        print(f"{name:<28}" + "".join(
+            f"{values[key]:>10.2f}" if values[key] is not None else f"{'-':>10}"
+            for key in ("p50", "p95", "max")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=50, help="synthetic jobs queued")
+    parser.add_argument("--concurrent", type=int, default=10, help="concurrent of the runner")
+    parser.add_argument("--cpu", type=int, default=256, help="cpu units of the runner task")
+    parser.add_argument("--memory", type=int, default=512, help="memory MiB of the runner task")
+    parser.add_argument("--script", default="sleep 5", help="script line of every job")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="jobs queued per second, all at once by default")
+    parser.add_argument("--provisioning-seconds", type=float, default=0,
+                        help="time a fake task spends in PROVISIONING")
+    parser.add_argument("--pull-seconds", type=float, default=0,
+                        help="time a fake task spends in PENDING")
+    parser.add_argument("--ci-image", default="python", help="image of docker_images running the jobs")
+    parser.add_argument("--gitlab-runner-version", default="14.5.1")
+    parser.add_argument("--arch", default="amd64", help="amd64 or arm64")
+    parser.add_argument("--timeout", type=int, default=900, help="seconds before giving up")
+    parser.add_argument("--no-build", action="store_true", help="reuse the images already built")
+    parser.add_argument("--output", help="file where the JSON report is written")
+    args = parser.parse_args()
+
+    if not args.no_build:
+        build_images(args)
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Measure the synth time of app.py for full, selective and skipped-asset synths.
+
+Usage: python benchmarks/synth_time.py [--runs N] [--stacks bastion,python]
+
+Run from the root of the repository, with config/app.yml, CDK_DEFAULT_ACCOUNT
+and CDK_DEFAULT_REGION set, like `cdk synth`. Each scenario runs app.py in a
+fresh process writing to a temporary cdk.out, and its median time is
+reported.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def synth(context, env=None, runs=3):
+    """Run app.py `runs` times with the given context, return the durations in seconds."""
+    durations = []
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as outdir:
+            process_env = {
+                **os.environ,
+                **(env or {}),
+                "CDK_OUTDIR": outdir,
+                "CDK_CONTEXT_JSON": json.dumps(context),
+            }
+            started_at = time.monotonic()
+            subprocess.run(
+                [sys.executable, "app.py"], env=process_env, check=True,
+                stdout=subprocess.DEVNULL)
+            durations.append(time.monotonic() - started_at)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3, help="runs per scenario")
+    parser.add_argument(
+        "--stacks", default="bastion",
+        help="comma separated stacks of the selective scenario (default: bastion)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as manifest_dir:
+        manifest_env = {"CDK_ASSET_MANIFEST": os.path.join(manifest_dir, "manifest.json")}
+        scenarios = [("full", {}, None), ("selective", {"Stacks": args.stacks}, None)]
+
+        # Record then confirm the assets, as a deploy pipeline would after a deploy
+        synth({"SkipUnchangedAssets": "true"}, manifest_env, runs=1)
+        with open(manifest_env["CDK_ASSET_MANIFEST"]) as manifest:
+            stack_names = sorted({asset_id.split("/", 1)[0] for asset_id in json.load(manifest)})
+        subprocess.run(
+            [sys.executable, "-m", "gitlab_ci_fargate_runner.assets", "confirm", *stack_names],
+            env={**os.environ, **manifest_env}, check=True)
+        scenarios += [
+            ("skip unchanged assets", {"SkipUnchangedAssets": "true"}, manifest_env),
+            ("selective + skip", {"Stacks": args.stacks, "SkipUnchangedAssets": "true"},
+             manifest_env),
+        ]
+
+        print(f"{'scenario':<24}{'median (s)':>12}{'min (s)':>10}")
+        for name, context, env in scenarios:
+            durations = synth(context, env, args.runs)
+            print(f"{name:<24}{statistics.median(durations):>12.2f}{min(durations):>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
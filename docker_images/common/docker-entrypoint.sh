@@ -69,10 +69,54 @@ propagateAWSEnvVarsAllLoginSessions() {
   done
 }
 
+warmKanikoCache() {
+
+  # Skip the warmer if no base image is configured or the image has no warmer.
+  [ -z "$KANIKO_WARM_IMAGES" ] && return
+  command -v warmer > /dev/null || return
+
+  # Pull the base images into the cache directory shared on the EFS workspace,
+  # the images already cached are skipped and one task at a time warms the cache.
+  mkdir -p $KANIKO_CACHE_DIR
+  WARMER_IMAGES=""
+  for IMAGE in $(echo "$KANIKO_WARM_IMAGES" | tr "," " ")
+  do
+    WARMER_IMAGES="$WARMER_IMAGES --image=$IMAGE"
+  done
+  flock -n $KANIKO_CACHE_DIR/.warmer.lock warmer --cache-dir=$KANIKO_CACHE_DIR $WARMER_IMAGES &
+}
+
+setupSSHHostKey() {
+
+  # The host key of sshd, by SSH_HOST_KEYS:
+  # - image (default): the ed25519 key generated when the image was built
+  # - task: a new ed25519 key for each task, a few milliseconds
+  # - secret: the private key of the SSH_HOST_KEY environment variable,
+  #   set from Secrets Manager by the task definition
+  SSH_HOST_KEY_FILE=/etc/ssh/ssh_host_ed25519_key
+  case "${SSH_HOST_KEYS:-image}" in
+    secret)
+      (umask 077 && printf '%s\n' "$SSH_HOST_KEY" > $SSH_HOST_KEY_FILE)
+      rm -f $SSH_HOST_KEY_FILE.pub
+      unset SSH_HOST_KEY
+      ;;
+    task)
+      rm -f $SSH_HOST_KEY_FILE $SSH_HOST_KEY_FILE.pub
+      ssh-keygen -q -t ed25519 -N '' -f $SSH_HOST_KEY_FILE
+      ;;
+    *)
+      # Custom images without a key generated at build
+      [ -f $SSH_HOST_KEY_FILE ] || ssh-keygen -q -t ed25519 -N '' -f $SSH_HOST_KEY_FILE
+      ;;
+  esac
+}
+
 storeAWSTemporarySecurityCredentials
 
 propagateAWSEnvVarsAllLoginSessions
 
+warmKanikoCache
+
 USER_SSH_KEYS_FOLDER=~/.ssh
 [ ! -d ${USER_SSH_KEYS_FOLDER} ] && mkdir -p ${USER_SSH_KEYS_FOLDER}
 
@@ -83,7 +127,7 @@ echo ${SSH_PUBLIC_KEY} > ${USER_SSH_KEYS_FOLDER}/authorized_keys
 
 # # Clear the `SSH_PUBLIC_KEY` environment variable.
 unset SSH_PUBLIC_KEY
-ssh-keygen -A
+setupSSHHostKey
 
-# Start the SSH daemon
+# Start the SSH daemon last, its banner tells the driver the task is ready
 exec /usr/sbin/sshd -D
@@ -0,0 +1,197 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Content-hash manifest of the docker image assets.
+
+A DockerImageAsset is fingerprinted and staged in cdk.out at every synth,
+and published again by the deploy when its hash changed. When skipping is
+enabled, the image of a source directory and build args already published
+is referenced by its URI instead, and its asset is not created at all.
+
+The manifest maps each asset to the hash of its sources, the stat of its
+files (to skip reading unchanged files) and the tag of its published image.
+Entries are written at synth time and only reused once confirmed, after a
+successful deploy of their stacks:
+
+    python -m gitlab_ci_fargate_runner.assets confirm <stack name>...
+"""
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+
+MANIFEST_PATH = os.environ.get("CDK_ASSET_MANIFEST", ".cdk-asset-manifest.json")
+
+# ECS cpu architecture of a task definition, and ARCH build arg of its image
+ARCHITECTURES = {"x86_64": "amd64", "arm64": "arm64"}
+
+
+def docker_architecture(architecture):
+    """ARCH build arg (amd64 or arm64) of the images of an ECS cpu architecture."""
+    if architecture not in ARCHITECTURES:
+        raise ValueError(
+            f"Unknown architecture {architecture}, expected one of {', '.join(ARCHITECTURES)}")
+    return ARCHITECTURES[architecture]
+
+
+def list_files(directory, exclude=None):
+    """Relative paths of the files of a directory, sorted, without the excluded ones."""
+    exclude = exclude or []
+    files = []
+    for root, dirs, names in os.walk(directory):
+        relative_root = os.path.relpath(root, directory)
+        dirs[:] = sorted(
+            name for name in dirs
+            if not excluded(os.path.normpath(os.path.join(relative_root, name)), exclude))
+        for name in names:
+            path = os.path.normpath(os.path.join(relative_root, name))
+            if not excluded(path, exclude):
+                files.append(path)
+    return sorted(files)
+
+
+def excluded(path, exclude):
+    return any(
+        fnmatch.fnmatch(path, pattern) or path.split(os.sep)[0] == pattern
+        for pattern in exclude)
+
+
+def file_stats(directory, files):
+    stats = {}
+    for path in files:
+        stat = os.stat(os.path.join(directory, path))
+        stats[path] = [stat.st_size, stat.st_mtime_ns]
+    return stats
+
+
+def source_hash(directory, files, build_args=None, file=None):
+    """Hash of the content of the files, the build args and the Dockerfile path."""
+    digest = hashlib.sha256()
+    digest.update(json.dumps(
+        {"build_args": build_args or {}, "file": file}, sort_keys=True).encode())
+    for path in files:
+        digest.update(path.encode() + b"\0")
+        with open(os.path.join(directory, path), "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AssetManifest:
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump(self.entries, f, indent=2, sort_keys=True)
+
+    def source_hash(self, asset_id, directory, exclude=None, build_args=None, file=None):
+        """Hash the sources of an asset, reusing the manifest hash when no file changed."""
+        files = list_files(directory, exclude)
+        stats = file_stats(directory, files)
+        entry = self.entries.get(asset_id, {})
+        options = {"build_args": build_args or {}, "file": file}
+        if entry.get("files") == stats and entry.get("options") == options:
+            return entry["source_hash"], stats
+        return source_hash(directory, files, build_args, file), stats
+
+    def published_tag(self, asset_id, source_hash):
+        """Tag of the published image of these sources, if any."""
+        entry = self.entries.get(asset_id, {})
+        if entry.get("confirmed") and entry.get("source_hash") == source_hash:
+            return entry["image_tag"]
+        return None
+
+    def record(self, asset_id, source_hash, stats, options, image_tag):
+        previous = self.entries.get(asset_id, {})
+        self.entries[asset_id] = {
+            "source_hash": source_hash,
+            "files": stats,
+            "options": options,
+            "image_tag": image_tag,
+            # Synthesizing the same image again keeps its confirmation
+            "confirmed": previous.get("confirmed", False)
+            and previous.get("image_tag") == image_tag,
+        }
+        self.save()
+
+    def confirm(self, stack_names):
+        """Confirm the assets of the deployed stacks, their images are published."""
+        for asset_id, entry in self.entries.items():
+            if asset_id.split("/", 1)[0] in stack_names:
+                entry["confirmed"] = True
+        self.save()
+
+
+def docker_image_uri(scope, construct_id, directory, file=None, exclude=None,
+                     build_args=None, skip_unchanged=False):
+    """URI of the image built from a directory, as a DockerImageAsset or a published image."""
+    import aws_cdk as cdk
+    from aws_cdk.aws_ecr_assets import DockerImageAsset
+
+    stack = cdk.Stack.of(scope)
+    if not skip_unchanged:
+        return DockerImageAsset(
+            scope,
+            construct_id,
+            directory=directory,
+            file=file,
+            exclude=exclude,
+            build_args=build_args,
+        ).image_uri
+
+    asset_id = f"{stack.stack_name}/{construct_id}"
+    manifest = AssetManifest()
+    options = {"build_args": build_args or {}, "file": file}
+    digest, stats = manifest.source_hash(asset_id, directory, exclude, build_args, file)
+
+    image_tag = manifest.published_tag(asset_id, digest)
+    if image_tag:
+        repository_name = cdk.DefaultStackSynthesizer.DEFAULT_IMAGE_ASSETS_REPOSITORY_NAME \
+            .replace("${Qualifier}", cdk.DefaultStackSynthesizer.DEFAULT_QUALIFIER) \
+            .replace("${AWS::AccountId}", stack.account) \
+            .replace("${AWS::Region}", stack.region)
+        return f"{stack.account}.dkr.ecr.{stack.region}.{stack.url_suffix}/{repository_name}:{image_tag}"
+
+    asset = DockerImageAsset(
+        scope,
+        construct_id,
+        directory=directory,
+        file=file,
+        exclude=exclude,
+        build_args=build_args,
+    )
+    manifest.record(asset_id, digest, stats, options, asset.asset_hash)
+    return asset.image_uri
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["confirm"] and sys.argv[2:]:
+        AssetManifest().confirm(sys.argv[2:])
+    elif sys.argv[1:] == ["show"]:
+        json.dump({
+            asset_id: {key: entry[key] for key in ("source_hash", "image_tag", "confirmed")}
+            for asset_id, entry in AssetManifest().entries.items()
+        }, sys.stdout, indent=2)
+        print()
+    else:
+        sys.exit("Usage: python -m gitlab_ci_fargate_runner.assets confirm <stack name>...|show")
@@ -0,0 +1,86 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Build a git bundle of each configured repository and upload it to the cache
+# bucket, under git-bundles/<project path>.bundle. Run on a schedule by the
+# GitBundles task of the runner stack, with the runner image. The jobs of
+# these projects seed their working copy from the bundle before fetching the
+# delta from GitLab (see fargate-driver.sh).
+#
+# The previous bundle of a repository is downloaded first, so only the
+# commits pushed since the last run are fetched from GitLab.
+#
+# Environment variables:
+# - GITLAB_URL (required): the URL to the GitLab instance
+# - GITLAB_API_TOKEN (required): token with the read_repository scope
+# - CACHE_BUCKET (required): bucket receiving the bundles
+# - GIT_BUNDLE_REPOSITORIES (required): comma separated list of project paths,
+#   ex: group/monorepo,group/other
+# - GIT_BUNDLE_MAX_SIZE (optional): bundles bigger than this size in MiB are
+#   not uploaded (defaults to 2048)
+# -----------------------------------------------------------------------------
+
+GIT_BUNDLE_MAX_SIZE=${GIT_BUNDLE_MAX_SIZE:-2048}
+GIT_BUNDLE_PREFIX=git-bundles
+
+###############################################################################
+# Build and upload the bundle of a repository.
+#
+# Arguments:
+#   $1 - Project path, ex: group/monorepo
+###############################################################################
+build_git_bundle() {
+    local key="${GIT_BUNDLE_PREFIX}/$1.bundle"
+    local work_dir size
+    work_dir=$(mktemp -d)
+
+    # Start from the previous bundle, fall back to a full clone
+    if aws s3 cp --quiet "s3://${CACHE_BUCKET}/${key}" "${work_dir}/previous.bundle" 2>/dev/null \
+        && git clone --quiet --mirror "${work_dir}/previous.bundle" "${work_dir}/mirror"; then
+        git -C "${work_dir}/mirror" remote set-url origin "${GITLAB_URL}/$1.git"
+    else
+        git init --quiet --bare "${work_dir}/mirror"
+        git -C "${work_dir}/mirror" remote add --mirror=fetch origin "${GITLAB_URL}/$1.git"
+    fi
+    rm -f "${work_dir}/previous.bundle"
+
+    git -C "${work_dir}/mirror" \
+        -c http.extraHeader="Authorization: Basic $(printf 'oauth2:%s' "${GITLAB_API_TOKEN}" | base64 -w 0)" \
+        fetch --quiet --prune origin '+refs/heads/*:refs/heads/*' '+refs/tags/*:refs/tags/*' \
+        && git -C "${work_dir}/mirror" bundle create "${work_dir}/repository.bundle" --branches --tags \
+        || { echo "Failed to bundle $1" >&2; rm -rf "${work_dir}"; return 1; }
+
+    size=$(($(stat -c %s "${work_dir}/repository.bundle") / 1048576))
+    if [ ${size} -gt ${GIT_BUNDLE_MAX_SIZE} ]; then
+        echo "Bundle of $1 is ${size} MiB, above the ${GIT_BUNDLE_MAX_SIZE} MiB limit, skipped" >&2
+        rm -rf "${work_dir}"
+        return 1
+    fi
+
+    aws s3 cp --quiet "${work_dir}/repository.bundle" "s3://${CACHE_BUCKET}/${key}"
+    echo "Uploaded the ${size} MiB bundle of $1"
+    rm -rf "${work_dir}"
+}
+
+failed=0
+for repository in ${GIT_BUNDLE_REPOSITORIES//,/ }; do
+    build_git_bundle "${repository}" || failed=1
+done
+exit ${failed}
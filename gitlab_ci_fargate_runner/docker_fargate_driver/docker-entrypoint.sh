@@ -19,90 +19,524 @@
 
 # -----------------------------------------------------------------------------
 # Important: this scripts depends on some predefined environment variables:
-# - GITLAB_REGISTRATION_TOKEN (required): registration token for your project
+# - GITLAB_REGISTRATION_TOKEN (required without RUNNER_TOKEN_SECRETS):
+#   registration token for your project
+# - RUNNER_TOKEN_SECRETS (optional): Secrets Manager secrets holding the
+#   authentication tokens of the runners, one secret per runner task slot, ex:
+#   {"python": "glrt-...", "nodejs": "glrt-..."}. The runners are neither
+#   registered nor unregistered
+# - RUNNER_TOKEN_LEASE_TABLE (required with RUNNER_TOKEN_SECRETS): DynamoDB
+#   table of the slots leased by the runner tasks
 # - GITLAB_URL (optional): the URL to the GitLab instance (defaults to https://gitlab.com)
-# - RUNNER_TAG_LIST (optional): comma separated list of tags for the runner
+# - RUNNER_IMAGES (required): JSON list of the docker images served by this
+#   runner, one runner is registered per image:
+#   [{"name": "python", "task_definition": "python", "tags": "python,py",
+#     "default_size": "medium", "sizes": ["small", "medium", "large"], "environment": ["PIP_CACHE_DIR=/cache"],
+#     "efs": true, "efs_projects": [42]}]
 # - FARGATE_CLUSTER (required): the AWS Fargate cluster name
 # - FARGATE_REGION (required): the AWS region where the task should be started
 # - FARGATE_SECURITY_GROUP (required): the AWS security group where the task
 #   should be started
-# - FARGATE_TASK_DEFINITION (required): the task definition used for the task
+# - WARM_POOL_SIZE (optional): number of idle CI tasks kept per task definition
+#   (see warm-pool.sh)
+# - TASK_REUSE_IDLE_TIMEOUT (optional): seconds the CI task of a job is kept for
+#   the next job of its pipeline (see fargate-driver.sh and task-reuse.sh)
+# - CACHE_SHARED (optional): share the cache between all the runners (defaults
+#   to true)
+# - CACHE_SERVER_ADDRESS (optional): S3 endpoint of the cache (defaults to
+#   s3.<CACHE_BUCKET_REGION>.amazonaws.com), CACHE_INSECURE (optional): use
+#   http instead of https with it (defaults to false)
+# - RUNNER_CONCURRENT (optional): maximum number of jobs run at the same time
+#   by the runner task, all images together (defaults to 10)
+# - RUNNER_CONCURRENT_PARAMETER (optional): SSM parameter holding the value of
+#   RUNNER_CONCURRENT, set by the capacity profiles. It is read at start, then
+#   every CONCURRENCY_POLL_INTERVAL seconds (defaults to 60)
+# - RUNNER_ENVIRONMENT (optional): TOML list of variables added to every job,
+#   ex: ["FF_USE_FASTZIP=true"], followed by the environment of the image
+#   (defaults to [])
+# - FARGATE_SUBNET_MAP (optional): JSON object of the subnet of each
+#   availability zone, the CI tasks run in the subnet of the AZ of the runner
+#   task (read from the runner task when missing)
+# - RUNNER_OUTPUT_LIMIT (optional): maximum size of the log of a job in KiB
+#   (defaults to 4096)
+# - BOOTSTRAP_BUDGET (optional): seconds from the container start to the start
+#   of gitlab-runner above which a warning is logged (defaults to 30)
+# - DRAIN_TIMEOUT (optional): seconds given to the running jobs to finish when
+#   the task is stopped (Spot interruption, deployment, scale in) before their
+#   CI tasks are stopped (defaults to 100, within the 120 seconds stopTimeout)
+# - DRAIN_REPORT_TIMEOUT (optional): seconds left to the runner to report the
+#   interrupted jobs before it is killed (defaults to 10)
 # -----------------------------------------------------------------------------
 
+source /usr/local/bin/fargate-tasks.sh
+source /usr/local/bin/metrics.sh
+
+DRAIN_TIMEOUT=${DRAIN_TIMEOUT:-100}
+DRAIN_REPORT_TIMEOUT=${DRAIN_REPORT_TIMEOUT:-10}
+BOOTSTRAP_BUDGET=${BOOTSTRAP_BUDGET:-30}
+# Seconds waiting for a slot of RUNNER_TOKEN_SECRETS to be released
+RUNNER_TOKEN_CLAIM_TIMEOUT=${RUNNER_TOKEN_CLAIM_TIMEOUT:-300}
+CONCURRENCY_POLL_INTERVAL=${CONCURRENCY_POLL_INTERVAL:-60}
+
+###############################################################################
+# Log a step of the bootstrap with the milliseconds elapsed since the start of
+# the container, and add it to the bootstrap timeline.
+#
+# Arguments:
+#   $1 - Name of the step
+#
+# Globals:
+#   - bootstrap_started_at, bootstrap_timeline
+###############################################################################
+timeline() {
+    local elapsed=$(($(date +%s%3N) - bootstrap_started_at))
+
+    echo "$(date -u +%FT%T.%3NZ) bootstrap +${elapsed}ms $1"
+    bootstrap_timeline+="\"$1\": ${elapsed}, "
+}
+
+###############################################################################
+# Write the bootstrap duration and its timeline as an EMF record, and warn
+# when it is over BOOTSTRAP_BUDGET. The start time is kept for the
+# TimeToFirstJob metric of fargate-driver.sh.
+###############################################################################
+emit_bootstrap_metrics() {
+    local duration=$(($(date +%s%3N) - bootstrap_started_at))
+
+    echo "${bootstrap_started_at}" > "${RUNNER_STATE_DIR}/bootstrap_started_at"
+    if [ ${duration} -gt $((BOOTSTRAP_BUDGET * 1000)) ]; then
+        echo "WARNING: bootstrap took ${duration}ms, over the budget of ${BOOTSTRAP_BUDGET}s" >&2
+    fi
+    emit_metrics \
+        "$(jq -cn --arg cluster "${FARGATE_CLUSTER}" --arg task_arn "${TASK_ARN}" \
+            --argjson timeline "{${bootstrap_timeline%, }}" \
+            '{Cluster: $cluster, TaskArn: $task_arn, Timeline: $timeline}')" \
+        '[["Cluster"]]' \
+        "{\"BootstrapDuration\": {\"value\": ${duration}, \"unit\": \"Milliseconds\"}}"
+}
+
 get_from_metadata() {
+    local subnets=${FARGATE_SUBNET_MAP:-"{}"}
+
     # Default to https://gitlab.com if the GitLab URL was not specified
     export GITLAB_URL=${GITLAB_URL:=https://gitlab.com}
 
-    AWS_METADATA=$(curl -s ${ECS_CONTAINER_METADATA_URI_V4}/task)
-    export CONTAINER_AZ=$(echo ${AWS_METADATA} | jq -r .AvailabilityZone)
-    export CLUSTER_ARN=$(echo ${AWS_METADATA}  | jq -r  .Cluster)
-    export TASK_ARN=$(echo ${AWS_METADATA} | jq -r .TaskARN)
-    export FARGATE_SUBNET=$(aws ecs describe-tasks --cluster $CLUSTER_ARN --tasks $TASK_ARN | jq  -r '.tasks[].attachments[].details[] | select(.name=="subnetId").value')
-
+    # A single jq reads the task metadata and the subnet of its AZ passed by the stack
+    IFS=$'\t' read -r CONTAINER_AZ CLUSTER_ARN TASK_ARN FARGATE_SUBNET < <(
+        curl -s "${ECS_CONTAINER_METADATA_URI_V4}/task" \
+            | jq -r --argjson subnets "${subnets}" \
+                '[.AvailabilityZone, .Cluster, .TaskARN, ($subnets[.AvailabilityZone] // "")] | @tsv')
+    if [ -z "${FARGATE_SUBNET}" ]; then
+        FARGATE_SUBNET=$(aws ecs describe-tasks --cluster $CLUSTER_ARN --tasks $TASK_ARN | jq  -r '.tasks[].attachments[].details[] | select(.name=="subnetId").value')
+    fi
+    export CONTAINER_AZ CLUSTER_ARN TASK_ARN FARGATE_SUBNET
 }
+
 ###############################################################################
-# Remove the Runner from the list of runners of the project identified by the
-# authentication token.
+# Remove the Runners from the list of runners of the project identified by the
+# authentication tokens.
 #
 # Arguments:
-#   $1 - Authorization token obtained after registering the runner in the
+#   $@ - Authorization tokens obtained after registering the runners in the
 #        project
 ###############################################################################
 unregister_runner() {
-    curl --request DELETE "${GITLAB_URL}/api/v4/runners" --form "token=$1"
+    local token
+    for token in "$@"; do
+        curl --request DELETE "${GITLAB_URL}/api/v4/runners" --form "token=${token}"
+    done
+}
+
+###############################################################################
+# Lease a slot of RUNNER_TOKEN_SECRETS to this task. A slot is free when it has
+# no owner or when its owner, a runner task, is stopped. The lease is written
+# with a conditional put, so that two runner tasks never share a slot.
+#
+# Arguments:
+#   $1 - Name of the secret of the slot
+###############################################################################
+lease_token_slot() {
+    local key owner status condition
+
+    key=$(jq -cn --arg slot "$1" '{slot: {S: $slot}}')
+    owner=$(aws dynamodb get-item --table-name "${RUNNER_TOKEN_LEASE_TABLE}" \
+        --key "${key}" --consistent-read | jq -r '.Item.owner.S // empty')
+
+    if [ -z "${owner}" ]; then
+        condition=(--condition-expression "attribute_not_exists(#owner)")
+    else
+        if [ "${owner}" != "${TASK_ARN}" ]; then
+            # A draining task still uses its tokens until it is stopped
+            status=$(aws ecs describe-tasks --cluster "${CLUSTER_ARN}" --tasks "${owner}" \
+                | jq -r '.tasks[0].lastStatus // "STOPPED"')
+            [ "${status}" == "STOPPED" ] || return 1
+        fi
+        condition=(--condition-expression "#owner = :owner"
+            --expression-attribute-values "$(jq -cn --arg owner "${owner}" '{":owner": {S: $owner}}')")
+    fi
+
+    aws dynamodb put-item --table-name "${RUNNER_TOKEN_LEASE_TABLE}" \
+        --item "$(jq -cn --arg slot "$1" --arg owner "${TASK_ARN}" --arg at "$(date -u +%FT%TZ)" \
+            '{slot: {S: $slot}, owner: {S: $owner}, leased_at: {S: $at}}')" \
+        --expression-attribute-names '{"#owner": "owner"}' \
+        "${condition[@]}" >/dev/null 2>&1
 }
 
 ###############################################################################
-# Register the Runner in the desired project, identified by the registration
-# token of that project.
+# Lease a free slot of RUNNER_TOKEN_SECRETS and read its authentication tokens,
+# waiting up to RUNNER_TOKEN_CLAIM_TIMEOUT seconds for a slot to be released.
 #
-# The function populates the "auth_token" variable with the authentication
-# token for the registered Runner.
+# The function sets "token_slot" and "runner_tokens".
+###############################################################################
+claim_runner_tokens() {
+    local deadline=$((SECONDS + RUNNER_TOKEN_CLAIM_TIMEOUT)) slot
+
+    while true; do
+        for slot in ${RUNNER_TOKEN_SECRETS//,/ }; do
+            if lease_token_slot "${slot}"; then
+                token_slot=${slot}
+                runner_tokens=$(aws secretsmanager get-secret-value --secret-id "${slot}" \
+                    | jq -r '.SecretString')
+                echo "Using the runner tokens of ${slot}"
+                return 0
+            fi
+        done
+        if [ ${SECONDS} -ge ${deadline} ]; then
+            echo "No free slot in ${RUNNER_TOKEN_SECRETS}" >&2
+            return 1
+        fi
+        sleep 10
+    done
+}
+
+###############################################################################
+# Release the slot leased by this task.
+###############################################################################
+release_token_slot() {
+    [ -n "${token_slot}" ] || return 0
+    aws dynamodb delete-item --table-name "${RUNNER_TOKEN_LEASE_TABLE}" \
+        --key "$(jq -cn --arg slot "${token_slot}" '{slot: {S: $slot}}')" \
+        --condition-expression "#owner = :owner" \
+        --expression-attribute-names '{"#owner": "owner"}' \
+        --expression-attribute-values "$(jq -cn --arg owner "${TASK_ARN}" '{":owner": {S: $owner}}')" \
+        >/dev/null
+}
+
+###############################################################################
+# Register a Runner in the desired project, identified by the registration
+# token of that project, and print its authentication token. The runner also
+# picks up the untagged jobs, as counted by the queue poller of the autoscaling.
 #
 # Arguments:
 #   $1 - Registration token
 #   $2 - List of tags for the Runner, separated by comma
+#   $3 - Description of the Runner
 ###############################################################################
 register_runner() {
-
-    runner_identification="RUNNER_${CONTAINER_AZ}"
-
-    # Uses the environment variable "GITLAB_REGISTRATION_TOKEN" to register the runner
-
     result_json=$(
         curl --request POST "${GITLAB_URL}/api/v4/runners" \
             --form "token=$1" \
-            --form "description=${runner_identification}" \
-            --form "tag_list=$2"
+            --form "description=$3" \
+            --form "tag_list=$2" \
+            --form "run_untagged=true"
     )
 
     # Read the authentication token
+    echo "${result_json}" | jq -r '.token'
+}
 
-    export auth_token=$(echo $result_json | jq -r '.token')
-
-    # Recreate the runner config.toml based on our template
+###############################################################################
+# Register the Runners of all the images of RUNNER_IMAGES concurrently. The
+# authentication token of each one is written to <directory>/<image name>.
+#
+# Arguments:
+#   $1 - Registration token
+#   $2 - Directory of the tokens
+###############################################################################
+register_runners() {
+    local name tags pids=()
 
-    export RUNNER_NAME=$runner_identification
-    export RUNNER_AUTH_TOKEN=$auth_token
-    envsubst < /tmp/config_runner_template.toml > /etc/gitlab-runner/config.toml
+    while IFS=$'\x1f' read -r name tags; do
+        register_runner "$1" "${tags}" "RUNNER_${CONTAINER_AZ}_${name}" > "$2/${name}" &
+        pids+=($!)
+    done < <(echo "${RUNNER_IMAGES}" | jq -r '.[] | [.name, .tags // ""] | join("\u001f")')
+    # The warm pool also runs in background, only wait for the registrations
+    wait "${pids[@]}"
 }
 
 ###############################################################################
-# Create the Fargate driver TOML configuration file based on a template
-# that is persisted in the repository. It uses the environment variables
-# passed to the container to set the correct values in that file.
+# Create the Fargate driver TOML configuration file of a docker image based on
+# a template that is persisted in the repository. It uses the environment
+# variables passed to the container to set the correct values in that file.
+# The settings read by fargate-driver.sh are written next to it, in a .env
+# file.
 #
 # Globals:
+#   - DRIVER_CONFIG
 #   - FARGATE_CLUSTER
 #   - FARGATE_REGION
 #   - FARGATE_SUBNET
 #   - FARGATE_SECURITY_GROUP
 #   - FARGATE_TASK_DEFINITION
+#   - FARGATE_DEFAULT_TASK_SIZE
+#   - FARGATE_TASK_SIZES
+#   - RUNNER_IMAGE
+#   - EFS_WORKSPACE
+#   - EFS_PROJECTS
 ###############################################################################
 create_driver_config() {
-    envsubst < /tmp/config_driver_template.toml > /etc/gitlab-runner/config_driver.toml
+    envsubst < /tmp/config_driver_template.toml > "${DRIVER_CONFIG}"
+    {
+        echo "RUNNER_IMAGE=${RUNNER_IMAGE}"
+        echo "FARGATE_TASK_DEFINITION=${FARGATE_TASK_DEFINITION}"
+        echo "FARGATE_DEFAULT_TASK_SIZE=${FARGATE_DEFAULT_TASK_SIZE}"
+        echo "FARGATE_TASK_SIZES=${FARGATE_TASK_SIZES}"
+        echo "EFS_WORKSPACE=${EFS_WORKSPACE}"
+        echo "EFS_PROJECTS=${EFS_PROJECTS}"
+    } > "${DRIVER_CONFIG%.toml}.env"
 }
 
+###############################################################################
+# Register one Runner per docker image of RUNNER_IMAGES and recreate the
+# runner config.toml based on our templates: the global settings followed by
+# one [[runners]] section per image, each one with its own driver config.
+#
+# The function populates the "auth_tokens" array with the authentication
+# tokens of the registered Runners. With a leased slot of RUNNER_TOKEN_SECRETS,
+# the tokens of the slot are used instead and no Runner is registered.
+#
+# Arguments:
+#   $1 - Registration token
+###############################################################################
+create_runners_config() {
+    local global_environment=${RUNNER_ENVIRONMENT:-[]} tokens_dir
+
+    auth_tokens=()
+    export CACHE_SHARED=${CACHE_SHARED:-true}
+    export CACHE_SERVER_ADDRESS=${CACHE_SERVER_ADDRESS:-s3.${CACHE_BUCKET_REGION}.amazonaws.com}
+    export CACHE_INSECURE=${CACHE_INSECURE:-false}
+    export RUNNER_CONCURRENT=${RUNNER_CONCURRENT:-10}
+    export RUNNER_OUTPUT_LIMIT=${RUNNER_OUTPUT_LIMIT:-4096}
+    envsubst < /tmp/config_runner_template.toml > /etc/gitlab-runner/config.toml
+
+    if [ -z "${token_slot}" ]; then
+        tokens_dir=$(mktemp -d)
+        register_runners "$1" "${tokens_dir}"
+        timeline "runners_registered"
+    fi
+
+    # One jq for all the images, the fields are separated by \x1f as they can be empty
+    while IFS=$'\x1f' read -r RUNNER_IMAGE FARGATE_TASK_DEFINITION FARGATE_DEFAULT_TASK_SIZE \
+            FARGATE_TASK_SIZES EFS_WORKSPACE EFS_PROJECTS RUNNER_ENVIRONMENT; do
+        export RUNNER_IMAGE FARGATE_TASK_DEFINITION FARGATE_DEFAULT_TASK_SIZE \
+            FARGATE_TASK_SIZES EFS_WORKSPACE EFS_PROJECTS RUNNER_ENVIRONMENT
+        export DRIVER_CONFIG=/etc/gitlab-runner/config_driver_${RUNNER_IMAGE}.toml
+        create_driver_config
+
+        export RUNNER_NAME="RUNNER_${CONTAINER_AZ}_${RUNNER_IMAGE}"
+        if [ -n "${token_slot}" ]; then
+            # Persistent runner, its tags are the ones set when it was created in GitLab
+            export RUNNER_AUTH_TOKEN=$(echo "${runner_tokens}" | jq -r --arg image "${RUNNER_IMAGE}" '.[$image] // .token // empty')
+            if [ -z "${RUNNER_AUTH_TOKEN}" ]; then
+                echo "No token for ${RUNNER_IMAGE} in ${token_slot}" >&2
+                return 1
+            fi
+        else
+            export RUNNER_AUTH_TOKEN=$(<"${tokens_dir}/${RUNNER_IMAGE}")
+            auth_tokens+=("${RUNNER_AUTH_TOKEN}")
+        fi
+        envsubst < /tmp/config_runner_section_template.toml | sed '/^#/d' >> /etc/gitlab-runner/config.toml
+    done < <(echo "${RUNNER_IMAGES}" | jq -r --argjson global "${global_environment}" \
+        '.[] | [.name, .task_definition // "", .default_size // "", (.sizes // [] | join(",")), (.efs // false),
+                (.efs_projects // [] | join(",")), ($global + (.environment // []) | tojson)]
+             | map(tostring) | join("\u001f")')
+    [ -n "${tokens_dir}" ] && rm -rf "${tokens_dir}"
+    timeline "runners_configured"
+}
+
+###############################################################################
+# Start the warm pool of CI tasks in background, when enabled.
+#
+# Globals:
+#   - WARM_POOL_SIZE
+###############################################################################
+start_warm_pool() {
+    if [ "${WARM_POOL_SIZE:-0}" -gt 0 ]; then
+        /usr/local/bin/warm-pool.sh &
+        warm_pool_pid=$!
+    fi
+}
+
+###############################################################################
+# Stop the warm pool, its idle CI tasks are stopped as well.
+###############################################################################
+stop_warm_pool() {
+    if [ -n "${warm_pool_pid}" ]; then
+        kill -15 "${warm_pool_pid}"
+        wait "${warm_pool_pid}"
+        warm_pool_pid=
+    fi
+}
+
+###############################################################################
+# Start the expiry of the idle CI tasks kept for the next job of their
+# pipeline in background, when enabled.
+#
+# Globals:
+#   - TASK_REUSE_IDLE_TIMEOUT
+###############################################################################
+start_task_reuse() {
+    if [ "${TASK_REUSE_IDLE_TIMEOUT:-0}" -gt 0 ]; then
+        /usr/local/bin/task-reuse.sh &
+        task_reuse_pid=$!
+    fi
+}
+
+###############################################################################
+# Stop the expiry of the idle CI tasks, the idle tasks are stopped as well.
+###############################################################################
+stop_task_reuse() {
+    if [ -n "${task_reuse_pid}" ]; then
+        kill -15 "${task_reuse_pid}"
+        wait "${task_reuse_pid}"
+        task_reuse_pid=
+    fi
+}
+
+###############################################################################
+# Print the concurrent jobs of RUNNER_CONCURRENT_PARAMETER, fails when the
+# parameter can not be read or is not a positive number.
+###############################################################################
+read_concurrency() {
+    local concurrent
+
+    concurrent=$(aws ssm get-parameter --region "${FARGATE_REGION}" \
+        --name "${RUNNER_CONCURRENT_PARAMETER}" --query Parameter.Value --output text) || return 1
+    [[ "${concurrent}" =~ ^[1-9][0-9]*$ ]] || return 1
+    echo "${concurrent}"
+}
+
+###############################################################################
+# Follow the concurrent jobs of the capacity profiles: a new value of
+# RUNNER_CONCURRENT_PARAMETER is written to config.toml, and gitlab-runner
+# reloads its configuration without restarting. The running jobs are kept
+# when the limit is lowered.
+###############################################################################
+watch_concurrency() {
+    local current=${RUNNER_CONCURRENT} concurrent
+
+    while true; do
+        sleep "${CONCURRENCY_POLL_INTERVAL}"
+        concurrent=$(read_concurrency) || continue
+        [ "${concurrent}" = "${current}" ] && continue
+        sed -i "s/^concurrent = .*/concurrent = ${concurrent}/" /etc/gitlab-runner/config.toml
+        echo "Concurrent jobs changed from ${current} to ${concurrent}"
+        current=${concurrent}
+    done
+}
+
+###############################################################################
+# Start the watcher of the concurrent jobs in background, when enabled.
+#
+# Globals:
+#   - RUNNER_CONCURRENT_PARAMETER
+###############################################################################
+start_concurrency_watcher() {
+    if [ -n "${RUNNER_CONCURRENT_PARAMETER}" ]; then
+        watch_concurrency &
+        concurrency_watcher_pid=$!
+    fi
+}
+
+###############################################################################
+# Stop the watcher of the concurrent jobs.
+###############################################################################
+stop_concurrency_watcher() {
+    if [ -n "${concurrency_watcher_pid}" ]; then
+        kill -15 "${concurrency_watcher_pid}" 2>/dev/null
+        concurrency_watcher_pid=
+    fi
+}
+
+###############################################################################
+# Wait for a process to exit.
+#
+# Arguments:
+#   $1 - PID of the process
+#   $2 - Timeout in seconds
+###############################################################################
+wait_exit() {
+    local deadline=$((SECONDS + $2))
+
+    while kill -0 "$1" 2>/dev/null; do
+        [ ${SECONDS} -ge ${deadline} ] && return 1
+        sleep 1
+    done
+}
+
+###############################################################################
+# Stop the CI tasks of the jobs still running, recorded by fargate-driver.sh in
+# ${RUNNER_STATE_DIR}/active-jobs. Their current step then fails with a runner
+# system failure, that the jobs can retry with:
+#   retry:
+#     when: runner_system_failure
+# Each interrupted job is written as an InterruptedJobs EMF metric.
+###############################################################################
+interrupt_jobs() {
+    local job task_arn
+
+    for job in "${RUNNER_STATE_DIR}/active-jobs"/*.json; do
+        [ -f "${job}" ] || continue
+        task_arn=$(jq -r '.task_arn // empty' "${job}")
+        echo "Interrupting job $(jq -r '.job_id' "${job}") of project $(jq -r '.project_id' "${job}") (${task_arn:-task unknown})"
+        [ -n "${task_arn}" ] && stop_ci_task "${task_arn}" "Runner ${TASK_ARN} is shutting down"
+        emit_metrics \
+            "$(jq -c '{Image: .image, JobId: .job_id, ProjectId: .project_id,
+                PipelineId: .pipeline_id, JobUrl: .job_url, TaskArn: .task_arn}' "${job}")" \
+            '[["Image"]]' \
+            '{"InterruptedJobs": {"value": 1, "unit": "Count"}}'
+    done
+}
+
+###############################################################################
+# Drain the runner before the task stops: the runner stops requesting new jobs
+# (SIGQUIT) and the running jobs have DRAIN_TIMEOUT seconds to finish. The jobs
+# still running are then interrupted, and the runner is stopped once it
+# reported them to GitLab.
+#
+# Globals:
+#   - pid
+###############################################################################
+drain_runner() {
+    mkdir -p "${RUNNER_STATE_DIR}"
+    touch "${RUNNER_STATE_DIR}/draining"
+    stop_concurrency_watcher
+    stop_warm_pool
+    stop_task_reuse
+
+    echo "Draining the runner, waiting up to ${DRAIN_TIMEOUT}s for the running jobs"
+    kill -QUIT "${pid}"
+    wait_exit "${pid}" "${DRAIN_TIMEOUT}" && return
+
+    interrupt_jobs
+    wait_exit "${pid}" "${DRAIN_REPORT_TIMEOUT}" || kill -15 "${pid}"
+}
+
+###############################################################################
+# Exit when the runners can not be configured. The warm pool and the idle
+# reused tasks, started during the bootstrap, are stopped with their tasks
+# instead of running until the orphan sweep of an other runner task.
+###############################################################################
+abort_bootstrap() {
+    stop_warm_pool
+    stop_task_reuse
+    release_token_slot
+    exit 1
+}
+
+bootstrap_started_at=$(date +%s%3N)
+bootstrap_timeline=
+
 mkdir -p /log/
 touch stderr.log stdout.log
 
@@ -115,19 +549,39 @@ pre_execution_handler() {
     ## Pre Execution
 
     get_from_metadata
+    timeline "metadata"
+    mkdir -p "${RUNNER_STATE_DIR}"
+
+    # The warm pool only needs the metadata, it starts its tasks while the
+    # runners are configured
+    start_warm_pool
+    start_task_reuse
 
-    create_driver_config
+    # GITLAB_REGISTRATION_TOKEN Retreive from ECS Secret, unless the runners
+    # use the persistent tokens of a slot
+    if [ -n "${RUNNER_TOKEN_SECRETS}" ]; then
+        claim_runner_tokens || abort_bootstrap
+        timeline "tokens_claimed"
+    fi
 
-    # GITLAB_REGISTRATION_TOKEN Retreive from ECS Secret
+    # Concurrent jobs of the current capacity profile
+    local concurrent
+    if [ -n "${RUNNER_CONCURRENT_PARAMETER}" ] && concurrent=$(read_concurrency); then
+        RUNNER_CONCURRENT=${concurrent}
+    fi
 
-    register_runner ${GITLAB_REGISTRATION_TOKEN} ${RUNNER_TAG_LIST}
+    create_runners_config ${GITLAB_REGISTRATION_TOKEN} || abort_bootstrap
 
 }
 
 ## Post execution handler
 post_execution_handler() {
   ## Post Execution
-  unregister_runner ${auth_token}
+  stop_concurrency_watcher
+  stop_warm_pool
+  stop_task_reuse
+  unregister_runner "${auth_tokens[@]}"
+  release_token_slot
 }
 
 ## Sigterm Handler
@@ -137,7 +591,7 @@ sigterm_handler() {
     # that the application has already started. without it you
     # could attempt cleanup steps if the application failed to
     # start, causing errors.
-    kill -15 "$pid"
+    drain_runner
     wait "$pid"
     post_execution_handler
   fi
@@ -156,6 +610,9 @@ pre_execution_handler
 # run process in background and record PID
 >/log/stdout.log 2>/log/stderr.log "$@" &
 pid="$!"
+timeline "runner_started"
+start_concurrency_watcher
+emit_bootstrap_metrics
 # Application can log to stdout/stderr, /log/stdout.log or /log/stderr.log
 
 ## Wait forever until app dies
@@ -0,0 +1,677 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Wrapper around the Fargate custom executor driver, configured as the
+# config/prepare/run/cleanup executable of the runner. The driver arguments
+# are passed through unchanged:
+#   fargate-driver.sh --config <driver config> custom <stage> [stage arguments]
+#
+# The settings of the runner of a docker image (RUNNER_IMAGE,
+# FARGATE_TASK_DEFINITION, FARGATE_DEFAULT_TASK_SIZE and FARGATE_TASK_SIZES, the
+# comma separated sizes of the image) are read from the .env file next to the
+# driver config, written by docker-entrypoint.sh.
+#
+# Job variables are exposed by the custom executor as CUSTOM_ENV_<NAME>:
+# - FARGATE_TASK_SIZE (optional): size variant of the task definition used by
+#   the job (ex: small, large). Defaults to FARGATE_DEFAULT_TASK_SIZE
+# - FARGATE_TASK_DEFINITION (optional): task definition used by the job
+# - FARGATE_SIDECARS (optional): sidecar set of the image started next to the
+#   job (ex: postgres), the job runs once the sidecars are healthy
+#
+# The duration and exit code of every stage are written as CloudWatch
+# Embedded Metric Format records to the runner log (see metrics.sh), as well
+# as the cache hits and misses of the restore_cache step and the time from the
+# start of the runner to its first job.
+#
+# When the image has an EFS workspace (EFS_WORKSPACE), the builds directory is
+# declared shared between the jobs, so that each concurrent job gets its own
+# directory, and the jobs of the projects of EFS_PROJECTS run the
+# "<family>-project-<project id>" task definition, which mounts the access
+# point of the project.
+#
+# The get_sources step of the projects of GIT_BUNDLE_REPOSITORIES first seeds
+# a new working copy from the git bundle of the project in the cache bucket
+# (see build-git-bundles.sh), when it is younger than GIT_BUNDLE_MAX_AGE hours
+# (defaults to 24) and smaller than GIT_BUNDLE_MAX_SIZE MiB (defaults to 2048).
+# The fetch of the runner then downloads the delta only.
+#
+# The jobs between their prepare and cleanup stages are recorded in
+# ${RUNNER_STATE_DIR}/active-jobs, for the drain of docker-entrypoint.sh. While
+# the runner drains, a failed run stage is reported as a runner system failure.
+#
+# When the warm pool is enabled (WARM_POOL_SIZE), the prepare stage claims an
+# idle task of the pool. The run and cleanup stages of such a job are handled
+# here over SSH, without calling the driver.
+#
+# When the CI tasks are placed over several subnets (FARGATE_SUBNETS), the
+# driver only supports one, the prepare stage starts the task of the job
+# itself (see start_ci_task), retrying in the other availability zones and on
+# the other capacity providers when Fargate has no capacity. The job is then
+# handled like a job of the warm pool.
+#
+# When the CI tasks are reused (TASK_REUSE_IDLE_TIMEOUT), the prepare stage
+# starts the task of the job itself as well. The cleanup stage of a successful
+# job keeps the task idle in ${TASK_REUSE_DIR}/<project>-<pipeline>/<task
+# definition>/, where the next job of the pipeline with the same task
+# definition claims it, with its workspace and caches. The task is stopped
+# instead when a run stage failed, when the runner drains and once it ran
+# TASK_REUSE_MAX_JOBS jobs. task-reuse.sh stops the idle tasks after
+# TASK_REUSE_IDLE_TIMEOUT seconds.
+# -----------------------------------------------------------------------------
+
+source /usr/local/bin/fargate-tasks.sh
+source /usr/local/bin/metrics.sh
+
+FARGATE_DRIVER=${FARGATE_DRIVER:-/usr/local/bin/fargate-linux}
+GIT_BUNDLE_MAX_AGE=${GIT_BUNDLE_MAX_AGE:-24}
+GIT_BUNDLE_MAX_SIZE=${GIT_BUNDLE_MAX_SIZE:-2048}
+JOB_DIR=${RUNNER_STATE_DIR}/jobs/${CUSTOM_ENV_CI_JOB_ID}
+PLACEMENT_STARTED_BY=gitlab-runner
+# Messages of the restore_cache script generated by the runner, once per cache
+CACHE_HIT_MESSAGE="Successfully extracted cache"
+CACHE_MISS_MESSAGE="Failed to extract cache"
+
+###############################################################################
+# Select the task definition family of the requested task size. The default
+# size is registered under the image family, the other ones under
+# "<image family>-<size>". An unknown size fails the job.
+#
+# Globals:
+#   - CUSTOM_ENV_FARGATE_TASK_SIZE
+#   - CUSTOM_ENV_FARGATE_TASK_DEFINITION
+#   - FARGATE_DEFAULT_TASK_SIZE
+#   - FARGATE_TASK_DEFINITION
+#   - FARGATE_TASK_SIZES
+###############################################################################
+select_task_size() {
+    local size=${CUSTOM_ENV_FARGATE_TASK_SIZE:-${FARGATE_DEFAULT_TASK_SIZE}}
+    if [ -z "${size}" ] || [ "${size}" == "${FARGATE_DEFAULT_TASK_SIZE}" ]; then
+        return
+    fi
+    if [[ ",${FARGATE_TASK_SIZES}," != *",${size},"* ]]; then
+        echo "ERROR: Unknown FARGATE_TASK_SIZE ${size}, the sizes of ${RUNNER_IMAGE} are: ${FARGATE_TASK_SIZES:-none}" >&2
+        exit "${BUILD_FAILURE_EXIT_CODE:-1}"
+    fi
+
+    local family=${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}
+    # Drop any pinned revision, a size always runs the latest revision of its family
+    export CUSTOM_ENV_FARGATE_TASK_DEFINITION="${family%%:*}-${size}"
+}
+
+###############################################################################
+# Select the task definition of the requested sidecar set, registered as
+# "<family>-sidecars-<set>" for each task size.
+#
+# Globals:
+#   - CUSTOM_ENV_FARGATE_SIDECARS
+#   - CUSTOM_ENV_FARGATE_TASK_DEFINITION
+#   - FARGATE_TASK_DEFINITION
+###############################################################################
+select_sidecars() {
+    [ -n "${CUSTOM_ENV_FARGATE_SIDECARS}" ] || return 0
+    if [[ ! "${CUSTOM_ENV_FARGATE_SIDECARS}" =~ ^[a-z0-9][a-z0-9-]*$ ]]; then
+        echo "Invalid FARGATE_SIDECARS ${CUSTOM_ENV_FARGATE_SIDECARS}" >&2
+        exit "${BUILD_FAILURE_EXIT_CODE:-1}"
+    fi
+
+    local family=${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}
+    export CUSTOM_ENV_FARGATE_TASK_DEFINITION="${family%%:*}-sidecars-${CUSTOM_ENV_FARGATE_SIDECARS}"
+}
+
+###############################################################################
+# Select the task definition mounting the EFS access point of the project,
+# when the project has one. The sidecar sets only mount the shared workspace.
+#
+# Globals:
+#   - CUSTOM_ENV_CI_PROJECT_ID
+#   - CUSTOM_ENV_FARGATE_SIDECARS
+#   - CUSTOM_ENV_FARGATE_TASK_DEFINITION
+#   - EFS_PROJECTS
+#   - FARGATE_TASK_DEFINITION
+###############################################################################
+select_project_workspace() {
+    [ -n "${EFS_PROJECTS}" ] || return 0
+    [ -z "${CUSTOM_ENV_FARGATE_SIDECARS}" ] || return 0
+    [[ ",${EFS_PROJECTS}," == *",${CUSTOM_ENV_CI_PROJECT_ID},"* ]] || return 0
+
+    local family=${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}
+    export CUSTOM_ENV_FARGATE_TASK_DEFINITION="${family%%:*}-project-${CUSTOM_ENV_CI_PROJECT_ID}"
+}
+
+###############################################################################
+# Run the config stage of the driver and declare the builds directory as
+# shared: the runner then adds the runner token and the concurrent job id to
+# the path of the builds, and jobs running at the same time on the EFS
+# workspace never use the same directory.
+###############################################################################
+config_shared_workspace() {
+    local output code
+
+    output=$(forward_signals "${FARGATE_DRIVER}" "$@")
+    code=$?
+    if [ ${code} -ne 0 ]; then
+        echo "${output}"
+        return ${code}
+    fi
+    echo "${output:-"{}"}" | jq -c '. + {builds_dir_is_shared: true}'
+}
+
+###############################################################################
+# Print a presigned URL of the git bundle of the project of the job, when the
+# project has a bundle that is recent and small enough.
+#
+# Globals:
+#   - CUSTOM_ENV_CI_PROJECT_PATH
+#   - GIT_BUNDLE_REPOSITORIES, GIT_BUNDLE_MAX_AGE, GIT_BUNDLE_MAX_SIZE
+#   - CACHE_BUCKET, CACHE_BUCKET_REGION
+###############################################################################
+get_git_bundle_url() {
+    local key="git-bundles/${CUSTOM_ENV_CI_PROJECT_PATH}.bundle"
+    local head modified_at
+
+    [ -n "${GIT_BUNDLE_REPOSITORIES}" ] || return 1
+    [[ ",${GIT_BUNDLE_REPOSITORIES}," == *",${CUSTOM_ENV_CI_PROJECT_PATH},"* ]] || return 1
+
+    head=$(aws s3api head-object --region "${CACHE_BUCKET_REGION}" \
+        --bucket "${CACHE_BUCKET}" --key "${key}" 2>/dev/null) || return 1
+    modified_at=$(date -d "$(echo "${head}" | jq -r '.LastModified')" +%s)
+    [ $(($(date +%s) - modified_at)) -le $((GIT_BUNDLE_MAX_AGE * 3600)) ] || return 1
+    [ "$(echo "${head}" | jq -r '.ContentLength')" -le $((GIT_BUNDLE_MAX_SIZE * 1048576)) ] || return 1
+
+    aws s3 presign --region "${CACHE_BUCKET_REGION}" --expires-in 900 "s3://${CACHE_BUCKET}/${key}"
+}
+
+###############################################################################
+# Write a copy of the get_sources script of the job that first seeds a new
+# working copy from the git bundle of the project, and print its path. The
+# bundle refs are fetched as the remote refs of origin, which the fetch of
+# the runner then uses as a base.
+#
+# Arguments:
+#   $1 - Path of the get_sources script
+###############################################################################
+seed_job_sources() {
+    local url script dir
+    dir=$(printf '%q' "${CUSTOM_ENV_CI_PROJECT_DIR}")
+
+    # The clone strategy removes the working copy, none does not use it
+    [ "${CUSTOM_ENV_GIT_STRATEGY:-fetch}" == "fetch" ] || return 1
+    url=$(get_git_bundle_url) || return 1
+
+    script=$(mktemp)
+    cat > "${script}" <<EOS
+#!/usr/bin/env bash
+if [ ! -d ${dir}/.git ]; then
+    echo "Seeding the working copy from the git bundle of ${CUSTOM_ENV_CI_PROJECT_PATH}"
+    mkdir -p ${dir} \\
+        && curl -sfL -o /tmp/sources.bundle $(printf '%q' "${url}") \\
+        && git init -q ${dir} \\
+        && git -C ${dir} fetch -q /tmp/sources.bundle '+refs/heads/*:refs/remotes/origin/*' '+refs/tags/*:refs/tags/*' \\
+        || rm -rf ${dir}/.git
+    rm -f /tmp/sources.bundle
+fi
+EOS
+    cat "$1" >> "${script}"
+    echo "${script}"
+}
+
+###############################################################################
+# Claim an idle task of the warm pool. The task state is moved to the job
+# directory, which makes the run and cleanup stages bypass the driver.
+#
+# Arguments:
+#   $1 - Task definition requested by the job
+###############################################################################
+claim_warm_task() {
+    local entry
+
+    [ "${WARM_POOL_SIZE:-0}" -gt 0 ] || return 1
+    mkdir -p "$(dirname "${JOB_DIR}")"
+    rm -rf "${JOB_DIR}"
+
+    for entry in "${RUNNER_STATE_DIR}/warm-pool/$1"/*/; do
+        [ -f "${entry}task.json" ] || continue
+        # Renaming is atomic, only one job can win an entry
+        mv "${entry}" "${JOB_DIR}" 2>/dev/null || continue
+        if wait_ci_task_ssh "$(jq -r '.ip' "${JOB_DIR}/task.json")" "${JOB_DIR}/id" 10; then
+            # The orphan sweep of the warm pools leaves the claimed tasks to their job
+            tag_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" claimed \
+                || echo "WARNING: Failed to tag the warm task as claimed" >&2
+            echo "Using warm Fargate task $(jq -r '.task_arn' "${JOB_DIR}/task.json")"
+            return 0
+        fi
+        stop_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" "Warm task unreachable"
+        rm -rf "${JOB_DIR}"
+    done
+    return 1
+}
+
+###############################################################################
+# Print the directory of the idle tasks of the pipeline of the job and of a
+# task definition.
+#
+# Arguments:
+#   $1 - Task definition
+###############################################################################
+task_reuse_dir() {
+    echo "${TASK_REUSE_DIR}/${CUSTOM_ENV_CI_PROJECT_ID}-${CUSTOM_ENV_CI_PIPELINE_ID}/$1"
+}
+
+###############################################################################
+# Claim an idle task left by a previous job of the pipeline, like a task of the
+# warm pool.
+#
+# Arguments:
+#   $1 - Task definition requested by the job
+###############################################################################
+claim_sticky_task() {
+    local entry jobs
+
+    [ "${TASK_REUSE_IDLE_TIMEOUT}" -gt 0 ] || return 1
+    mkdir -p "$(dirname "${JOB_DIR}")"
+    rm -rf "${JOB_DIR}"
+
+    for entry in "$(task_reuse_dir "$1")"/*/; do
+        [ -f "${entry}task.json" ] || continue
+        # Renaming is atomic, only one job can win an entry
+        mv "${entry}" "${JOB_DIR}" 2>/dev/null || continue
+        if wait_ci_task_ssh "$(jq -r '.ip' "${JOB_DIR}/task.json")" "${JOB_DIR}/id" 10; then
+            tag_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" claimed \
+                || echo "WARNING: Failed to tag the idle task as claimed" >&2
+            jobs=$(($(jq -r '.jobs // 1' "${JOB_DIR}/task.json") + 1))
+            jq --argjson jobs "${jobs}" '.jobs = $jobs | del(.idle_since)' "${JOB_DIR}/task.json" \
+                > "${JOB_DIR}/task.json.tmp" && mv "${JOB_DIR}/task.json.tmp" "${JOB_DIR}/task.json"
+            echo "Reusing Fargate task $(jq -r '.task_arn' "${JOB_DIR}/task.json") (job ${jobs} of ${TASK_REUSE_MAX_JOBS})"
+            emit_metrics \
+                "$(jq -nc --arg image "${RUNNER_IMAGE:-unknown}" --arg task_definition "$1" \
+                    '{Image: $image, TaskDefinition: $task_definition}')" \
+                '[["Image"]]' \
+                '{"ReusedTasks": {"value": 1, "unit": "Count"}}'
+            return 0
+        fi
+        stop_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" "Idle task unreachable"
+        rm -rf "${JOB_DIR}"
+    done
+    return 1
+}
+
+###############################################################################
+# Keep the task of the job idle for the next job of the pipeline, fails when
+# the task must be stopped instead.
+#
+# Globals:
+#   - TASK_REUSE_IDLE_TIMEOUT, TASK_REUSE_MAX_JOBS, TASK_REUSE_WORKSPACE
+#   - CUSTOM_ENV_CI_PROJECT_DIR
+###############################################################################
+release_sticky_task() {
+    local task_definition directory jobs
+
+    [ "${TASK_REUSE_IDLE_TIMEOUT}" -gt 0 ] || return 1
+    [ -f "${RUNNER_STATE_DIR}/draining" ] && return 1
+    if [ -f "${JOB_DIR}/failed" ]; then
+        echo "Stopping the Fargate task, a stage of the job failed"
+        return 1
+    fi
+    jobs=$(jq -r '.jobs // 1' "${JOB_DIR}/task.json")
+    [ "${jobs}" -lt "${TASK_REUSE_MAX_JOBS}" ] || return 1
+
+    # The runner keeps its temporary files next to the project directory
+    if [ "${TASK_REUSE_WORKSPACE}" == "clean" ] && [ -n "${CUSTOM_ENV_CI_PROJECT_DIR}" ]; then
+        ssh_ci_task "$(jq -r '.ip' "${JOB_DIR}/task.json")" "${JOB_DIR}/id" \
+            rm -rf "${CUSTOM_ENV_CI_PROJECT_DIR}" "${CUSTOM_ENV_CI_PROJECT_DIR}.tmp" </dev/null || return 1
+    fi
+
+    # Only the idle tasks are stopped by the orphan sweep of task-reuse.sh
+    tag_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" idle || return 1
+
+    task_definition=$(jq -r '.task_definition' "${JOB_DIR}/task.json")
+    directory=$(task_reuse_dir "${task_definition}")
+    mkdir -p "${directory}"
+    jq --argjson idle_since "$(date +%s)" '.idle_since = $idle_since' "${JOB_DIR}/task.json" \
+        > "${JOB_DIR}/task.json.tmp" && mv "${JOB_DIR}/task.json.tmp" "${JOB_DIR}/task.json"
+    rm -f "${JOB_DIR}/run-task.err"
+    mv "${JOB_DIR}" "${directory}/${CUSTOM_ENV_CI_JOB_ID}" || return 1
+    echo "Keeping the Fargate task for the next job of pipeline ${CUSTOM_ENV_CI_PIPELINE_ID} (${TASK_REUSE_IDLE_TIMEOUT}s)"
+}
+
+###############################################################################
+# Start the task of the job in one of the subnets of FARGATE_SUBNETS. The task
+# state is written to the job directory, like a task of the warm pool.
+#
+# Arguments:
+#   $1 - Task definition requested by the job
+###############################################################################
+place_job_task() {
+    mkdir -p "$(dirname "${JOB_DIR}")"
+    rm -rf "${JOB_DIR}"
+
+    echo "Starting a Fargate task of $1"
+    if start_ci_task "$1" "${JOB_DIR}" "${PLACEMENT_STARTED_BY}" "${CUSTOM_ENV_CI_JOB_ID}"; then
+        jq -r '"Using Fargate task \(.task_arn) in \(.availability_zone) (\(.capacity_provider))"' "${JOB_DIR}/task.json"
+        return 0
+    fi
+    echo "ERROR: Failed to start a Fargate task of $1" >&2
+    rm -rf "${JOB_DIR}"
+    return "${SYSTEM_FAILURE_EXIT_CODE:-1}"
+}
+
+###############################################################################
+# Run a command in background, forwarding SIGTERM and SIGINT to it. The runner
+# sends them when a job is canceled or times out. Stdin is passed to the
+# command.
+#
+# Arguments:
+#   $@ - Command to run
+###############################################################################
+forward_signals() {
+    local pid code
+
+    "$@" <&0 &
+    pid=$!
+    trap 'kill -TERM ${pid} 2>/dev/null' TERM INT
+    wait ${pid}
+    code=$?
+    # A trapped signal interrupts wait, wait again for the exit code of the command
+    while [ ${code} -gt 128 ] && kill -0 ${pid} 2>/dev/null; do
+        wait ${pid}
+        code=$?
+    done
+    if [ ${code} -gt 128 ]; then
+        wait ${pid} 2>/dev/null
+        code=$?
+    fi
+    trap - TERM INT
+    return ${code}
+}
+
+###############################################################################
+# Print the ARN of the task of the job, when known: from the job directory for
+# warm tasks, otherwise from the task metadata of the driver.
+###############################################################################
+get_job_task_arn() {
+    local metadata=${DRIVER_METADATA_DIR:-/tmp}/${CUSTOM_ENV_CI_JOB_ID}.json
+
+    if [ -f "${JOB_DIR}/task.json" ]; then
+        jq -r '.task_arn' "${JOB_DIR}/task.json"
+    elif [ -f "${metadata}" ]; then
+        jq -r '.TaskARN // .TaskArn // empty' "${metadata}" 2>/dev/null
+    fi
+}
+
+###############################################################################
+# Write the duration and exit code of the stage as EMF metrics.
+#
+# Arguments:
+#   $1 - Exit code of the stage
+#
+# Globals:
+#   - stage, stage_args, stage_started_at, task_arn
+###############################################################################
+emit_stage_metrics() {
+    local duration=$(($(date +%s%3N) - stage_started_at))
+    local step=${stage}
+
+    # The run stage is called once per step of the job (get_sources, step_script, ...)
+    [ "${stage}" == "run" ] && step=${stage_args[1]:-run}
+
+    emit_metrics \
+        "$(jq -cn \
+            --arg stage "${stage}" \
+            --arg step "${step}" \
+            --arg image "${RUNNER_IMAGE:-unknown}" \
+            --arg task_arn "${task_arn:-$(get_job_task_arn)}" \
+            --arg task_definition "${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}" \
+            --arg job_id "${CUSTOM_ENV_CI_JOB_ID}" \
+            --arg project_id "${CUSTOM_ENV_CI_PROJECT_ID}" \
+            --arg pipeline_id "${CUSTOM_ENV_CI_PIPELINE_ID}" \
+            --argjson exit_code "$1" \
+            '{Stage: $stage, Step: $step, Image: $image, TaskArn: $task_arn,
+              TaskDefinition: $task_definition, JobId: $job_id, ProjectId: $project_id,
+              PipelineId: $pipeline_id, ExitCode: $exit_code}')" \
+        '[["Stage", "Image"], ["Step", "Image"], ["Stage"]]' \
+        "$(jq -cn --argjson duration "${duration}" --argjson exit_code "$1" \
+            '{StageDuration: {value: $duration, unit: "Milliseconds"},
+              StageFailed: {value: (if $exit_code == 0 then 0 else 1 end), unit: "Count"}}')"
+}
+
+###############################################################################
+# Write the time from the start of the runner container to the prepare stage
+# of its first job as an EMF metric, once per runner task.
+###############################################################################
+emit_first_job_metrics() {
+    local started_at
+
+    [ -f "${RUNNER_STATE_DIR}/bootstrap_started_at" ] || return 0
+    # Creating a directory is atomic, only the first job gets it
+    mkdir "${RUNNER_STATE_DIR}/first-job" 2>/dev/null || return 0
+    started_at=$(<"${RUNNER_STATE_DIR}/bootstrap_started_at")
+
+    emit_metrics \
+        "$(jq -cn --arg image "${RUNNER_IMAGE:-unknown}" --arg job_id "${CUSTOM_ENV_CI_JOB_ID}" \
+            '{Image: $image, JobId: $job_id}')" \
+        '[["Image"]]' \
+        "{\"TimeToFirstJob\": {\"value\": $((stage_started_at - started_at)), \"unit\": \"Milliseconds\"}}"
+}
+
+###############################################################################
+# Copy the output of the stage to a file, to count the caches restored by the
+# restore_cache step. Stdout and stderr both go to the runner on stdout.
+#
+# The messages counted are printed by the script of the step, which is written
+# by the runner: the output is not captured when the script restores no cache,
+# nor when it does not print these messages (another runner version).
+#
+# Arguments:
+#   $1 - Script of the restore_cache step
+#
+# Globals:
+#   - cache_log, cache_tee_pid
+###############################################################################
+capture_cache_output() {
+    grep -q "cache-extractor" "$1" || return 0
+    if ! grep -q "${CACHE_HIT_MESSAGE}" "$1" || ! grep -q "${CACHE_MISS_MESSAGE}" "$1"; then
+        echo "WARNING: Unknown cache messages in the restore_cache script, the cache metrics are not written" >&2
+        return 0
+    fi
+    cache_log=$(mktemp)
+    exec 3>&1 4>&2
+    exec > >(tee "${cache_log}" >&3) 2>&1
+    cache_tee_pid=$!
+}
+
+###############################################################################
+# Write the caches found (hits) and not found (misses) by the restore_cache
+# step as EMF metrics.
+#
+# Globals:
+#   - cache_log, cache_tee_pid
+###############################################################################
+emit_cache_metrics() {
+    local hits misses
+
+    # Closing the pipe lets tee write the end of the output and exit
+    exec 1>&3 2>&4 3>&- 4>&-
+    wait ${cache_tee_pid} 2>/dev/null
+    hits=$(grep -c "${CACHE_HIT_MESSAGE}" "${cache_log}")
+    misses=$(grep -c "${CACHE_MISS_MESSAGE}" "${cache_log}")
+    rm -f "${cache_log}"
+    [ $((hits + misses)) -gt 0 ] || return 0
+
+    emit_metrics \
+        "$(jq -cn \
+            --arg image "${RUNNER_IMAGE:-unknown}" \
+            --arg job_id "${CUSTOM_ENV_CI_JOB_ID}" \
+            --arg project_id "${CUSTOM_ENV_CI_PROJECT_ID}" \
+            '{Image: $image, JobId: $job_id, ProjectId: $project_id}')" \
+        '[["Image"]]' \
+        "$(jq -cn --argjson hits "${hits}" --argjson misses "${misses}" \
+            '{CacheHits: {value: $hits, unit: "Count"}, CacheMisses: {value: $misses, unit: "Count"}}')"
+}
+
+###############################################################################
+# Record the job and the ARN of its task once prepared, forget it on cleanup.
+#
+# Arguments:
+#   $1 - Exit code of the stage
+###############################################################################
+track_job() {
+    local record=${RUNNER_STATE_DIR}/active-jobs/${CUSTOM_ENV_CI_JOB_ID}.json
+
+    case "${stage}" in
+        prepare)
+            [ "$1" -eq 0 ] || return 0
+            mkdir -p "$(dirname "${record}")"
+            jq -n \
+                --arg job_id "${CUSTOM_ENV_CI_JOB_ID}" \
+                --arg project_id "${CUSTOM_ENV_CI_PROJECT_ID}" \
+                --arg pipeline_id "${CUSTOM_ENV_CI_PIPELINE_ID}" \
+                --arg job_url "${CUSTOM_ENV_CI_JOB_URL}" \
+                --arg image "${RUNNER_IMAGE:-unknown}" \
+                --arg task_arn "$(get_job_task_arn)" \
+                '{job_id: $job_id, project_id: $project_id, pipeline_id: $pipeline_id,
+                  job_url: $job_url, image: $image, task_arn: $task_arn}' > "${record}"
+            ;;
+        cleanup)
+            rm -f "${record}"
+            ;;
+    esac
+}
+
+###############################################################################
+# Exit with the system failure code when the runner drains, the job was
+# interrupted and can be retried (retry:when:runner_system_failure).
+###############################################################################
+fail_interrupted_job() {
+    if [ -f "${RUNNER_STATE_DIR}/draining" ]; then
+        echo "ERROR: Job interrupted, the runner is shutting down" >&2
+        exit "${SYSTEM_FAILURE_EXIT_CODE:-1}"
+    fi
+}
+
+###############################################################################
+# Write the metrics of the stage, called on exit.
+#
+# Arguments:
+#   $1 - Exit code of the stage
+###############################################################################
+finish_stage() {
+    [ -n "${cache_log}" ] && emit_cache_metrics
+    [ -n "${seeded_script}" ] && rm -f "${seeded_script}"
+    track_job "$1"
+    emit_stage_metrics "$1"
+}
+
+###############################################################################
+# Run a script of the job in its task and exit with the custom executor codes.
+#
+# ssh exits with 255 on its own errors (connection, authentication) and with
+# the exit code of the script otherwise. The remote shell turns the 255 of the
+# script into 1, so that only an SSH error is a system failure.
+#
+# Arguments:
+#   $1 - Path of the script
+###############################################################################
+run_job_script() {
+    local code
+
+    forward_signals ssh_ci_task "$(jq -r '.ip' "${JOB_DIR}/task.json")" "${JOB_DIR}/id" \
+        '/bin/bash; code=$?; exit $((code == 255 ? 1 : code))' < "$1"
+    code=$?
+    # A task whose job failed is never reused
+    [ ${code} -ne 0 ] && touch "${JOB_DIR}/failed"
+    case ${code} in
+        0) exit 0 ;;
+        255) exit "${SYSTEM_FAILURE_EXIT_CODE:-1}" ;;
+        *)
+            fail_interrupted_job
+            exit "${BUILD_FAILURE_EXIT_CODE:-1}"
+            ;;
+    esac
+}
+
+###############################################################################
+# Stop the task of the job, unless it is kept for the next job of the pipeline.
+###############################################################################
+cleanup_job_task() {
+    release_sticky_task && return 0
+    stop_ci_task "$(jq -r '.task_arn' "${JOB_DIR}/task.json")" "Job ${CUSTOM_ENV_CI_JOB_ID} finished"
+    rm -rf "${JOB_DIR}"
+}
+
+# The stage follows "custom" in the arguments, the stage arguments follow it
+args=("$@")
+for i in "${!args[@]}"; do
+    [ "${args[$i]}" == "--config" ] && driver_config=${args[$((i + 1))]}
+    [ "${args[$i]}" == "custom" ] && break
+done
+stage=${args[$((i + 1))]}
+stage_args=("${args[@]:$((i + 2))}")
+
+if [ -f "${driver_config%.toml}.env" ]; then
+    source "${driver_config%.toml}.env"
+fi
+
+stage_started_at=$(date +%s%3N)
+# The task of the job is gone after cleanup, read it beforehand
+[ "${stage}" != "prepare" ] && task_arn=$(get_job_task_arn)
+trap 'finish_stage $?' EXIT
+
+if [ "${stage}" == "run" ] && [ "${stage_args[1]}" == "restore_cache" ]; then
+    capture_cache_output "${stage_args[0]}"
+fi
+
+case "${stage}" in
+    config)
+        if [ "${EFS_WORKSPACE}" == "true" ]; then
+            config_shared_workspace "$@"
+            exit $?
+        fi
+        ;;
+    prepare)
+        emit_first_job_metrics
+        select_task_size
+        select_sidecars
+        select_project_workspace
+        claim_sticky_task "${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}" && exit 0
+        claim_warm_task "${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}" && exit 0
+        if [ -n "${FARGATE_SUBNETS}" ] || [ "${TASK_REUSE_IDLE_TIMEOUT}" -gt 0 ]; then
+            place_job_task "${CUSTOM_ENV_FARGATE_TASK_DEFINITION:-${FARGATE_TASK_DEFINITION}}"
+            exit $?
+        fi
+        ;;
+    run)
+        if [ "${stage_args[1]}" == "get_sources" ] && seeded_script=$(seed_job_sources "${stage_args[0]}"); then
+            stage_args[0]=${seeded_script}
+            set -- "${args[@]:0:$((i + 2))}" "${stage_args[@]}"
+        fi
+        [ -f "${JOB_DIR}/task.json" ] && run_job_script "${stage_args[0]}"
+        ;;
+    cleanup)
+        if [ -f "${JOB_DIR}/task.json" ]; then
+            cleanup_job_task
+            exit 0
+        fi
+        ;;
+esac
+
+forward_signals "${FARGATE_DRIVER}" "$@"
+code=$?
+[ "${stage}" == "run" ] && [ ${code} -ne 0 ] && fail_interrupted_job
+exit ${code}
@@ -0,0 +1,397 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Functions to run CI tasks directly, without the Fargate driver. This file is
+# sourced by fargate-driver.sh and warm-pool.sh, with metrics.sh, and depends
+# on the environment variables of the runner container:
+# - FARGATE_CLUSTER, FARGATE_REGION, FARGATE_SUBNET, FARGATE_SECURITY_GROUP
+# - TASK_ARN: ARN of the runner task, set by docker-entrypoint.sh
+# - RUNNER_STATE_DIR (optional): directory holding the tasks state
+#
+# Placement of the CI tasks, see start_ci_task:
+# - FARGATE_SUBNETS (optional): comma separated subnets the CI tasks are spread
+#   over, one per availability zone (defaults to FARGATE_SUBNET)
+# - FARGATE_SUBNET_MAP (optional): JSON object of the subnet of each AZ
+# - FARGATE_PLACEMENT (optional): spread or least_loaded (defaults to spread)
+# - FARGATE_CAPACITY_PROVIDERS (optional): comma separated capacity providers
+#   tried in order (defaults to the strategy of the cluster)
+# - PLACEMENT_BACKOFF (optional): seconds a subnet without capacity is tried
+#   last (defaults to 300)
+#
+# Readiness of the CI tasks started by these scripts (warm pool, placement and
+# task reuse), the Fargate driver keeps its own wait, see wait_ci_task_ssh:
+# - SSH_POLL_INTERVAL (optional): seconds between two probes of sshd (defaults
+#   to 0.2)
+#
+# Reuse of the CI tasks by the next job of the same pipeline, see
+# fargate-driver.sh and task-reuse.sh:
+# - TASK_REUSE_IDLE_TIMEOUT (optional): seconds an idle task waits for the next
+#   job, 0 disables the reuse (defaults to 0)
+# - TASK_REUSE_MAX_JOBS (optional): jobs run by a task before it is stopped
+#   (defaults to 5)
+# - TASK_REUSE_WORKSPACE (optional): keep or clean, whether the project
+#   directory of the job is removed before the task is reused (defaults to keep)
+# -----------------------------------------------------------------------------
+
+RUNNER_STATE_DIR=${RUNNER_STATE_DIR:-/var/lib/fargate-runner}
+SSH_USERNAME=${SSH_USERNAME:-root}
+SSH_PORT=${SSH_PORT:-22}
+CI_TASK_START_TIMEOUT=${CI_TASK_START_TIMEOUT:-300}
+SSH_POLL_INTERVAL=${SSH_POLL_INTERVAL:-0.2}
+CI_CONTAINER_NAME=${CI_CONTAINER_NAME:-ci-coordinator}
+FARGATE_PLACEMENT=${FARGATE_PLACEMENT:-spread}
+PLACEMENT_BACKOFF=${PLACEMENT_BACKOFF:-300}
+PLACEMENT_DIR=${RUNNER_STATE_DIR}/placement
+TASK_REUSE_IDLE_TIMEOUT=${TASK_REUSE_IDLE_TIMEOUT:-0}
+TASK_REUSE_MAX_JOBS=${TASK_REUSE_MAX_JOBS:-5}
+TASK_REUSE_WORKSPACE=${TASK_REUSE_WORKSPACE:-keep}
+TASK_REUSE_DIR=${RUNNER_STATE_DIR}/task-reuse
+
+###############################################################################
+# Start a CI task and print its ARN. The reason of a failure is written to
+# stderr, the function returns 2 when Fargate has no capacity for the task.
+#
+# Arguments:
+#   $1 - Task definition (family or family:revision)
+#   $2 - Public key authorized in the CI container
+#   $3 - Value of the startedBy field of the task
+#   $4 - Subnet of the task (optional, default FARGATE_SUBNET)
+#   $5 - Capacity provider (optional, default the strategy of the cluster)
+###############################################################################
+run_ci_task() {
+    local overrides response reason capacity_provider_strategy=()
+    overrides=$(jq -cn --arg name "${CI_CONTAINER_NAME}" --arg key "$2" \
+        '{containerOverrides: [{name: $name, environment: [{name: "SSH_PUBLIC_KEY", value: $key}]}]}')
+    [ -n "$5" ] && capacity_provider_strategy=(--capacity-provider-strategy "capacityProvider=$5,weight=1")
+
+    response=$(aws ecs run-task \
+        --region "${FARGATE_REGION}" \
+        --cluster "${FARGATE_CLUSTER}" \
+        --task-definition "$1" \
+        --started-by "$3" \
+        "${capacity_provider_strategy[@]}" \
+        --network-configuration "awsvpcConfiguration={subnets=[${4:-${FARGATE_SUBNET}}],securityGroups=[${FARGATE_SECURITY_GROUP}],assignPublicIp=DISABLED}" \
+        --overrides "${overrides}" \
+        --tags "key=gitlab-runner:coordinator,value=${TASK_ARN}") || return 1
+
+    reason=$(echo "${response}" | jq -r '.failures[0].reason // empty')
+    if [ -n "${reason}" ]; then
+        echo "${reason}" >&2
+        [[ "${reason}" == *"Capacity is unavailable"* || "${reason}" == RESOURCE:* ]] && return 2
+        return 1
+    fi
+    echo "${response}" | jq -r '.tasks[0].taskArn // empty'
+}
+
+###############################################################################
+# Print the subnets to try for a new task, one per line, in placement order:
+# - spread: rotation of FARGATE_SUBNETS starting at a different subnet for
+#   each task
+# - least_loaded: the subnets running the fewest tasks of this runner first
+# The subnets that had no capacity in the last PLACEMENT_BACKOFF seconds come
+# last.
+#
+# Arguments:
+#   $1 - Seed of the rotation (ex: the job id)
+###############################################################################
+placement_subnets() {
+    local subnets subnet count index offset backoff
+    IFS=',' read -r -a subnets <<< "${FARGATE_SUBNETS:-${FARGATE_SUBNET}}"
+    offset=$(( ${1:-${RANDOM}} % ${#subnets[@]} ))
+
+    for index in "${!subnets[@]}"; do
+        subnet=${subnets[$(( (offset + index) % ${#subnets[@]} ))]}
+        count=0
+        if [ "${FARGATE_PLACEMENT}" == "least_loaded" ]; then
+            count=$(cat "${RUNNER_STATE_DIR}"/jobs/*/task.json "${RUNNER_STATE_DIR}"/warm-pool/*/*/task.json 2>/dev/null \
+                | jq -r '.subnet // empty' | grep -cx "${subnet}")
+        fi
+        backoff=0
+        [ -n "$(find "${PLACEMENT_DIR}/${subnet}" -newermt "-${PLACEMENT_BACKOFF} seconds" 2>/dev/null)" ] && backoff=1
+        printf '%d\t%d\t%d\t%s\n' "${backoff}" "${count}" "${index}" "${subnet}"
+    done | sort -n -k1,1 -k2,2 -k3,3 | cut -f4
+}
+
+###############################################################################
+# Print the availability zone of a subnet, from FARGATE_SUBNET_MAP.
+#
+# Arguments:
+#   $1 - Subnet
+###############################################################################
+subnet_zone() {
+    echo "${FARGATE_SUBNET_MAP:-"{}"}" \
+        | jq -r --arg subnet "$1" 'to_entries | map(select(.value == $subnet).key) | first // "unknown"'
+}
+
+###############################################################################
+# Record a placement without capacity: the subnet is tried last for
+# PLACEMENT_BACKOFF seconds and a PlacementFailures EMF metric is written.
+#
+# Arguments:
+#   $1 - Task definition
+#   $2 - Subnet
+#   $3 - Capacity provider, empty for the strategy of the cluster
+#   $4 - Reason of the failure
+###############################################################################
+record_placement_failure() {
+    mkdir -p "${PLACEMENT_DIR}"
+    touch "${PLACEMENT_DIR}/$2"
+
+    emit_metrics \
+        "$(jq -cn \
+            --arg image "${RUNNER_IMAGE:-${1%%:*}}" \
+            --arg task_definition "$1" \
+            --arg zone "$(subnet_zone "$2")" \
+            --arg subnet "$2" \
+            --arg capacity_provider "${3:-default}" \
+            --arg reason "$4" \
+            --arg job_id "${CUSTOM_ENV_CI_JOB_ID}" \
+            '{Image: $image, TaskDefinition: $task_definition, AvailabilityZone: $zone,
+              Subnet: $subnet, CapacityProvider: $capacity_provider, Reason: $reason, JobId: $job_id}')" \
+        '[["Image"], ["AvailabilityZone"], ["CapacityProvider"]]' \
+        '{"PlacementFailures": {"value": 1, "unit": "Count"}}'
+}
+
+###############################################################################
+# Wait for a CI task to be running and print its private IP. The task is
+# ready as soon as its sshd answers, usually before ECS reports it RUNNING.
+#
+# Arguments:
+#   $1 - Task ARN
+###############################################################################
+wait_ci_task() {
+    local deadline=$((SECONDS + CI_TASK_START_TIMEOUT))
+    local task ip
+
+    while [ ${SECONDS} -lt ${deadline} ]; do
+        task=$(aws ecs describe-tasks --region "${FARGATE_REGION}" \
+            --cluster "${FARGATE_CLUSTER}" --tasks "$1" | jq -c '.tasks[0]')
+        ip=$(echo "${task}" | jq -r '.attachments[]?.details[]? | select(.name=="privateIPv4Address").value')
+        case $(echo "${task}" | jq -r '.lastStatus') in
+            RUNNING)
+                echo "${ip}"
+                return 0
+                ;;
+            DEACTIVATING|STOPPING|DEPROVISIONING|STOPPED|null)
+                return 1
+                ;;
+        esac
+        # Probe sshd until the next status check once the ENI has its address
+        if [ -n "${ip}" ] && wait_ci_task_sshd "${ip}" 2; then
+            echo "${ip}"
+            return 0
+        fi
+        [ -z "${ip}" ] && sleep 2
+    done
+    return 1
+}
+
+###############################################################################
+# Wait for the sshd of a CI task to send its banner. The startup script of the
+# CI images starts sshd last, once the authorized key is written, so the
+# banner is the readiness signal of the task.
+#
+# Arguments:
+#   $1 - Private IP of the task
+#   $2 - Timeout in seconds
+###############################################################################
+wait_ci_task_sshd() {
+    local deadline=$((SECONDS + $2))
+
+    until timeout 1 bash -c "exec 3<>/dev/tcp/$1/${SSH_PORT} && head -c 4 <&3" 2>/dev/null | grep -q SSH-; do
+        [ ${SECONDS} -ge ${deadline} ] && return 1
+        sleep "${SSH_POLL_INTERVAL}"
+    done
+}
+
+###############################################################################
+# Run a command in a CI task over SSH, stdin is forwarded to the command.
+#
+# Arguments:
+#   $1 - Private IP of the task
+#   $2 - Private key authorized in the task
+#   $@ - Command to run
+###############################################################################
+ssh_ci_task() {
+    local ip=$1 key=$2
+    shift 2
+    ssh -i "${key}" -p "${SSH_PORT}" \
+        -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null \
+        -o LogLevel=ERROR -o ConnectTimeout=5 -o BatchMode=yes \
+        "${SSH_USERNAME}@${ip}" "$@"
+}
+
+###############################################################################
+# Wait for sshd of a CI task to accept our key.
+#
+# Arguments:
+#   $1 - Private IP of the task
+#   $2 - Private key authorized in the task
+#   $3 - Timeout in seconds (optional, default CI_TASK_START_TIMEOUT)
+###############################################################################
+wait_ci_task_ssh() {
+    local timeout=${3:-${CI_TASK_START_TIMEOUT}}
+    local deadline=$((SECONDS + timeout))
+
+    # The banner is cheaper than a login, a single login checks the key
+    wait_ci_task_sshd "$1" "${timeout}" || return 1
+    until ssh_ci_task "$1" "$2" true </dev/null; do
+        [ ${SECONDS} -ge ${deadline} ] && return 1
+        sleep "${SSH_POLL_INTERVAL}"
+    done
+}
+
+###############################################################################
+# Start a CI task and wait for it to accept SSH connections. The task details
+# are written to <directory>/task.json and its private key to <directory>/id.
+#
+# Each capacity provider of FARGATE_CAPACITY_PROVIDERS is tried in order, in
+# each subnet of placement_subnets, until Fargate has capacity for the task.
+# Other failures of RunTask are not retried.
+#
+# Arguments:
+#   $1 - Task definition
+#   $2 - Directory of the task state
+#   $3 - Value of the startedBy field of the task
+#   $4 - Seed of the placement (optional)
+###############################################################################
+start_ci_task() {
+    local task_definition=$1 directory=$2 task_arn ip subnet capacity_provider code
+    local capacity_providers subnets
+
+    mkdir -p "${directory}"
+    ssh-keygen -q -t ed25519 -N '' -f "${directory}/id" || return 1
+
+    IFS=',' read -r -a capacity_providers <<< "${FARGATE_CAPACITY_PROVIDERS:-}"
+    [ ${#capacity_providers[@]} -eq 0 ] && capacity_providers=("")
+    subnets=$(placement_subnets "$4")
+
+    for capacity_provider in "${capacity_providers[@]}"; do
+        for subnet in ${subnets}; do
+            task_arn=$(run_ci_task "${task_definition}" "$(cat "${directory}/id.pub")" "$3" \
+                "${subnet}" "${capacity_provider}" 2> "${directory}/run-task.err")
+            code=$?
+            [ ${code} -eq 0 ] && [ -n "${task_arn}" ] && break 2
+            cat "${directory}/run-task.err" >&2
+            [ ${code} -eq 2 ] || return 1
+            echo "No Fargate capacity in $(subnet_zone "${subnet}") (${capacity_provider:-default}), trying the next placement" >&2
+            record_placement_failure "${task_definition}" "${subnet}" "${capacity_provider}" \
+                "$(<"${directory}/run-task.err")"
+        done
+    done
+    [ -z "${task_arn}" ] && return 1
+
+    if ! ip=$(wait_ci_task "${task_arn}") || ! wait_ci_task_ssh "${ip}" "${directory}/id"; then
+        stop_ci_task "${task_arn}" "CI task failed to start"
+        return 1
+    fi
+
+    jq -n --arg task_arn "${task_arn}" --arg ip "${ip}" \
+        --arg task_definition "${task_definition}" --argjson started_at "$(date +%s)" \
+        --arg subnet "${subnet}" --arg zone "$(subnet_zone "${subnet}")" \
+        --arg capacity_provider "${capacity_provider:-default}" \
+        '{task_arn: $task_arn, ip: $ip, task_definition: $task_definition, started_at: $started_at,
+          subnet: $subnet, availability_zone: $zone, capacity_provider: $capacity_provider}' \
+        > "${directory}/task.json"
+}
+
+###############################################################################
+# Stop a CI task.
+#
+# Arguments:
+#   $1 - Task ARN
+#   $2 - Reason
+###############################################################################
+stop_ci_task() {
+    aws ecs stop-task --region "${FARGATE_REGION}" --cluster "${FARGATE_CLUSTER}" \
+        --task "$1" --reason "$2" >/dev/null
+}
+
+###############################################################################
+# Tag the state of a CI task, read by stop_orphaned_ci_tasks.
+#
+# Arguments:
+#   $1 - Task ARN
+#   $2 - State of the task (ex: claimed)
+###############################################################################
+tag_ci_task() {
+    aws ecs tag-resource --region "${FARGATE_REGION}" --resource-arn "$1" \
+        --tags "key=gitlab-runner:state,value=$2" >/dev/null
+}
+
+###############################################################################
+# Stop the CI tasks left by runner tasks that are stopped. A draining runner
+# task still waits for the jobs of its CI tasks until it is stopped, and the
+# tasks claimed by a job (gitlab-runner:state=claimed) are left to the job.
+#
+# Arguments:
+#   $1 - Value of the startedBy field of the tasks
+#   $2 - Value of the gitlab-runner:state tag of the tasks to stop (optional,
+#        default every task not claimed)
+###############################################################################
+stop_orphaned_ci_tasks() {
+    local tasks candidates coordinators active task coordinator state
+
+    mapfile -t tasks < <(aws ecs list-tasks --region "${FARGATE_REGION}" --cluster "${FARGATE_CLUSTER}" \
+        --started-by "$1" | jq -r '.taskArns[]')
+    [ ${#tasks[@]} -eq 0 ] && return
+
+    candidates=$(describe_ci_tasks --include TAGS -- "${tasks[@]}" \
+        | jq -r --arg self "${TASK_ARN}" --arg state "$2" '.tasks[]
+            | [.taskArn,
+               ((.tags // []) | map(select(.key == "gitlab-runner:coordinator").value) | first // ""),
+               ((.tags // []) | map(select(.key == "gitlab-runner:state").value) | first // "")]
+            | select(.[1] != $self)
+            | select(if $state != "" then .[2] == $state else .[2] != "claimed" end)
+            | join("\u001f")')
+    [ -z "${candidates}" ] && return
+
+    # A runner task missing from the response is stopped, a draining one still
+    # waits for its jobs
+    mapfile -t coordinators < <(echo "${candidates}" | cut -d $'\x1f' -f 2 | grep -v '^$' | sort -u)
+    active=$(describe_ci_tasks -- "${coordinators[@]}") || return 1
+    active=$(echo "${active}" | jq -r '.tasks[] | select(.lastStatus != "STOPPED") | .taskArn')
+
+    while IFS=$'\x1f' read -r task coordinator state; do
+        [ -n "${coordinator}" ] && grep -qxF "${coordinator}" <<< "${active}" && continue
+        stop_ci_task "${task}" "Runner ${coordinator} is gone"
+    done <<< "${candidates}"
+}
+
+###############################################################################
+# Describe tasks of the cluster, 100 at a time as accepted by DescribeTasks.
+# Prints one DescribeTasks response per batch.
+#
+# Arguments:
+#   $@ - Options of describe-tasks, "--", then the task ARNs
+###############################################################################
+describe_ci_tasks() {
+    local options=() i
+
+    while [ $# -gt 0 ] && [ "$1" != "--" ]; do
+        options+=("$1")
+        shift
+    done
+    shift
+    for ((i = 1; i <= $#; i += 100)); do
+        aws ecs describe-tasks --region "${FARGATE_REGION}" --cluster "${FARGATE_CLUSTER}" \
+            "${options[@]}" --tasks "${@:i:100}" || return 1
+    done
+}
@@ -0,0 +1,57 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Functions writing CloudWatch Embedded Metric Format (EMF) records to the log
+# of the runner container. The records are shipped by the awslogs driver and
+# CloudWatch Logs extracts their metrics, no agent is needed.
+# https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+#
+# - METRICS_NAMESPACE (optional): CloudWatch namespace (defaults to GitlabRunner)
+# - METRICS_LOG (optional): file the records are appended to (defaults to
+#   /log/stdout.log, the stdout of the runner container)
+# -----------------------------------------------------------------------------
+
+METRICS_NAMESPACE=${METRICS_NAMESPACE:-GitlabRunner}
+METRICS_LOG=${METRICS_LOG:-/log/stdout.log}
+
+###############################################################################
+# Write an EMF record.
+#
+# Arguments:
+#   $1 - JSON object of the dimensions and properties of the record,
+#        ex: {"Stage": "prepare", "JobId": "42"}
+#   $2 - JSON list of the dimension sets, ex: [["Stage"]]
+#   $3 - JSON object of the metrics, ex: {"Duration": {"value": 12, "unit": "Milliseconds"}}
+###############################################################################
+emit_metrics() {
+    jq -cn \
+        --arg namespace "${METRICS_NAMESPACE}" \
+        --argjson timestamp "$(date +%s%3N)" \
+        --argjson properties "$1" \
+        --argjson dimensions "$2" \
+        --argjson metrics "$3" \
+        '{_aws: {Timestamp: $timestamp, CloudWatchMetrics: [{
+            Namespace: $namespace,
+            Dimensions: $dimensions,
+            Metrics: [$metrics | to_entries[] | {Name: .key, Unit: .value.unit}]
+          }]}}
+         + $properties
+         + ($metrics | map_values(.value))' >> "${METRICS_LOG}"
+}
@@ -0,0 +1,86 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Stop the CI tasks kept idle by fargate-driver.sh for the next job of their
+# pipeline, once no job claimed them for TASK_REUSE_IDLE_TIMEOUT seconds.
+#
+# The idle tasks live in ${TASK_REUSE_DIR}/<project>-<pipeline>/<task
+# definition>/, one directory per task. A job claims a task by moving its
+# directory away.
+#
+# Environment variables:
+# - TASK_REUSE_IDLE_TIMEOUT (required): seconds an idle task is kept
+# - TASK_REUSE_INTERVAL (optional): seconds between two checks (defaults to 5)
+# -----------------------------------------------------------------------------
+
+# Installed next to fargate-tasks.sh, in /usr/local/bin
+source "$(dirname "$0")/metrics.sh"
+source "$(dirname "$0")/fargate-tasks.sh"
+
+TASK_REUSE_INTERVAL=${TASK_REUSE_INTERVAL:-5}
+# startedBy of the tasks started by the prepare stage of fargate-driver.sh
+TASK_REUSE_STARTED_BY=gitlab-runner
+
+###############################################################################
+# Stop the idle tasks older than TASK_REUSE_IDLE_TIMEOUT, and forget the
+# pipelines without idle tasks.
+###############################################################################
+expire_sticky_tasks() {
+    local entry idle_since expired=${TASK_REUSE_DIR}/.expired
+
+    mkdir -p "${expired}"
+    for entry in "${TASK_REUSE_DIR}"/*/*/*/; do
+        [ -f "${entry}task.json" ] || continue
+        idle_since=$(jq -r '.idle_since // 0' "${entry}task.json")
+        if [ $(($(date +%s) - idle_since)) -ge ${TASK_REUSE_IDLE_TIMEOUT} ]; then
+            # Claim the entry before stopping it, a job may be faster than us
+            mv "${entry}" "${expired}/" 2>/dev/null || continue
+            entry=${expired}/$(basename "${entry}")
+            stop_ci_task "$(jq -r '.task_arn' "${entry}/task.json")" "Idle for ${TASK_REUSE_IDLE_TIMEOUT}s"
+            rm -rf "${entry}"
+        fi
+    done
+    find "${TASK_REUSE_DIR}" -mindepth 1 -maxdepth 2 -type d -empty -mmin +1 ! -name .expired -delete 2>/dev/null
+}
+
+###############################################################################
+# Stop all the idle tasks.
+###############################################################################
+drain_sticky_tasks() {
+    local task
+
+    for task in "${TASK_REUSE_DIR}"/*/*/*/task.json; do
+        [ -f "${task}" ] || continue
+        stop_ci_task "$(jq -r '.task_arn' "${task}")" "Runner stopped"
+        rm -rf "$(dirname "${task}")"
+    done
+}
+
+trap 'drain_sticky_tasks; exit 0' SIGTERM
+
+# Idle tasks of a runner task stopped without draining, the tasks running a
+# job are left to their runner task
+stop_orphaned_ci_tasks "${TASK_REUSE_STARTED_BY}" idle
+
+while true; do
+    expire_sticky_tasks
+    sleep "${TASK_REUSE_INTERVAL}" &
+    wait $!
+done
@@ -0,0 +1,125 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Keep a pool of idle CI tasks, ready to be claimed by the prepare stage of
+# fargate-driver.sh instead of starting a new task for each job.
+#
+# The pool of a task definition lives in ${RUNNER_STATE_DIR}/warm-pool/<task
+# definition>/, one directory per ready task. A job claims a task by moving
+# its directory away, the next iteration of the loop starts a replacement.
+#
+# Environment variables:
+# - WARM_POOL_SIZE (required): number of idle tasks per task definition
+# - WARM_POOL_TTL (optional): seconds before an idle task is replaced
+#   (defaults to 900)
+# - WARM_POOL_TASK_DEFINITIONS (optional): comma separated list of the task
+#   definitions to keep warm (defaults to the task definitions of RUNNER_IMAGES)
+# - WARM_POOL_INTERVAL (optional): seconds between two refills (defaults to 5)
+# -----------------------------------------------------------------------------
+
+source /usr/local/bin/metrics.sh
+source /usr/local/bin/fargate-tasks.sh
+
+WARM_POOL_TTL=${WARM_POOL_TTL:-900}
+WARM_POOL_INTERVAL=${WARM_POOL_INTERVAL:-5}
+WARM_POOL_DIR=${RUNNER_STATE_DIR}/warm-pool
+WARM_POOL_STARTED_BY=warm-pool
+
+###############################################################################
+# Stop the idle tasks older than WARM_POOL_TTL.
+#
+# Arguments:
+#   $1 - Pool directory of a task definition
+###############################################################################
+expire_warm_tasks() {
+    local entry started_at expired=${WARM_POOL_DIR}/.expired
+
+    mkdir -p "${expired}"
+    for entry in "$1"/*/; do
+        [ -f "${entry}task.json" ] || continue
+        started_at=$(jq -r '.started_at' "${entry}task.json")
+        if [ $(($(date +%s) - started_at)) -ge ${WARM_POOL_TTL} ]; then
+            # Claim the entry before stopping it, a job may be faster than us
+            mv "${entry}" "${expired}/" 2>/dev/null || continue
+            entry=${expired}/$(basename "${entry}")
+            stop_ci_task "$(jq -r '.task_arn' "${entry}/task.json")" "Warm pool TTL expired"
+            rm -rf "${entry}"
+        fi
+    done
+}
+
+###############################################################################
+# Start the tasks missing in the pool of a task definition, in background.
+#
+# Arguments:
+#   $1 - Task definition
+###############################################################################
+refill_warm_pool() {
+    local pool=${WARM_POOL_DIR}/$1
+    local starting=${WARM_POOL_DIR}/.starting/$1
+    local count entry
+
+    mkdir -p "${pool}" "${starting}"
+    expire_warm_tasks "${pool}"
+
+    count=$(find "${pool}" "${starting}" -mindepth 1 -maxdepth 1 -type d | wc -l)
+    while [ ${count} -lt ${WARM_POOL_SIZE} ]; do
+        entry=$(mktemp -d "${starting}/XXXXXX")
+        (
+            if start_ci_task "$1" "${entry}" "${WARM_POOL_STARTED_BY}"; then
+                mv "${entry}" "${pool}/"
+            else
+                echo "Failed to start a warm task of $1" >&2
+                rm -rf "${entry}"
+            fi
+        ) &
+        count=$((count + 1))
+    done
+}
+
+###############################################################################
+# Stop all the idle tasks of the pool.
+###############################################################################
+drain_warm_pool() {
+    local task
+
+    for task in "${WARM_POOL_DIR}"/*/*/task.json; do
+        [ -f "${task}" ] || continue
+        stop_ci_task "$(jq -r '.task_arn' "${task}")" "Runner stopped"
+        rm -rf "$(dirname "${task}")"
+    done
+}
+
+trap 'drain_warm_pool; exit 0' SIGTERM
+
+stop_orphaned_ci_tasks "${WARM_POOL_STARTED_BY}"
+
+if [ -z "${WARM_POOL_TASK_DEFINITIONS}" ]; then
+    WARM_POOL_TASK_DEFINITIONS=$(echo "${RUNNER_IMAGES}" | jq -r 'map(.task_definition // empty) | join(",")')
+fi
+IFS=',' read -r -a task_definitions <<< "${WARM_POOL_TASK_DEFINITIONS}"
+
+while true; do
+    for task_definition in "${task_definitions[@]}"; do
+        refill_warm_pool "${task_definition}"
+    done
+    sleep "${WARM_POOL_INTERVAL}" &
+    wait $!
+done
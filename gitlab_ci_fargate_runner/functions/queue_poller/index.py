@@ -0,0 +1,123 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import json
+import os
+import urllib.parse
+import urllib.request
+
+# Statuses of the jobs that the coordinators have to absorb
+JOB_STATUSES = ("pending", "running")
+
+
+def list_jobs(gitlab_url, token, project_id, status, per_page=100, timeout=10):
+    """Yield the jobs of a project with the given status, following pagination."""
+    project = urllib.parse.quote(str(project_id), safe="")
+    page = "1"
+    while page:
+        query = urllib.parse.urlencode(
+            {"scope[]": status, "per_page": per_page, "page": page}
+        )
+        request = urllib.request.Request(
+            f"{gitlab_url}/api/v4/projects/{project}/jobs?{query}",
+            headers={"PRIVATE-TOKEN": token},
+        )
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            jobs = json.loads(response.read())
+            page = response.headers.get("X-Next-Page", "")
+        yield from jobs
+
+
+def runner_can_pick(job, runner_tags):
+    """Mirror GitLab tag matching for runners registered with run_untagged.
+
+    ``runner_tags`` holds the tag list of each runner of the coordinator, empty
+    for a runner without tags. A job can be picked up when one of the runners
+    has all of its tags, an untagged job by any runner. Without ``runner_tags``
+    every job is counted.
+    """
+    if runner_tags is None:
+        return True
+    job_tags = set(job.get("tag_list") or [])
+    return any(job_tags <= set(tags) for tags in runner_tags)
+
+
+def count_jobs(gitlab_url, token, project_ids, runner_tags=None, per_page=100):
+    """Count pending and running jobs the runners could pick up."""
+    counts = dict.fromkeys(JOB_STATUSES, 0)
+    for project_id in project_ids:
+        for status in JOB_STATUSES:
+            counts[status] += sum(
+                1
+                for job in list_jobs(gitlab_url, token, project_id, status, per_page)
+                if runner_can_pick(job, runner_tags)
+            )
+    return counts
+
+
+def jobs_per_coordinator(counts, coordinators):
+    """Backlog per running coordinator, the metric tracked by the scaling policy.
+
+    With no coordinator running the whole backlog is reported, so a service
+    scaled in to zero still scales out as soon as a job is queued.
+    """
+    return sum(counts.values()) / max(coordinators, 1)
+
+
+def split_list(value):
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def handler(event, context):
+    import boto3
+
+    secret = boto3.client("secretsmanager").get_secret_value(
+        SecretId=os.environ["GITLAB_API_TOKEN_SECRET_ARN"]
+    )
+    token = json.loads(secret["SecretString"])["token"]
+
+    counts = count_jobs(
+        os.environ["GITLAB_URL"],
+        token,
+        split_list(os.environ["GITLAB_PROJECT_IDS"]),
+        json.loads(os.environ.get("RUNNER_TAG_LIST", "null")),
+    )
+
+    cluster = os.environ["FARGATE_CLUSTER"]
+    service = os.environ["SERVICE_NAME"]
+    services = boto3.client("ecs").describe_services(
+        cluster=cluster, services=[service]
+    )["services"]
+    coordinators = services[0]["runningCount"] if services else 0
+
+    dimensions = [
+        {"Name": "ClusterName", "Value": cluster},
+        {"Name": "ServiceName", "Value": service},
+    ]
+    boto3.client("cloudwatch").put_metric_data(
+        Namespace=os.environ.get("METRIC_NAMESPACE", "GitlabRunner"),
+        MetricData=[
+            {"MetricName": "PendingJobs", "Dimensions": dimensions,
+             "Value": counts["pending"], "Unit": "Count"},
+            {"MetricName": "RunningJobs", "Dimensions": dimensions,
+             "Value": counts["running"], "Unit": "Count"},
+            {"MetricName": "JobsPerCoordinator", "Dimensions": dimensions,
+             "Value": jobs_per_coordinator(counts, coordinators), "Unit": "Count"},
+        ],
+    )
+    print(json.dumps({**counts, "coordinators": coordinators}))
+    return counts
@@ -17,18 +17,29 @@
 #
 import aws_cdk as cdk
 from constructs import Construct
+import json
+import re
 import sys
 from aws_cdk import (
     aws_ec2 as ec2,
     aws_iam as iam,
+    aws_dynamodb as dynamodb,
     aws_ecs as ecs,
     aws_s3 as s3,
-    aws_autoscaling as autoscaling,
-    aws_logs as logs,
-    aws_secretsmanager as secretsmanager
+    aws_applicationautoscaling as appscaling,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_lambda as lambda_,
+    aws_secretsmanager as secretsmanager,
+    aws_ssm as ssm
 
 )
-from aws_cdk.aws_ecr_assets import DockerImageAsset
+from gitlab_ci_fargate_runner.assets import docker_architecture, docker_image_uri
+from gitlab_ci_fargate_runner.log_configuration import (
+    awslogs_configuration,
+    log_group,
+    log_retention,
+)
 
 
 class GitlabCiFargateRunnerStack(cdk.Stack):
@@ -38,13 +49,18 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
         super().__init__(scope, construct_id, env=env, **kwargs)
         # Lookup for VPC
         self.vpc = ec2.Vpc.from_lookup(self, "VPC", vpc_id=props.get("VpcId"))
-        self.gitlab_token_secret = secretsmanager.Secret.from_secret_name_v2(
-            self,
-            "gitlabRegistrationToken",
-            props.get("gitlab_runner_token_secret_name"),
-        )
+        # Persistent runner tokens replace the registration token
+        runner_tokens = props.get("runner_tokens") or {}
+        self.gitlab_token_secret = None
+        if not runner_tokens.get("enabled"):
+            self.gitlab_token_secret = secretsmanager.Secret.from_secret_name_v2(
+                self,
+                "gitlabRegistrationToken",
+                props.get("gitlab_runner_token_secret_name"),
+            )
 
         try:
+            cache = props.get("cache") or {}
             cachebucket = s3.Bucket(
                 self,
                 "gitlabrunnercachebucket",
@@ -52,11 +68,18 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 encryption=s3.BucketEncryption.KMS_MANAGED,
                 removal_policy=cdk.RemovalPolicy.DESTROY,
                 enforce_ssl=True,
-                auto_delete_objects=True
+                auto_delete_objects=True,
+                lifecycle_rules=[self.cache_lifecycle_rule(cache)]
             )
             self.cache_bucket = cachebucket
 
             # # Add ECS Cluster
+            # spot: every task prefers Fargate Spot, on_demand_coordinator: the
+            # runner service runs on demand and only the CI tasks on Spot,
+            # on_demand: no task on Spot
+            capacity_strategy = props.get("capacity_strategy", "spot")
+            if capacity_strategy not in ("spot", "on_demand_coordinator", "on_demand"):
+                raise ValueError(f"Unknown capacity_strategy: {capacity_strategy}")
             fargate_spot_strategy = ecs.CfnCluster.CapacityProviderStrategyItemProperty(
                 capacity_provider="FARGATE_SPOT", weight=100
             )
@@ -71,7 +94,8 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 f"{self.stack_name}-cluster",
                 cluster_name=f"{self.stack_name}-cluster",
                 capacity_providers=["FARGATE", "FARGATE_SPOT"],
-                default_capacity_provider_strategy=[
+                default_capacity_provider_strategy=[fargate_strategy]
+                if capacity_strategy == "on_demand" else [
                     fargate_spot_strategy,
                     fargate_strategy,
                 ],
@@ -125,8 +149,10 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                             effect=iam.Effect.ALLOW,
                             actions=[
                                 "ecs:DescribeTasks",
+                                "ecs:ListTasks",
                                 "ecs:RunTask",
-                                "ecs:StopTask"
+                                "ecs:StopTask",
+                                "ecs:TagResource"
                             ],
                             resources=["*"]
                         ),
@@ -141,7 +167,8 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 )
             }
 
-            self.gitlab_token_secret.grant_read(self.fargate_execution_role)
+            if self.gitlab_token_secret:
+                self.gitlab_token_secret.grant_read(self.fargate_execution_role)
 
             # Create IAM roles
 
@@ -158,13 +185,11 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
             )
 
             # Create LogGroup
-            self.log_group = logs.LogGroup(self,
-                                           id="LogGroup",
-                                           log_group_name=props.get(
-                                               "log_group_name", "/Gitlab/Runners/"),
-                                           removal_policy=cdk.RemovalPolicy.DESTROY,
-                                           retention=logs.RetentionDays.ONE_DAY,
-                                           )
+            self.log_group = log_group(
+                self,
+                props.get("log_group_name", "/Gitlab/Runners/"),
+                props.get("logging"),
+            )
             # Create SG
             self.sg_runner = ec2.SecurityGroup(
                 self, id="GitlabRunner", vpc=self.vpc, allow_all_outbound=False
@@ -181,17 +206,42 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
             self.sg_runner.add_egress_rule(
                 peer=ec2.Peer.any_ipv4(), connection=ec2.Port.tcp(80)
             )
+            # NFS to the EFS workspaces of the CI tasks
+            if any(image.get("efs") for image in props.get("runner_images") or []):
+                self.sg_runner.add_egress_rule(
+                    peer=ec2.Peer.ipv4(self.vpc.vpc_cidr_block),
+                    connection=ec2.Port.tcp(2049)
+                )
 
-            # Add Fargate task definition
-            gitlab_runner = DockerImageAsset(
+            # Add Fargate task definition, x86_64 or arm64 (Graviton)
+            architecture = props.get("architecture", "x86_64")
+            self.runtime_platform = ecs.CfnTaskDefinition.RuntimePlatformProperty(
+                cpu_architecture=architecture.upper(),
+                operating_system_family="LINUX",
+            )
+            gitlab_runner_image_uri = docker_image_uri(
                 self,
                 "GitlabRunnerImage",
                 directory="./gitlab_ci_fargate_runner/docker_fargate_driver",
                 build_args={
-                    "GITLAB_RUNNER_VERSION": props.get("gitlab_runner_version")
-                }
+                    "GITLAB_RUNNER_VERSION": props.get("gitlab_runner_version"),
+                    "ARCH": docker_architecture(architecture),
+                },
+                skip_unchanged=props.get("skip_unchanged_assets", False),
             )
 
+            # One runner per docker image, all served by this coordinator
+            self.runner_images = props.get("runner_images") or [{
+                "name": "default",
+                "task_definition": props.get("task_definition", ""),
+                "tags": props.get("runner_tags"),
+            }]
+            warm_pool = props.get("warm_pool") or {}
+            # Subnet of each AZ, the runner does not have to look up its own subnet
+            subnet_map = {}
+            for subnet in self.vpc.select_subnets(
+                    subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT).subnets:
+                subnet_map.setdefault(subnet.availability_zone, subnet.subnet_id)
             runner_environment = [
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
                     name="FARGATE_CLUSTER", value=f"{self.stack_name}-cluster"),
@@ -200,36 +250,103 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
                     name="FARGATE_SECURITY_GROUP", value=self.sg_runner.security_group_id),
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
-                    name="RUNNER_TAG_LIST", value=props.get("runner_tags")),
+                    name="FARGATE_SUBNET_MAP", value=json.dumps(subnet_map)),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="RUNNER_OUTPUT_LIMIT",
+                    value=str(props.get("runner_log_output_limit", 4096))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="BOOTSTRAP_BUDGET", value=str(props.get("bootstrap_budget", 30))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="RUNNER_IMAGES", value=json.dumps(self.runner_images)),
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
                     name="CACHE_BUCKET", value=self.cache_bucket.bucket_name),
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
                     name="CACHE_BUCKET_REGION", value=self.region),
                 ecs.CfnTaskDefinition.KeyValuePairProperty(
-                    name="GITLAB_URL", value=f'https://{props.get("gitlab_server")}')
+                    name="CACHE_SHARED", value=str(cache.get("shared", True)).lower()),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="RUNNER_ENVIRONMENT",
+                    value=json.dumps(self.cache_environment(cache))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="GITLAB_URL", value=f'https://{props.get("gitlab_server")}'),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="WARM_POOL_SIZE", value=str(warm_pool.get("size", 0))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="WARM_POOL_TTL", value=str(warm_pool.get("ttl", 900))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="WARM_POOL_TASK_DEFINITIONS",
+                    value=",".join(warm_pool.get("task_definitions", []))),
             ]
 
-            runner_secrets = [ecs.CfnTaskDefinition.SecretProperty(
-                name="GITLAB_REGISTRATION_TOKEN",
-                value_from=ecs.Secret.from_secrets_manager(
-                    self.gitlab_token_secret, "token"
-                ).arn
-            )]
-
-            awslogs_driver = ecs.CfnTaskDefinition.LogConfigurationProperty(
-                log_driver="awslogs",
-                options={
-                    "awslogs-group": self.log_group.log_group_name,
-                    "awslogs-region": self.region,
-                    "awslogs-stream-prefix": "fargate",
-                },
-            )
+            # Running jobs get DRAIN_TIMEOUT seconds to finish when the runner
+            # task is stopped, then DRAIN_REPORT_TIMEOUT seconds to report the
+            # interrupted jobs, and the runners are unregistered and their
+            # token slot released, all within the stop timeout of the container
+            drain = props.get("drain") or {}
+            stop_timeout = int(drain.get("stop_timeout", 120))
+            report_timeout = int(drain.get("report_timeout", 10))
+            cleanup_seconds = 10
+            drain_timeout = int(drain.get("timeout", stop_timeout - report_timeout - cleanup_seconds))
+            if not (0 < drain_timeout and 0 < report_timeout
+                    and drain_timeout + report_timeout + cleanup_seconds <= stop_timeout <= 120):
+                raise ValueError(
+                    f"drain timeout and report_timeout must leave {cleanup_seconds} seconds "
+                    "of stop_timeout to unregister the runners, at most 120 seconds")
+            runner_environment += [
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="DRAIN_TIMEOUT", value=str(drain_timeout)),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="DRAIN_REPORT_TIMEOUT", value=str(report_timeout)),
+            ]
+
+            # CI tasks spread over the subnet of each AZ, retried in the other
+            # AZs and on the other capacity providers without capacity
+            placement = props.get("placement") or {}
+            if placement.get("enabled"):
+                runner_environment += self.placement_environment(
+                    placement, capacity_strategy, subnet_map)
+
+            # CI tasks kept for the next job of the same pipeline
+            task_reuse = props.get("task_reuse") or {}
+            if task_reuse.get("enabled"):
+                runner_environment += self.task_reuse_environment(task_reuse)
+
+            git_bundles = props.get("git_bundles") or {}
+            if git_bundles.get("enabled"):
+                runner_environment += [
+                    ecs.CfnTaskDefinition.KeyValuePairProperty(
+                        name="GIT_BUNDLE_REPOSITORIES",
+                        value=",".join(git_bundles.get("repositories", []))),
+                    ecs.CfnTaskDefinition.KeyValuePairProperty(
+                        name="GIT_BUNDLE_MAX_AGE",
+                        value=str(git_bundles.get("max_age_hours", 24))),
+                    ecs.CfnTaskDefinition.KeyValuePairProperty(
+                        name="GIT_BUNDLE_MAX_SIZE",
+                        value=str(git_bundles.get("max_size_mb", 2048))),
+                ]
+
+            # Concurrent jobs of a runner task, changed by the capacity profiles
+            runner_environment += self.add_runner_concurrency(props)
+
+            runner_secrets = None
+            if runner_tokens.get("enabled"):
+                runner_environment += self.add_runner_tokens(props)
+            else:
+                runner_secrets = [ecs.CfnTaskDefinition.SecretProperty(
+                    name="GITLAB_REGISTRATION_TOKEN",
+                    value_from=ecs.Secret.from_secrets_manager(
+                        self.gitlab_token_secret, "token"
+                    ).arn
+                )]
+
+            awslogs_driver = awslogs_configuration(
+                self.log_group, self.region, "fargate", props.get("logging"))
             port_mappings = [
                 ecs.CfnTaskDefinition.PortMappingProperty(container_port=22)
             ]
             runner = ecs.CfnTaskDefinition.ContainerDefinitionProperty(
                 name="gitlab-runner",
-                image=gitlab_runner.image_uri,
+                image=gitlab_runner_image_uri,
                 port_mappings=port_mappings,
                 log_configuration=awslogs_driver,
                 environment=runner_environment,
@@ -237,6 +354,7 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 linux_parameters=ecs.CfnTaskDefinition.LinuxParametersProperty(
                     init_process_enabled=True,
                 ),
+                stop_timeout=stop_timeout,
                 interactive=True
             )
 
@@ -244,14 +362,16 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 self,
                 'GitlabRunnerTaskDefinition',
                 family="gitlab-runner",
-                cpu=str(props.get("task_definition_cpu", 256)),
-                memory=str(props.get("task_definition_memory", 512)),
+                cpu=str(props.get("task_definition_cpu", props.get("cpu", 256))),
+                memory=str(props.get("task_definition_memory", props.get("memory", 512))),
+                runtime_platform=self.runtime_platform,
                 network_mode="awsvpc",
                 task_role_arn=self.fargate_service_task_role.role_arn,
                 execution_role_arn=self.fargate_execution_role.role_arn,
                 container_definitions=[runner]
             )
 
+            scaled = bool(props.get("autoscaling", {}).get("enabled") or props.get("capacity_profiles"))
             self.gitlab_service = ecs.CfnService(
                 self,
                 "GitlabRunnerService",
@@ -268,7 +388,13 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
                 deployment_controller=ecs.CfnService.DeploymentControllerProperty(
                     type="ECS"
                 ),
-                desired_count=props.get("desired_count",1),
+                capacity_provider_strategy=[
+                    ecs.CfnService.CapacityProviderStrategyItemProperty(
+                        capacity_provider="FARGATE", weight=1)
+                ] if capacity_strategy == "on_demand_coordinator" else None,
+                # The scalable target owns the count of a scaled service,
+                # a static one would reset it on every update of the stack
+                desired_count=None if scaled else props.get("desired_count",1),
                 enable_ecs_managed_tags=True,
                 enable_execute_command=True,
                 network_configuration=ecs.CfnService.NetworkConfigurationProperty(
@@ -281,14 +407,541 @@ class GitlabCiFargateRunnerStack(cdk.Stack):
 
             )
 
+            # Runner tasks scaled on the job queue, within the capacity profiles
+            if scaled:
+                self.add_scalable_target(props)
+            if props.get("autoscaling", {}).get("enabled"):
+                self.add_queue_depth_autoscaling(props)
+
+            if props.get("vpc_endpoints"):
+                self.add_vpc_endpoints(props)
+
+            if git_bundles.get("enabled"):
+                self.add_git_bundles(props, gitlab_runner_image_uri)
+
+            if (props.get("task_events") or {}).get("enabled"):
+                self.add_task_events(props)
+
             self.output_props = props.copy()
             self.output_props["vpc"] = self.vpc
             self.output_props["log_group_name"] = self.log_group.log_group_name
+            if (props.get("task_events") or {}).get("enabled"):
+                self.output_props["task_events_log_group_name"] = (
+                    self.task_events_log_group.log_group_name)
 
         except:
             print("Unexpected error:", sys.exc_info()[0])
             raise
 
+    @staticmethod
+    def cache_lifecycle_rule(cache):
+        """Expire the job caches, optionally moving them to a cheaper storage class first."""
+        transitions = []
+        if cache.get("transition_days"):
+            transitions.append(s3.Transition(
+                storage_class=getattr(
+                    s3.StorageClass,
+                    cache.get("transition_storage_class", "INTELLIGENT_TIERING")),
+                transition_after=cdk.Duration.days(cache.get("transition_days")),
+            ))
+        return s3.LifecycleRule(
+            id="ExpireJobCaches",
+            prefix="gitlab-cache/",
+            expiration=cdk.Duration.days(cache.get("expiration_days", 30)),
+            transitions=transitions or None,
+            abort_incomplete_multipart_upload_after=cdk.Duration.days(1),
+        )
+
+    @staticmethod
+    def cache_environment(cache):
+        """Job variables tuning the cache archiver of the runner helper."""
+        environment = []
+        if not cache.get("fastzip"):
+            return environment
+        environment.append("FF_USE_FASTZIP=true")
+        compression_level = cache.get("compression_level")
+        if compression_level:
+            if compression_level not in ("fastest", "fast", "default", "slow", "slowest"):
+                raise ValueError(f"Unknown cache compression_level: {compression_level}")
+            environment.append(f"CACHE_COMPRESSION_LEVEL={compression_level}")
+        if cache.get("archiver_concurrency"):
+            environment.append(
+                f'FASTZIP_ARCHIVER_CONCURRENCY={cache.get("archiver_concurrency")}')
+        if cache.get("archiver_buffer_size"):
+            environment.append(
+                f'FASTZIP_ARCHIVER_BUFFER_SIZE={cache.get("archiver_buffer_size")}')
+        return environment
+
+    @staticmethod
+    def capacity_profiles(props):
+        """Runner tasks and concurrent jobs of each window of capacity_profiles."""
+        autoscaling = props.get("autoscaling") or {}
+        profiles = []
+        for profile in props.get("capacity_profiles") or []:
+            name = str(profile.get("name"))
+            if not re.fullmatch(r"[A-Za-z0-9_-]+", name):
+                raise ValueError(
+                    f"capacity profile name {name} must be letters, digits, dashes and underscores")
+            if name in (other["name"] for other in profiles):
+                raise ValueError(f"capacity profile name {name} is not unique")
+            if not profile.get("schedule"):
+                raise ValueError(f"capacity profile {name} requires a schedule")
+            # desired_count is the floor of the queue depth autoscaling
+            desired_count = int(profile.get("desired_count", props.get("desired_count", 1)))
+            max_capacity = desired_count
+            if autoscaling.get("enabled"):
+                max_capacity = max(desired_count, int(
+                    profile.get("max_capacity", autoscaling.get("max_capacity", 2))))
+            profiles.append({
+                "name": name,
+                "schedule": profile["schedule"],
+                "timezone": profile.get("timezone", "UTC"),
+                "min_capacity": desired_count,
+                "max_capacity": max_capacity,
+                "concurrent_jobs": profile.get("concurrent_jobs"),
+            })
+        return profiles
+
+    @staticmethod
+    def placement_environment(placement, capacity_strategy, subnet_map):
+        """Environment of the placement of the CI tasks by the runner."""
+        strategy = placement.get("strategy", "spread")
+        if strategy not in ("spread", "least_loaded"):
+            raise ValueError(f"Unknown placement strategy: {strategy}")
+        capacity_providers = placement.get("capacity_providers") or (
+            ["FARGATE"] if capacity_strategy == "on_demand" else ["FARGATE_SPOT", "FARGATE"])
+        for capacity_provider in capacity_providers:
+            if capacity_provider not in ("FARGATE", "FARGATE_SPOT"):
+                raise ValueError(f"Unknown capacity provider: {capacity_provider}")
+        return [
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="FARGATE_SUBNETS", value=",".join(subnet_map.values())),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="FARGATE_PLACEMENT", value=strategy),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="FARGATE_CAPACITY_PROVIDERS", value=",".join(capacity_providers)),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="PLACEMENT_BACKOFF", value=str(placement.get("backoff", 300))),
+        ]
+
+    @staticmethod
+    def task_reuse_environment(task_reuse):
+        """Environment of the reuse of the CI tasks by the next job of a pipeline."""
+        idle_timeout = int(task_reuse.get("idle_timeout", 120))
+        max_jobs = int(task_reuse.get("max_jobs", 5))
+        workspace = task_reuse.get("workspace", "keep")
+        if idle_timeout <= 0:
+            raise ValueError("task_reuse idle_timeout must be a positive number of seconds")
+        if max_jobs < 2:
+            raise ValueError("task_reuse max_jobs must be at least 2")
+        if workspace not in ("keep", "clean"):
+            raise ValueError(f"Unknown task_reuse workspace policy: {workspace}")
+        return [
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="TASK_REUSE_IDLE_TIMEOUT", value=str(idle_timeout)),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="TASK_REUSE_MAX_JOBS", value=str(max_jobs)),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="TASK_REUSE_WORKSPACE", value=workspace),
+        ]
+
+    def add_vpc_endpoints(self, props):
+        """Reach S3, ECR, CloudWatch Logs, Secrets Manager and ECS without the NAT gateway."""
+        interface_services = {
+            "ecr": ec2.InterfaceVpcEndpointAwsService.ECR,
+            "ecr_docker": ec2.InterfaceVpcEndpointAwsService.ECR_DOCKER,
+            "logs": ec2.InterfaceVpcEndpointAwsService.CLOUDWATCH_LOGS,
+            "secretsmanager": ec2.InterfaceVpcEndpointAwsService.SECRETS_MANAGER,
+            "ecs": ec2.InterfaceVpcEndpointAwsService.ECS,
+        }
+        endpoints = props.get("vpc_endpoints")
+        if endpoints is True:
+            endpoints = ["s3", *interface_services]
+        unknown = set(endpoints) - {"s3", *interface_services}
+        if unknown:
+            raise ValueError(f"Unknown vpc_endpoints: {', '.join(sorted(unknown))}")
+
+        subnets = ec2.SubnetSelection(
+            subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT, one_per_az=True
+        )
+        if "s3" in endpoints:
+            # Gateway endpoints are routes, the 443 egress of sg_runner covers them
+            self.vpc.add_gateway_endpoint(
+                "S3Endpoint",
+                service=ec2.GatewayVpcEndpointAwsService.S3,
+                subnets=[subnets],
+            )
+
+        interface_endpoints = [name for name in endpoints if name in interface_services]
+        if not interface_endpoints:
+            return
+        self.sg_endpoints = ec2.SecurityGroup(
+            self, id="VpcEndpoints", vpc=self.vpc, allow_all_outbound=False
+        )
+        self.sg_endpoints.add_ingress_rule(
+            peer=self.sg_runner, connection=ec2.Port.tcp(443)
+        )
+        for name in interface_endpoints:
+            self.vpc.add_interface_endpoint(
+                f"{name.title().replace('_', '')}Endpoint",
+                service=interface_services[name],
+                subnets=subnets,
+                security_groups=[self.sg_endpoints],
+                private_dns_enabled=True,
+            )
+
+    def add_runner_tokens(self, props):
+        """Create the lease table of the runner token slots, return the runner environment."""
+        runner_tokens = props.get("runner_tokens")
+        secret_names = runner_tokens.get("secret_names") or []
+        autoscaling = props.get("autoscaling") or {}
+        max_runners = props.get("desired_count", 1)
+        if autoscaling.get("enabled"):
+            max_runners = max(max_runners, autoscaling.get("max_capacity", 2))
+        for profile in self.capacity_profiles(props):
+            max_runners = max(max_runners, profile["max_capacity"])
+        if len(secret_names) < max_runners:
+            raise ValueError(
+                f"runner_tokens needs a secret per runner task, {max_runners} at most")
+
+        # One item per slot, owned by the runner task using its tokens
+        lease_table = dynamodb.Table(
+            self,
+            "RunnerTokenLeases",
+            partition_key=dynamodb.Attribute(
+                name="slot", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+        lease_table.grant_read_write_data(self.fargate_service_task_role)
+        for index, secret_name in enumerate(secret_names):
+            secretsmanager.Secret.from_secret_name_v2(
+                self, f"runnerTokenSlot{index}", secret_name
+            ).grant_read(self.fargate_service_task_role)
+
+        return [
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="RUNNER_TOKEN_SECRETS", value=",".join(secret_names)),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="RUNNER_TOKEN_LEASE_TABLE", value=lease_table.table_name),
+        ]
+
+    def add_git_bundles(self, props, image_uri):
+        """Rebuild the git bundles of the configured repositories on a schedule."""
+        git_bundles = props.get("git_bundles")
+        family = "gitlab-git-bundles"
+
+        gitlab_api_token_secret = secretsmanager.Secret.from_secret_name_v2(
+            self,
+            "gitBundlesApiToken",
+            git_bundles.get("gitlab_api_token_secret_name"),
+        )
+        gitlab_api_token_secret.grant_read(self.fargate_execution_role)
+
+        task_role = iam.Role(
+            self,
+            "GitBundlesTaskRole",
+            assumed_by=iam.ServicePrincipal("ecs-tasks.amazonaws.com"),
+        )
+        task_role.add_to_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["s3:GetObject", "s3:PutObject"],
+                resources=[f"{self.cache_bucket.bucket_arn}/git-bundles/*"],
+            )
+        )
+
+        bundler = ecs.CfnTaskDefinition.ContainerDefinitionProperty(
+            name="git-bundles",
+            image=image_uri,
+            entry_point=["/usr/local/bin/build-git-bundles.sh"],
+            environment=[
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="GITLAB_URL", value=f'https://{props.get("gitlab_server")}'),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="CACHE_BUCKET", value=self.cache_bucket.bucket_name),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="GIT_BUNDLE_REPOSITORIES",
+                    value=",".join(git_bundles.get("repositories", []))),
+                ecs.CfnTaskDefinition.KeyValuePairProperty(
+                    name="GIT_BUNDLE_MAX_SIZE",
+                    value=str(git_bundles.get("max_size_mb", 2048))),
+            ],
+            secrets=[ecs.CfnTaskDefinition.SecretProperty(
+                name="GITLAB_API_TOKEN",
+                value_from=ecs.Secret.from_secrets_manager(
+                    gitlab_api_token_secret, "token"
+                ).arn
+            )],
+            log_configuration=awslogs_configuration(
+                self.log_group, self.region, "git-bundles", props.get("logging")),
+        )
+        task_definition = ecs.CfnTaskDefinition(
+            self,
+            "GitBundlesTaskDefinition",
+            family=family,
+            cpu=str(git_bundles.get("cpu", 1024)),
+            memory=str(git_bundles.get("memory", 4096)),
+            ephemeral_storage=ecs.CfnTaskDefinition.EphemeralStorageProperty(
+                size_in_gib=int(git_bundles.get("ephemeral_storage", 50))),
+            runtime_platform=self.runtime_platform,
+            network_mode="awsvpc",
+            requires_compatibilities=["FARGATE"],
+            task_role_arn=task_role.role_arn,
+            execution_role_arn=self.fargate_execution_role.role_arn,
+            container_definitions=[bundler],
+        )
+
+        # Scheduled task, started by EventBridge in the runner subnets
+        events_role = iam.Role(
+            self,
+            "GitBundlesScheduleRole",
+            assumed_by=iam.ServicePrincipal("events.amazonaws.com"),
+        )
+        events_role.add_to_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["ecs:RunTask"],
+                resources=[
+                    f"arn:aws:ecs:{self.region}:{self.account}:task-definition/{family}:*"],
+            )
+        )
+        events_role.add_to_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["iam:PassRole"],
+                resources=[task_role.role_arn, self.fargate_execution_role.role_arn],
+            )
+        )
+        events.CfnRule(
+            self,
+            "GitBundlesSchedule",
+            schedule_expression=git_bundles.get("schedule", "rate(1 hour)"),
+            targets=[events.CfnRule.TargetProperty(
+                id="GitBundles",
+                arn=self.fargate_cluster.attr_arn,
+                role_arn=events_role.role_arn,
+                ecs_parameters=events.CfnRule.EcsParametersProperty(
+                    task_definition_arn=task_definition.ref,
+                    task_count=1,
+                    launch_type="FARGATE",
+                    platform_version="LATEST",
+                    network_configuration=events.CfnRule.NetworkConfigurationProperty(
+                        aws_vpc_configuration=events.CfnRule.AwsVpcConfigurationProperty(
+                            subnets=self.vpc.select_subnets(
+                                subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT).subnet_ids,
+                            security_groups=[self.sg_runner.security_group_id],
+                            assign_public_ip="DISABLED",
+                        )
+                    ),
+                ),
+            )],
+        )
+
+    def add_task_events(self, props):
+        """Record the last state change of every task of the cluster, see tools/task_report.py."""
+        task_events = props.get("task_events")
+        self.task_events_log_group = log_group(
+            self,
+            task_events.get(
+                "log_group_name", f"/aws/events/{self.stack_name}/task-lifecycle"),
+            task_events,
+            id="TaskEventsLogGroup",
+        )
+        # The STOPPED event holds every timestamp of the lifecycle of the task
+        events.Rule(
+            self,
+            "TaskLifecycleEvents",
+            event_pattern=events.EventPattern(
+                source=["aws.ecs"],
+                detail_type=["ECS Task State Change"],
+                detail={
+                    "clusterArn": [self.fargate_cluster.attr_arn],
+                    "lastStatus": ["STOPPED"],
+                },
+            ),
+            targets=[targets.CloudWatchLogGroup(self.task_events_log_group)],
+        )
+
+    def add_runner_concurrency(self, props):
+        """Create the parameter of the concurrent jobs set by the capacity profiles, return the runner environment."""
+        environment = []
+        if props.get("concurrent_jobs"):
+            environment.append(ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="RUNNER_CONCURRENT", value=str(props.get("concurrent_jobs"))))
+        profiles = [
+            profile for profile in self.capacity_profiles(props) if profile["concurrent_jobs"]]
+        if not profiles:
+            return environment
+
+        # Polled by the runner tasks, gitlab-runner reloads its config without restarting
+        parameter_name = f"/{self.stack_name}/runner/concurrent"
+        parameter = ssm.StringParameter(
+            self,
+            "RunnerConcurrent",
+            parameter_name=parameter_name,
+            description="Concurrent jobs of a runner task, set by the capacity profiles",
+            string_value=str(props.get("concurrent_jobs", 10)),
+        )
+        parameter.grant_read(self.fargate_service_task_role)
+
+        scheduler_role = iam.Role(
+            self,
+            "CapacityProfilesSchedulerRole",
+            assumed_by=iam.ServicePrincipal("scheduler.amazonaws.com"),
+        )
+        scheduler_role.add_to_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["ssm:PutParameter"],
+                resources=[parameter.parameter_arn],
+            )
+        )
+        # EventBridge Scheduler has no construct in this CDK version
+        for profile in profiles:
+            cdk.CfnResource(
+                self,
+                f'{profile["name"]}ConcurrencySchedule',
+                type="AWS::Scheduler::Schedule",
+                properties={
+                    "Description": f'Concurrent jobs of the {profile["name"]} capacity profile',
+                    "ScheduleExpression": profile["schedule"],
+                    "ScheduleExpressionTimezone": profile["timezone"],
+                    "FlexibleTimeWindow": {"Mode": "OFF"},
+                    "Target": {
+                        "Arn": "arn:aws:scheduler:::aws-sdk:ssm:putParameter",
+                        "RoleArn": scheduler_role.role_arn,
+                        "Input": json.dumps({
+                            "Name": parameter_name,
+                            "Value": str(profile["concurrent_jobs"]),
+                            "Overwrite": True,
+                        }),
+                    },
+                },
+            )
+
+        environment.append(ecs.CfnTaskDefinition.KeyValuePairProperty(
+            name="RUNNER_CONCURRENT_PARAMETER", value=parameter_name))
+        return environment
+
+    def add_scalable_target(self, props):
+        """Scalable target of the runner service, with a scheduled action per capacity profile."""
+        autoscaling_props = props.get("autoscaling") or {}
+        cluster_name = f"{self.stack_name}-cluster"
+        min_capacity = max_capacity = props.get("desired_count", 1)
+        if autoscaling_props.get("enabled"):
+            min_capacity = autoscaling_props.get("min_capacity", 1)
+            max_capacity = autoscaling_props.get("max_capacity", 2)
+
+        self.scalable_target = appscaling.CfnScalableTarget(
+            self,
+            "GitlabRunnerScalableTarget",
+            min_capacity=min_capacity,
+            max_capacity=max_capacity,
+            resource_id=cdk.Fn.join(
+                "/", ["service", cluster_name, self.gitlab_service.attr_name]),
+            role_arn=f"arn:aws:iam::{self.account}:role/aws-service-role/"
+                     "ecs.application-autoscaling.amazonaws.com/"
+                     "AWSServiceRoleForApplicationAutoScaling_ECSService",
+            scalable_dimension="ecs:service:DesiredCount",
+            service_namespace="ecs",
+            scheduled_actions=[
+                appscaling.CfnScalableTarget.ScheduledActionProperty(
+                    scheduled_action_name=f'{self.stack_name}-{profile["name"]}',
+                    schedule=profile["schedule"],
+                    timezone=profile["timezone"],
+                    scalable_target_action=appscaling.CfnScalableTarget.ScalableTargetActionProperty(
+                        min_capacity=profile["min_capacity"],
+                        max_capacity=profile["max_capacity"],
+                    ),
+                )
+                for profile in self.capacity_profiles(props)
+            ] or None,
+        )
+        self.scalable_target.add_depends_on(self.gitlab_service)
+
+    def add_queue_depth_autoscaling(self, props):
+        """Scale the runner service on the pending/running jobs reported by GitLab."""
+        autoscaling_props = props.get("autoscaling")
+        cluster_name = f"{self.stack_name}-cluster"
+        metric_namespace = autoscaling_props.get("metric_namespace", "GitlabRunner")
+
+        gitlab_api_token_secret = secretsmanager.Secret.from_secret_name_v2(
+            self,
+            "gitlabApiToken",
+            autoscaling_props.get("gitlab_api_token_secret_name"),
+        )
+
+        # Poller publishing the queue depth as a custom metric
+        self.queue_poller = lambda_.Function(
+            self,
+            "QueueDepthPoller",
+            runtime=lambda_.Runtime.PYTHON_3_9,
+            handler="index.handler",
+            code=lambda_.Code.from_asset(
+                "./gitlab_ci_fargate_runner/functions/queue_poller"),
+            timeout=cdk.Duration.seconds(50),
+            vpc=self.vpc,
+            vpc_subnets=ec2.SubnetSelection(
+                subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT),
+            security_groups=[self.sg_runner],
+            environment={
+                "GITLAB_URL": f'https://{props.get("gitlab_server")}',
+                "GITLAB_API_TOKEN_SECRET_ARN": gitlab_api_token_secret.secret_arn,
+                "GITLAB_PROJECT_IDS": ",".join(
+                    str(project) for project in autoscaling_props.get("project_ids", [])),
+                # Tags of each runner, an empty list for a runner without tags
+                "RUNNER_TAG_LIST": json.dumps([
+                    [tag.strip() for tag in (image.get("tags") or "").split(",") if tag.strip()]
+                    for image in self.runner_images]),
+                "FARGATE_CLUSTER": cluster_name,
+                "SERVICE_NAME": self.gitlab_service.attr_name,
+                "METRIC_NAMESPACE": metric_namespace,
+            },
+            log_retention=log_retention(props.get("logging")),
+        )
+        gitlab_api_token_secret.grant_read(self.queue_poller)
+        self.queue_poller.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["cloudwatch:PutMetricData", "ecs:DescribeServices"],
+                resources=["*"],
+            )
+        )
+        events.Rule(
+            self,
+            "QueueDepthPollerSchedule",
+            schedule=events.Schedule.rate(cdk.Duration.minutes(
+                autoscaling_props.get("poll_interval_minutes", 1))),
+            targets=[targets.LambdaFunction(self.queue_poller)],
+        )
+
+        # Target tracking on the backlog of each coordinator
+        appscaling.CfnScalingPolicy(
+            self,
+            "GitlabRunnerQueueDepthScaling",
+            policy_name=f"{self.stack_name}-queue-depth",
+            policy_type="TargetTrackingScaling",
+            scaling_target_id=self.scalable_target.ref,
+            target_tracking_scaling_policy_configuration=appscaling.CfnScalingPolicy.TargetTrackingScalingPolicyConfigurationProperty(
+                target_value=float(autoscaling_props.get(
+                    "target_jobs_per_coordinator", props.get("concurrent_jobs", 1))),
+                scale_in_cooldown=autoscaling_props.get("scale_in_cooldown", 300),
+                scale_out_cooldown=autoscaling_props.get("scale_out_cooldown", 60),
+                customized_metric_specification=appscaling.CfnScalingPolicy.CustomizedMetricSpecificationProperty(
+                    metric_name="JobsPerCoordinator",
+                    namespace=metric_namespace,
+                    statistic="Average",
+                    dimensions=[
+                        appscaling.CfnScalingPolicy.MetricDimensionProperty(
+                            name="ClusterName", value=cluster_name),
+                        appscaling.CfnScalingPolicy.MetricDimensionProperty(
+                            name="ServiceName", value=self.gitlab_service.attr_name),
+                    ],
+                ),
+            ),
+        )
+
     @property
     def outputs(self):
         return self.output_props
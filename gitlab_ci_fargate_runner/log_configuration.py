@@ -0,0 +1,90 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Log groups and awslogs configuration of the task definitions.
+
+The ``logging`` props of a stack set the retention of its log group and the
+delivery mode of the awslogs driver. In the default non-blocking mode, the
+logs of a container are buffered (``max_buffer_size``) while CloudWatch Logs
+throttles, instead of blocking the writes of the container. The oldest logs
+are dropped when the buffer is full.
+"""
+import aws_cdk as cdk
+from aws_cdk import (
+    aws_ecs as ecs,
+    aws_logs as logs
+)
+
+RETENTION_DAYS = {
+    1: logs.RetentionDays.ONE_DAY,
+    3: logs.RetentionDays.THREE_DAYS,
+    5: logs.RetentionDays.FIVE_DAYS,
+    7: logs.RetentionDays.ONE_WEEK,
+    14: logs.RetentionDays.TWO_WEEKS,
+    30: logs.RetentionDays.ONE_MONTH,
+    60: logs.RetentionDays.TWO_MONTHS,
+    90: logs.RetentionDays.THREE_MONTHS,
+    120: logs.RetentionDays.FOUR_MONTHS,
+    150: logs.RetentionDays.FIVE_MONTHS,
+    180: logs.RetentionDays.SIX_MONTHS,
+    365: logs.RetentionDays.ONE_YEAR,
+    400: logs.RetentionDays.THIRTEEN_MONTHS,
+    545: logs.RetentionDays.EIGHTEEN_MONTHS,
+    731: logs.RetentionDays.TWO_YEARS,
+    1827: logs.RetentionDays.FIVE_YEARS,
+    3653: logs.RetentionDays.TEN_YEARS,
+}
+
+
+def log_retention(logging=None):
+    """RetentionDays of the retention_days of the logging props (defaults to 1)."""
+    retention_days = int((logging or {}).get("retention_days", 1))
+    if retention_days not in RETENTION_DAYS:
+        raise ValueError(
+            f"retention_days must be one of {', '.join(map(str, RETENTION_DAYS))}")
+    return RETENTION_DAYS[retention_days]
+
+
+def log_group(scope, log_group_name, logging=None, id="LogGroup"):
+    """Create the log group of the containers of a stack."""
+    return logs.LogGroup(
+        scope,
+        id=id,
+        log_group_name=log_group_name,
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+        retention=log_retention(logging),
+    )
+
+
+def awslogs_configuration(log_group, region, stream_prefix, logging=None):
+    """awslogs LogConfigurationProperty of a container, non-blocking by default."""
+    logging = logging or {}
+    options = {
+        "awslogs-group": log_group.log_group_name,
+        "awslogs-region": region,
+        "awslogs-stream-prefix": stream_prefix,
+    }
+    mode = logging.get("mode", "non-blocking")
+    if mode == "non-blocking":
+        options["mode"] = "non-blocking"
+        options["max-buffer-size"] = str(logging.get("max_buffer_size", "25m"))
+    elif mode != "blocking":
+        raise ValueError(f"Unknown logging mode: {mode}")
+    return ecs.CfnTaskDefinition.LogConfigurationProperty(
+        log_driver="awslogs",
+        options=options,
+    )
@@ -20,13 +20,135 @@ from constructs import Construct
 import sys
 from aws_cdk import (
     aws_iam as iam,
+    aws_codebuild as codebuild,
+    aws_ec2 as ec2,
+    aws_ecr as ecr,
     aws_ecs as ecs,
-    aws_logs as logs
+    aws_efs as efs,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_s3_assets as s3_assets,
+    aws_secretsmanager as secretsmanager
 )
-from aws_cdk.aws_ecr_assets import DockerImageAsset
+from gitlab_ci_fargate_runner.assets import docker_architecture, docker_image_uri
+from gitlab_ci_fargate_runner.log_configuration import awslogs_configuration, log_group
 import json
+import os
+import re
 from jinja2 import Template
 
+# Mount path of the EFS workspace, parent of the builds_dir of the runner
+WORKSPACE_PATH = "/opt/gitlab-runner"
+# Job variables moving the package manager caches to the workspace
+DEPENDENCY_CACHE_VARIABLES = {
+    "PIP_CACHE_DIR": f"{WORKSPACE_PATH}/dependencies/pip",
+    "npm_config_cache": f"{WORKSPACE_PATH}/dependencies/npm",
+    "YARN_CACHE_FOLDER": f"{WORKSPACE_PATH}/dependencies/yarn",
+    "GOMODCACHE": f"{WORKSPACE_PATH}/dependencies/go",
+    "MAVEN_OPTS": f"-Dmaven.repo.local={WORKSPACE_PATH}/dependencies/maven",
+}
+
+
+# Base images pulled by the kaniko warmer, shared by the tasks on the EFS workspace
+KANIKO_CACHE_DIR = f"{WORKSPACE_PATH}/kaniko-cache"
+
+
+def kaniko_cache(props):
+    """Settings of the ECR layer cache, enabled by default for the kaniko image."""
+    cache_props = props.get("kaniko_cache") or {}
+    enabled = cache_props.get("enabled", props.get("docker_image_name") == "kaniko")
+    if not enabled:
+        return None
+    if cache_props.get("base_images") and not props.get("efs", {}).get("enabled"):
+        raise ValueError("kaniko_cache.base_images requires the efs workspace")
+    return {
+        "repository_name": cache_props.get(
+            "repository_name", f'gitlab-runner/{props.get("docker_image_name")}-cache'),
+        "expiration_days": int(cache_props.get("expiration_days", 14)),
+        "base_images": cache_props.get("base_images", []),
+    }
+
+
+def warmed_images(props):
+    """Settings of the dependency-warmed images, None when disabled."""
+    warmed_props = props.get("warmed_images") or {}
+    if not warmed_props.get("enabled"):
+        return None
+    projects = warmed_props.get("projects") or []
+    names = [project.get("name") for project in projects]
+    for project in projects:
+        if not re.fullmatch(r"[a-z0-9][a-z0-9-]*", str(project.get("name"))):
+            raise ValueError(
+                f'warmed_images project name {project.get("name")} must be lowercase letters, digits and dashes')
+        if names.count(project["name"]) > 1:
+            raise ValueError(f'warmed_images project name {project["name"]} is not unique')
+        if not project.get("project") or not project.get("files"):
+            raise ValueError(f'warmed_images project {project["name"]} requires a project and files')
+    return {
+        "repository_name": warmed_props.get(
+            "repository_name", f'gitlab-runner/{props.get("docker_image_name")}-warmed'),
+        "schedule": warmed_props.get("schedule", "cron(0 2 * * ? *)"),
+        "gitlab_api_token_secret_name": warmed_props.get("gitlab_api_token_secret_name"),
+        "images_to_keep": int(warmed_props.get("images_to_keep", 3)),
+        "timeout": int(warmed_props.get("timeout", 60)),
+        "projects": [
+            {
+                "name": project["name"],
+                "project": str(project["project"]),
+                "ref": project.get("ref", "HEAD"),
+                "files": project["files"],
+            }
+            for project in projects
+        ],
+    }
+
+
+def sidecar_sets(props):
+    """Sidecar containers of each sidecar set, validated against the task sizes."""
+    sets = props.get("sidecars") or {}
+    sizes = props.get("sizes") or {
+        None: {
+            "cpu": props.get("task_definition_cpu", props.get("cpu", 256)),
+            "memory": props.get("task_definition_memory", props.get("memory", 512)),
+        }
+    }
+    for set_name, sidecars in sets.items():
+        if not re.fullmatch(r"[a-z0-9][a-z0-9-]*", str(set_name)):
+            raise ValueError(f"sidecars set name {set_name} must be lowercase letters, digits and dashes")
+        if not sidecars:
+            raise ValueError(f"sidecars set {set_name} has no container")
+        names = [sidecar.get("name") for sidecar in sidecars]
+        for sidecar in sidecars:
+            if not re.fullmatch(r"[a-zA-Z0-9][a-zA-Z0-9_-]*", str(sidecar.get("name"))):
+                raise ValueError(f'sidecar name {sidecar.get("name")} of set {set_name} is not a valid container name')
+            if sidecar["name"] == "ci-coordinator" or names.count(sidecar["name"]) > 1:
+                raise ValueError(f'sidecar name {sidecar["name"]} of set {set_name} is not unique')
+            if not sidecar.get("image"):
+                raise ValueError(f'sidecar {sidecar["name"]} of set {set_name} requires an image')
+        # ci-coordinator runs the job in what the sidecars leave of the task
+        cpu = sum(int(sidecar.get("cpu", 0)) for sidecar in sidecars)
+        memory = sum(int(sidecar.get("memory", sidecar.get("memory_reservation", 0))) for sidecar in sidecars)
+        for size_name, size in sizes.items():
+            if cpu >= int(size.get("cpu", 256)) or memory >= int(size.get("memory", 512)):
+                raise ValueError(
+                    f"sidecars set {set_name} leaves no cpu or memory to the job in size {size_name or 'default'}")
+    return sets
+
+
+def runner_environment(props, account, region):
+    """Variables added by the runner to the jobs of the image."""
+    environment = []
+    if props.get("efs", {}).get("enabled"):
+        environment += [f"{name}={value}" for name, value in DEPENDENCY_CACHE_VARIABLES.items()]
+    cache = kaniko_cache(props)
+    if cache:
+        cache_repo = f'{account}.dkr.ecr.{region}.amazonaws.com/{cache["repository_name"]}'
+        cache_args = f"--cache=true --cache-repo={cache_repo}"
+        if cache["base_images"]:
+            cache_args += f" --cache-dir={KANIKO_CACHE_DIR}"
+        environment += [f"KANIKO_CACHE_REPO={cache_repo}", f"KANIKO_CACHE_ARGS={cache_args}"]
+    return environment
+
 
 class TaskDefinitionStack(cdk.Stack):
     def __init__(
@@ -74,60 +196,445 @@ class TaskDefinitionStack(cdk.Stack):
             except IOError:
                 print("No task policies template provided.")
             # Add Fargate task definition
-            default_docker_image = DockerImageAsset(
+            # All images are built from the docker_images folder so they can
+            # share the files of docker_images/common. The other images are
+            # excluded to keep the asset hash of this image stable.
+            docker_image_name = props.get("docker_image_name")
+            architecture = props.get("architecture", "x86_64")
+            default_docker_image_uri = docker_image_uri(
                 self,
-                props.get("docker_image_name"),
-                directory=f'./docker_images/{props.get("docker_image_name")}',
+                docker_image_name,
+                directory="./docker_images",
+                file=f"{docker_image_name}/Dockerfile",
+                exclude=[
+                    entry
+                    for entry in os.listdir("./docker_images")
+                    if entry not in (docker_image_name, "common")
+                ],
                 build_args={
-                    "GITLAB_RUNNER_VERSION": props.get("gitlab_runner_version") 
-                }
+                    "GITLAB_RUNNER_VERSION": props.get("gitlab_runner_version"),
+                    "ARCH": docker_architecture(architecture),
+                },
+                skip_unchanged=props.get("skip_unchanged_assets", False),
             )
 
             # Create LogGroup
-            self.log_group = logs.LogGroup(self,
-                                           id="LogGroup",
-                                           log_group_name=props.get(
-                                               "log_group_name", f'/Gitlab/TaskDefinitions/{props.get("docker_image_name")}/'),
-                                           removal_policy=cdk.RemovalPolicy.DESTROY,
-                                           retention=logs.RetentionDays.ONE_DAY,
-                                           )
-
-            awslogs_driver = ecs.CfnTaskDefinition.LogConfigurationProperty(
-                log_driver="awslogs",
-                options={
-                    "awslogs-group": self.log_group.log_group_name,
-                    "awslogs-region": self.region,
-                    "awslogs-stream-prefix": "fargate",
-                },
+            self.log_group = log_group(
+                self,
+                props.get(
+                    "log_group_name", f'/Gitlab/TaskDefinitions/{props.get("docker_image_name")}/'),
+                props.get("logging"),
             )
+
+            awslogs_driver = awslogs_configuration(
+                self.log_group, self.region, "fargate", props.get("logging"))
             port_mappings = [
                 ecs.CfnTaskDefinition.PortMappingProperty(container_port=22)
             ]
-            ci_coordinator = ecs.CfnTaskDefinition.ContainerDefinitionProperty(
+            # Persistent workspace, one volume per project with its own access point
+            workspace_volumes = {None: None}
+            mount_points = None
+            if props.get("efs", {}).get("enabled"):
+                workspace_volumes = self.add_workspace_file_system(props)
+                mount_points = [ecs.CfnTaskDefinition.MountPointProperty(
+                    container_path=WORKSPACE_PATH,
+                    source_volume="workspace",
+                    read_only=False,
+                )]
+
+            # ECR layer cache of kaniko, the warmer runs when the CI task starts
+            environment = []
+            if kaniko_cache(props):
+                environment += self.add_kaniko_cache(props) or []
+
+            # Host key of sshd, generated at image build by default
+            environment, secrets = self.add_ssh_host_key(props, environment)
+
+            ci_coordinator_props = dict(
                 name="ci-coordinator",
-                image=default_docker_image.image_uri,
+                image=default_docker_image_uri,
                 port_mappings=port_mappings,
                 log_configuration=awslogs_driver,
+                mount_points=mount_points,
+                environment=environment or None,
+                secrets=secrets,
             )
-            self.fargate_task_definition = ecs.CfnTaskDefinition(
-                self,
-                f'{props.get("docker_image_name")}TaskDefinition',
-                family=f'{props.get("docker_image_name")}',
-                cpu=str(props.get("task_definition_cpu", 256)),
-                memory=str(props.get("task_definition_memory", 512)),
-                network_mode="awsvpc",
-                task_role_arn=self.fargate_task_role.role_arn,
-                execution_role_arn=self.fargate_execution_role.role_arn,
-                container_definitions=[ci_coordinator],
+            ci_coordinator = ecs.CfnTaskDefinition.ContainerDefinitionProperty(**ci_coordinator_props)
+
+            # One task definition per size variant, the default size keeps the
+            # image name as family so existing FARGATE_TASK_DEFINITION still work
+            default_size = props.get("default_size")
+            sizes = props.get("sizes") or {
+                default_size: {
+                    "cpu": props.get("task_definition_cpu", props.get("cpu", 256)),
+                    "memory": props.get("task_definition_memory", props.get("memory", 512)),
+                }
+            }
+            # x86_64 or arm64 (Graviton), the image is built for this architecture
+            self.runtime_platform = ecs.CfnTaskDefinition.RuntimePlatformProperty(
+                cpu_architecture=architecture.upper(),
+                operating_system_family="LINUX",
             )
+            if default_size not in sizes:
+                raise ValueError(f"default_size {default_size} is not defined in sizes")
+
+            # Task definitions by family
+            self.fargate_task_definitions = {}
+            sidecars_by_set = sidecar_sets(props)
+            for size_name, size in sizes.items():
+                for project_id, volume in workspace_volumes.items():
+                    family = props.get("docker_image_name")
+                    if size_name != default_size:
+                        family = f"{family}-{size_name}"
+                    if project_id is not None:
+                        family = f"{family}-project-{project_id}"
+                    self.fargate_task_definitions[family] = self.add_task_definition(
+                        family, size, [ci_coordinator], volume
+                    )
+                # Sidecar sets on the shared workspace, the job starts once they are healthy
+                for set_name, sidecars in sidecars_by_set.items():
+                    family = props.get("docker_image_name")
+                    if size_name != default_size:
+                        family = f"{family}-{size_name}"
+                    family = f"{family}-sidecars-{set_name}"
+                    self.fargate_task_definitions[family] = self.add_task_definition(
+                        family,
+                        size,
+                        self.sidecar_containers(sidecars, ci_coordinator_props, awslogs_driver),
+                        workspace_volumes[None],
+                        tags=[cdk.CfnTag(key="gitlab-runner:sidecars", value=set_name)],
+                    )
+            self.fargate_task_definition = self.fargate_task_definitions[
+                props.get("docker_image_name")]
+
+            # Images with the dependencies of projects, rebuilt on a schedule
+            if warmed_images(props):
+                self.add_warmed_images(props, architecture)
 
             self.output_props = props.copy()
             self.output_props["fargate_task_definition"] = self.fargate_task_definition
+            self.output_props["fargate_task_definitions"] = self.fargate_task_definitions
+            self.output_props["runner_environment"] = runner_environment(
+                props, self.account, self.region)
 
         except:
             print("Unexpected error:", sys.exc_info()[0])
             raise
 
+    def add_workspace_file_system(self, props):
+        """Create the EFS file system of the workspaces, return the task volume of each project."""
+        efs_props = props.get("efs")
+        vpc = self.lookup_vpc(props)
+
+        sg_workspace = ec2.SecurityGroup(
+            self, id="WorkspaceMountTarget", vpc=vpc, allow_all_outbound=False
+        )
+        sg_workspace.add_ingress_rule(
+            peer=ec2.Peer.ipv4(vpc.vpc_cidr_block), connection=ec2.Port.tcp(2049)
+        )
+
+        throughput_mode = efs_props.get("throughput_mode", "bursting")
+        if throughput_mode not in ("bursting", "provisioned", "elastic"):
+            raise ValueError(f"Unknown efs throughput_mode: {throughput_mode}")
+        provisioned_throughput = None
+        if throughput_mode == "provisioned":
+            provisioned_throughput = cdk.Size.mebibytes(
+                efs_props.get("provisioned_throughput", 64))
+
+        self.file_system = efs.FileSystem(
+            self,
+            "Workspace",
+            vpc=vpc,
+            vpc_subnets=ec2.SubnetSelection(
+                subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT),
+            security_group=sg_workspace,
+            encrypted=True,
+            performance_mode=efs.PerformanceMode.GENERAL_PURPOSE,
+            throughput_mode=(efs.ThroughputMode.PROVISIONED
+                             if throughput_mode == "provisioned"
+                             else efs.ThroughputMode.BURSTING),
+            provisioned_throughput_per_second=provisioned_throughput,
+            removal_policy=cdk.RemovalPolicy.DESTROY,
+        )
+        if throughput_mode == "elastic":
+            self.file_system.node.default_child.add_property_override(
+                "ThroughputMode", "elastic")
+
+        # The jobs run as root, the access point keeps each project in its directory
+        volumes = {}
+        for project_id in [None, *efs_props.get("projects", [])]:
+            path = "/shared" if project_id is None else f"/projects/{project_id}"
+            access_point = self.file_system.add_access_point(
+                "SharedAccessPoint" if project_id is None
+                else f"Project{project_id}AccessPoint",
+                path=path,
+                create_acl=efs.Acl(owner_uid="0", owner_gid="0", permissions="755"),
+                posix_user=efs.PosixUser(uid="0", gid="0"),
+            )
+            volumes[project_id] = ecs.CfnTaskDefinition.VolumeProperty(
+                name="workspace",
+                efs_volume_configuration=ecs.CfnTaskDefinition.EfsVolumeConfigurationProperty(
+                    file_system_id=self.file_system.file_system_id,
+                    transit_encryption="ENABLED",
+                    authorization_config=ecs.CfnTaskDefinition.AuthorizationConfigProperty(
+                        access_point_id=access_point.access_point_id,
+                        iam="DISABLED",
+                    ),
+                ),
+            )
+        return volumes
+
+    def add_kaniko_cache(self, props):
+        """Create the ECR cache repository of kaniko, return the environment of the warmer."""
+        cache = kaniko_cache(props)
+        self.kaniko_cache_repository = ecr.Repository(
+            self,
+            "KanikoCache",
+            repository_name=cache["repository_name"],
+            lifecycle_rules=[
+                ecr.LifecycleRule(
+                    description="Expire the untagged layers",
+                    tag_status=ecr.TagStatus.UNTAGGED,
+                    max_image_age=cdk.Duration.days(1),
+                ),
+                ecr.LifecycleRule(
+                    description="Expire the cached layers",
+                    tag_status=ecr.TagStatus.ANY,
+                    max_image_age=cdk.Duration.days(cache["expiration_days"]),
+                ),
+            ],
+        )
+        self.kaniko_cache_repository.grant_pull_push(self.fargate_task_role)
+
+        if not cache["base_images"]:
+            return None
+        return [
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="KANIKO_WARM_IMAGES", value=",".join(cache["base_images"])),
+            ecs.CfnTaskDefinition.KeyValuePairProperty(
+                name="KANIKO_CACHE_DIR", value=KANIKO_CACHE_DIR),
+        ]
+
+    def add_ssh_host_key(self, props, environment):
+        """Environment and secrets of the host key of sshd, see SSH_HOST_KEYS of docker-entrypoint.sh."""
+        ssh_props = props.get("ssh") or {}
+        host_keys = ssh_props.get("host_keys", "image")
+        if host_keys not in ("image", "task", "secret"):
+            raise ValueError(f"Unknown ssh host_keys: {host_keys}")
+        if host_keys == "image":
+            return environment, None
+
+        environment = environment + [
+            ecs.CfnTaskDefinition.KeyValuePairProperty(name="SSH_HOST_KEYS", value=host_keys)]
+        if host_keys == "task":
+            return environment, None
+
+        if not ssh_props.get("host_key_secret_name"):
+            raise ValueError("ssh host_keys secret requires host_key_secret_name")
+        host_key_secret = secretsmanager.Secret.from_secret_name_v2(
+            self, "SshHostKey", ssh_props.get("host_key_secret_name"))
+        host_key_secret.grant_read(self.fargate_execution_role)
+        return environment, [ecs.CfnTaskDefinition.SecretProperty(
+            name="SSH_HOST_KEY",
+            value_from=ecs.Secret.from_secrets_manager(host_key_secret).arn,
+        )]
+
+    def add_warmed_images(self, props, architecture):
+        """Build the images of the warmed_images projects, see task_definitions/warmed_images."""
+        warmed = warmed_images(props)
+        family = props.get("docker_image_name")
+
+        # The task definitions point to the latest images of each project
+        self.warmed_images_repository = ecr.Repository(
+            self,
+            "WarmedImages",
+            repository_name=warmed["repository_name"],
+            lifecycle_rules=[
+                ecr.LifecycleRule(
+                    description="Expire the untagged layers",
+                    tag_status=ecr.TagStatus.UNTAGGED,
+                    max_image_age=cdk.Duration.days(1),
+                ),
+                *[
+                    ecr.LifecycleRule(
+                        description=f'Keep the latest images of {project["name"]}',
+                        tag_status=ecr.TagStatus.TAGGED,
+                        tag_prefix_list=[f'{project["name"]}-'],
+                        max_image_count=warmed["images_to_keep"],
+                    )
+                    for project in warmed["projects"]
+                ],
+            ],
+        )
+
+        gitlab_api_token_secret = secretsmanager.Secret.from_secret_name_v2(
+            self,
+            "WarmedImagesApiToken",
+            warmed["gitlab_api_token_secret_name"],
+        )
+        source = s3_assets.Asset(
+            self, "WarmedImagesSource", path="./task_definitions/warmed_images")
+
+        # docker build needs a privileged build, on the architecture of the tasks
+        if architecture == "arm64":
+            build_image = codebuild.LinuxBuildImage.AMAZON_LINUX_2_ARM_2
+            compute_type = codebuild.ComputeType.LARGE
+        else:
+            build_image = codebuild.LinuxBuildImage.STANDARD_5_0
+            compute_type = codebuild.ComputeType.MEDIUM
+        project = codebuild.Project(
+            self,
+            "WarmedImagesBuild",
+            source=codebuild.Source.s3(bucket=source.bucket, path=source.s3_object_key),
+            build_spec=codebuild.BuildSpec.from_object({
+                "version": "0.2",
+                "phases": {"build": {"commands": ["bash build-warmed-images.sh"]}},
+            }),
+            environment=codebuild.BuildEnvironment(
+                build_image=build_image,
+                compute_type=compute_type,
+                privileged=True,
+            ),
+            environment_variables={
+                "GITLAB_URL": codebuild.BuildEnvironmentVariable(
+                    value=f'https://{props.get("gitlab_server")}'),
+                "GITLAB_API_TOKEN": codebuild.BuildEnvironmentVariable(
+                    type=codebuild.BuildEnvironmentVariableType.SECRETS_MANAGER,
+                    value=f"{gitlab_api_token_secret.secret_name}:token"),
+                "BASE_TASK_DEFINITION": codebuild.BuildEnvironmentVariable(value=family),
+                "REPOSITORY_URI": codebuild.BuildEnvironmentVariable(
+                    value=self.warmed_images_repository.repository_uri),
+                "WARMED_PROJECTS": codebuild.BuildEnvironmentVariable(
+                    value=json.dumps(warmed["projects"])),
+            },
+            vpc=self.lookup_vpc(props),
+            subnet_selection=ec2.SubnetSelection(
+                subnet_type=ec2.SubnetType.PRIVATE_WITH_NAT),
+            timeout=cdk.Duration.minutes(warmed["timeout"]),
+            logging=codebuild.LoggingOptions(
+                cloud_watch=codebuild.CloudWatchLoggingOptions(
+                    log_group=self.log_group, prefix="warmed-images")),
+        )
+        gitlab_api_token_secret.grant_read(project)
+        self.warmed_images_repository.grant_pull_push(project)
+        project.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=[
+                    "ecr:BatchCheckLayerAvailability",
+                    "ecr:BatchGetImage",
+                    "ecr:GetDownloadUrlForLayer",
+                ],
+                resources=[f"arn:aws:ecr:{self.region}:{self.account}:repository/*"],
+            )
+        )
+        project.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["ecs:DescribeTaskDefinition", "ecs:RegisterTaskDefinition"],
+                resources=["*"],
+            )
+        )
+        project.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["ecs:TagResource"],
+                resources=[
+                    f"arn:aws:ecs:{self.region}:{self.account}:task-definition/{family}-warmed-*:*"],
+            )
+        )
+        project.add_to_role_policy(
+            iam.PolicyStatement(
+                effect=iam.Effect.ALLOW,
+                actions=["iam:PassRole"],
+                resources=[
+                    self.fargate_task_role.role_arn, self.fargate_execution_role.role_arn],
+            )
+        )
+
+        events.Rule(
+            self,
+            "WarmedImagesSchedule",
+            schedule=events.Schedule.expression(warmed["schedule"]),
+            targets=[targets.CodeBuildProject(project)],
+        )
+
+    def sidecar_containers(self, sidecars, ci_coordinator_props, log_configuration):
+        """Container definitions of a sidecar set, ci-coordinator waiting for the sidecars."""
+        containers = []
+        depends_on = []
+        for sidecar in sidecars:
+            health_check = sidecar.get("health_check")
+            if isinstance(health_check, (str, list)):
+                health_check = {"command": health_check}
+            if health_check:
+                command = health_check["command"]
+                if isinstance(command, str):
+                    command = ["CMD-SHELL", command]
+                health_check = ecs.CfnTaskDefinition.HealthCheckProperty(
+                    command=command,
+                    interval=int(health_check.get("interval", 5)),
+                    timeout=int(health_check.get("timeout", 5)),
+                    retries=int(health_check.get("retries", 10)),
+                    start_period=int(health_check.get("start_period", 0)) or None,
+                )
+            containers.append(ecs.CfnTaskDefinition.ContainerDefinitionProperty(
+                name=sidecar["name"],
+                image=sidecar["image"],
+                essential=sidecar.get("essential", False),
+                command=sidecar.get("command"),
+                environment=[
+                    ecs.CfnTaskDefinition.KeyValuePairProperty(name=name, value=str(value))
+                    for name, value in (sidecar.get("environment") or {}).items()
+                ] or None,
+                health_check=health_check,
+                cpu=int(sidecar["cpu"]) if sidecar.get("cpu") else None,
+                memory=int(sidecar["memory"]) if sidecar.get("memory") else None,
+                memory_reservation=int(sidecar["memory_reservation"]) if sidecar.get("memory_reservation") else None,
+                log_configuration=log_configuration,
+            ))
+            # Without a health check, a sidecar is only waited for until it starts
+            depends_on.append(ecs.CfnTaskDefinition.ContainerDependencyProperty(
+                container_name=sidecar["name"],
+                condition="HEALTHY" if health_check else "START",
+            ))
+        return [
+            ecs.CfnTaskDefinition.ContainerDefinitionProperty(**ci_coordinator_props, depends_on=depends_on),
+            *containers,
+        ]
+
+    def lookup_vpc(self, props):
+        """VPC of the runner, looked up once."""
+        if not hasattr(self, "vpc"):
+            self.vpc = ec2.Vpc.from_lookup(self, "VPC", vpc_id=props.get("VpcId"))
+        return self.vpc
+
+    def add_task_definition(self, family, size, container_definitions, volume=None, tags=None):
+        """Create a Fargate task definition of the given size (cpu, memory, ephemeral_storage)."""
+        ephemeral_storage = None
+        if size.get("ephemeral_storage"):
+            if not 21 <= int(size["ephemeral_storage"]) <= 200:
+                raise ValueError(
+                    f"ephemeral_storage of {family} must be between 21 and 200 GiB")
+            ephemeral_storage = ecs.CfnTaskDefinition.EphemeralStorageProperty(
+                size_in_gib=int(size["ephemeral_storage"]))
+
+        return ecs.CfnTaskDefinition(
+            self,
+            f"{family}TaskDefinition",
+            family=family,
+            cpu=str(size.get("cpu", 256)),
+            memory=str(size.get("memory", 512)),
+            ephemeral_storage=ephemeral_storage,
+            runtime_platform=self.runtime_platform,
+            network_mode="awsvpc",
+            task_role_arn=self.fargate_task_role.role_arn,
+            execution_role_arn=self.fargate_execution_role.role_arn,
+            container_definitions=container_definitions,
+            volumes=[volume] if volume else None,
+            tags=tags,
+        )
+
     @property
     def outputs(self):
-        return self.output
+        return self.output_props
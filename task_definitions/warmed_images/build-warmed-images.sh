@@ -0,0 +1,134 @@
+#!/bin/bash
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+
+# -----------------------------------------------------------------------------
+# Build the dependency-warmed images of the configured projects. Run on a
+# schedule by the WarmedImages CodeBuild project of the task definition stack.
+#
+# For each project, the lockfiles are downloaded from GitLab and hashed with
+# the image of the base task definition. When the hash changed, an image is
+# built FROM the base image with the dependencies installed, pushed to ECR
+# with the <name>-<hash> tag, and a new revision of the <base>-warmed-<name>
+# task definition is registered. Jobs then call warmed-deps to skip the
+# installation when their lockfiles still match.
+#
+# Environment variables:
+# - GITLAB_URL (required): the URL to the GitLab instance
+# - GITLAB_API_TOKEN (required): token with the read_api scope
+# - BASE_TASK_DEFINITION (required): family of the task definition to derive
+# - REPOSITORY_URI (required): ECR repository receiving the images
+# - WARMED_PROJECTS (required): JSON list of the projects, ex:
+#   [{"name": "app", "project": "group/app", "ref": "main", "files": ["requirements.txt"]}]
+# -----------------------------------------------------------------------------
+
+set -o pipefail
+
+BUILD_DIR=$(cd "$(dirname "$0")" && pwd)
+
+###############################################################################
+# Download a file of a project from the GitLab API.
+#
+# Arguments:
+#   $1 - Project id or path
+#   $2 - Path of the file in the repository
+#   $3 - Git ref
+#   $4 - Destination
+###############################################################################
+download_project_file() {
+    local project file
+    project=$(jq -rn --arg value "$1" '$value | @uri')
+    file=$(jq -rn --arg value "$2" '$value | @uri')
+    mkdir -p "$(dirname "$4")"
+    curl --silent --show-error --fail --location --output "$4" \
+        --header "PRIVATE-TOKEN: ${GITLAB_API_TOKEN}" \
+        "${GITLAB_URL}/api/v4/projects/${project}/repository/files/${file}/raw?ref=$3"
+}
+
+###############################################################################
+# Build the image of a project and register its task definition, unless the
+# latest revision already runs these lockfiles on the current base.
+#
+# Arguments:
+#   $1 - Project settings, an item of WARMED_PROJECTS
+###############################################################################
+build_warmed_image() {
+    local name project ref family work_dir hash image current
+    name=$(jq -r '.name' <<<"$1")
+    project=$(jq -r '.project' <<<"$1")
+    ref=$(jq -r '.ref // "HEAD"' <<<"$1")
+    family="${BASE_TASK_DEFINITION}-warmed-${name}"
+    work_dir=$(mktemp -d)
+
+    mkdir -p "${work_dir}/lockfiles"
+    while read -r file; do
+        download_project_file "${project}" "${file}" "${ref}" "${work_dir}/lockfiles/${file}" \
+            || { echo "Failed to download ${file} of ${project}" >&2; rm -rf "${work_dir}"; return 1; }
+    done < <(jq -r '.files[]' <<<"$1")
+
+    # Checked by warmed-deps in the job, relative to the project directory
+    (cd "${work_dir}/lockfiles" && jq -r '.files[]' <<<"$1" | sort | xargs sha256sum > lockfiles.sha256)
+    hash=$( (cat "${work_dir}/lockfiles/lockfiles.sha256"; echo "${BASE_IMAGE}") | sha256sum | cut -c1-16)
+    image="${REPOSITORY_URI}:${name}-${hash}"
+
+    current=$(aws ecs describe-task-definition --task-definition "${family}" --include TAGS 2>/dev/null || echo '{}')
+    if [ "$(jq -r '.taskDefinition.containerDefinitions[0].image // empty' <<<"${current}")" = "${image}" ] \
+        && [ "$(jq -r '.tags[]? | select(.key == "gitlab-runner:base-task-definition") | .value' <<<"${current}")" = "${BASE_TASK_DEFINITION_ARN}" ]; then
+        echo "${family} is up to date"
+        rm -rf "${work_dir}"
+        return 0
+    fi
+
+    if ! aws ecr describe-images --repository-name "${REPOSITORY_URI#*/}" --image-ids "imageTag=${name}-${hash}" >/dev/null 2>&1; then
+        cp "${BUILD_DIR}/Dockerfile" "${BUILD_DIR}/warmed-deps" "${work_dir}/"
+        docker build --quiet --build-arg "BASE_IMAGE=${BASE_IMAGE}" --tag "${image}" "${work_dir}" \
+            && docker push --quiet "${image}" \
+            || { echo "Failed to build the image of ${name}" >&2; rm -rf "${work_dir}"; return 1; }
+        docker rmi "${image}" >/dev/null
+    fi
+    rm -rf "${work_dir}"
+
+    # Same settings as the base task definition, with the warmed image
+    jq --arg family "${family}" --arg image "${image}" \
+        --arg base "${BASE_TASK_DEFINITION_ARN}" --arg hash "${hash}" '
+        .taskDefinition
+        | {family: $family, taskRoleArn, executionRoleArn, networkMode, containerDefinitions,
+           volumes, requiresCompatibilities, cpu, memory, runtimePlatform, ephemeralStorage}
+        | .containerDefinitions[0].image = $image
+        | with_entries(select(.value != null))
+        | .tags = [{key: "gitlab-runner:base-task-definition", value: $base},
+                   {key: "gitlab-runner:lockfiles-hash", value: $hash}]' \
+        <<<"${BASE_TASK_DEFINITION_JSON}" > "${BUILD_DIR}/${family}.json" \
+        && aws ecs register-task-definition --cli-input-json "file://${BUILD_DIR}/${family}.json" \
+            --query 'taskDefinition.taskDefinitionArn' --output text \
+        || { echo "Failed to register ${family}" >&2; return 1; }
+}
+
+BASE_TASK_DEFINITION_JSON=$(aws ecs describe-task-definition --task-definition "${BASE_TASK_DEFINITION}") || exit 1
+BASE_TASK_DEFINITION_ARN=$(jq -r '.taskDefinition.taskDefinitionArn' <<<"${BASE_TASK_DEFINITION_JSON}")
+BASE_IMAGE=$(jq -r '.taskDefinition.containerDefinitions[0].image' <<<"${BASE_TASK_DEFINITION_JSON}")
+
+for registry in $(printf '%s\n' "${BASE_IMAGE%%/*}" "${REPOSITORY_URI%%/*}" | sort -u); do
+    aws ecr get-login-password | docker login --username AWS --password-stdin "${registry}" >/dev/null || exit 1
+done
+
+failed=0
+while read -r project; do
+    build_warmed_image "${project}" || failed=1
+done < <(jq -c '.[]' <<<"${WARMED_PROJECTS}")
+exit ${failed}
@@ -0,0 +1,292 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import itertools
+import json
+import re
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ECS_TARGET_PREFIX = "AmazonEC2ContainerServiceV20141113."
+DYNAMODB_TARGET_PREFIX = "DynamoDB_20120810."
+SECRETS_MANAGER_TARGET_PREFIX = "secretsmanager."
+TARGET_PREFIXES = (ECS_TARGET_PREFIX, DYNAMODB_TARGET_PREFIX, SECRETS_MANAGER_TARGET_PREFIX)
+CAPACITY_FAILURE = (
+    "Capacity is unavailable at this time. Please try again later or in a different availability zone")
+
+
+class ConditionalCheckFailed(Exception):
+    """The condition of a DynamoDB write does not hold."""
+
+
+class FakeAws:
+    """Minimal stand-in for the AWS APIs used by the runner, served on localhost.
+
+    - ECS JSON API: RunTask, DescribeTasks, StopTask, ListTasks and
+      TagResource. The tasks go through PROVISIONING, PENDING
+      (``provisioning_seconds``) and RUNNING (after ``pull_seconds`` more),
+      with ``task_ip`` as private IP, unless their ``lastStatus`` is set in
+      ``tasks``. The subnets of ``full_subnets`` have no capacity.
+    - Task metadata endpoint of the runner task, under ``/v4`` (use
+      ``metadata_url`` as ECS_CONTAINER_METADATA_URI_V4).
+    - S3 objects, path style (``/<bucket>/<key>``), kept in memory.
+    - DynamoDB GetItem, PutItem and DeleteItem on the items of ``items``,
+      by table and by the value of their ``table_keys`` attribute, with the
+      ``attribute_not_exists(#name)`` and ``#name = :value`` conditions.
+    - Secrets Manager GetSecretValue of the strings of ``secrets``.
+
+    ``on_run_task`` is called with each task started and its overrides, for
+    instance to authorize the SSH key of the task in a container.
+    """
+
+    def __init__(self, provisioning_seconds=0.0, pull_seconds=0.0, task_ip="127.0.0.1",
+                 full_subnets=(), availability_zone="us-east-1a", on_run_task=None,
+                 table_keys=None):
+        self.provisioning_seconds = provisioning_seconds
+        self.pull_seconds = pull_seconds
+        self.task_ip = task_ip
+        self.full_subnets = set(full_subnets)
+        self.availability_zone = availability_zone
+        self.on_run_task = on_run_task
+        self.tasks = {}
+        self.objects = {}
+        self.table_keys = table_keys or {}
+        self.items = {table: {} for table in self.table_keys}
+        self.secrets = {}
+        self.calls = []
+        self.lock = threading.Lock()
+        self.task_ids = itertools.count(1)
+        self.runner_task_arn = "arn:aws:ecs:us-east-1:123456789012:task/fake-cluster/runner"
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def do_GET(self):
+                path = urllib.parse.urlsplit(self.path).path
+                if path.startswith("/v4"):
+                    return self.reply(200, fake.task_metadata())
+                self.s3("GET", path)
+
+            def do_HEAD(self):
+                self.s3("HEAD", urllib.parse.urlsplit(self.path).path)
+
+            def do_PUT(self):
+                self.s3("PUT", urllib.parse.urlsplit(self.path).path, self.body())
+
+            def do_POST(self):
+                target = self.headers.get("X-Amz-Target", "")
+                prefix = next((prefix for prefix in TARGET_PREFIXES if target.startswith(prefix)), None)
+                if prefix is None:
+                    return self.reply(400, {"__type": "UnknownOperationException"})
+                action = target[len(prefix):]
+                request = json.loads(self.body() or b"{}")
+                fake.calls.append((time.monotonic(), action))
+                handler = getattr(fake, action.lower(), None)
+                if handler is None:
+                    return self.reply(400, {"__type": "UnknownOperationException"})
+                try:
+                    self.reply(200, handler(request), content_type="application/x-amz-json-1.1")
+                except ConditionalCheckFailed as error:
+                    self.reply(400, {"__type": "com.amazonaws.dynamodb.v20120810#ConditionalCheckFailedException",
+                                     "message": str(error)},
+                               content_type="application/x-amz-json-1.0")
+                except ValueError as error:
+                    self.reply(400, {"__type": "InvalidParameterException", "message": str(error)},
+                               content_type="application/x-amz-json-1.1")
+
+            def s3(self, method, path, data=None):
+                key = urllib.parse.unquote(path.lstrip("/"))
+                fake.calls.append((time.monotonic(), f"S3:{method}"))
+                if method == "PUT":
+                    fake.objects[key] = (data, time.time())
+                    return self.raw(200, b"")
+                if key not in fake.objects:
+                    return self.raw(404, b"" if method == "HEAD" else b"<Error><Code>NoSuchKey</Code></Error>")
+                data, modified_at = fake.objects[key]
+                headers = {"Last-Modified": time.strftime(
+                    "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(modified_at))}
+                self.raw(200, data, headers, length=len(data), send_body=method == "GET")
+
+            def reply(self, code, body, headers=None, content_type="application/json"):
+                self.raw(code, json.dumps(body).encode(), headers, content_type)
+
+            def raw(self, code, payload, headers=None, content_type="application/octet-stream",
+                    length=None, send_body=True):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(payload) if length is None else length))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def metadata_url(self):
+        return f"{self.url}/v4"
+
+    def task_metadata(self):
+        return {
+            "Cluster": "arn:aws:ecs:us-east-1:123456789012:cluster/fake-cluster",
+            "TaskARN": self.runner_task_arn,
+            "AvailabilityZone": self.availability_zone,
+        }
+
+    def describe(self, task):
+        """Task as returned by the ECS API, its status following the elapsed time."""
+        elapsed = time.monotonic() - task["created"]
+        if task.get("stopped"):
+            status = "STOPPED"
+        elif task.get("lastStatus"):
+            status = task["lastStatus"]
+        elif elapsed < self.provisioning_seconds:
+            status = "PROVISIONING"
+        elif elapsed < self.provisioning_seconds + self.pull_seconds:
+            status = "PENDING"
+        else:
+            status = "RUNNING"
+        return {
+            "taskArn": task["taskArn"],
+            "taskDefinitionArn": task["taskDefinitionArn"],
+            "startedBy": task["startedBy"],
+            "lastStatus": status,
+            "desiredStatus": "STOPPED" if task.get("stopped") else "RUNNING",
+            "capacityProviderName": task["capacityProviderName"],
+            "availabilityZone": self.availability_zone,
+            "tags": task["tags"],
+            "attachments": [{"type": "ElasticNetworkInterface", "details": [
+                {"name": "subnetId", "value": task["subnet"]},
+                {"name": "privateIPv4Address", "value": self.task_ip},
+            ]}],
+        }
+
+    def runtask(self, request):
+        subnets = request["networkConfiguration"]["awsvpcConfiguration"]["subnets"]
+        if set(subnets) <= self.full_subnets:
+            return {"tasks": [], "failures": [{"reason": CAPACITY_FAILURE}]}
+        strategy = request.get("capacityProviderStrategy") or [{"capacityProvider": "FARGATE_SPOT"}]
+        with self.lock:
+            task_arn = ("arn:aws:ecs:us-east-1:123456789012:task/fake-cluster/"
+                        f"{next(self.task_ids):032x}")
+            task = self.tasks[task_arn] = {
+                "taskArn": task_arn,
+                "taskDefinitionArn": request["taskDefinition"],
+                "startedBy": request.get("startedBy", ""),
+                "capacityProviderName": strategy[0]["capacityProvider"],
+                "subnet": subnets[0],
+                "tags": request.get("tags", []),
+                "created": time.monotonic(),
+            }
+        if self.on_run_task:
+            self.on_run_task(task, request.get("overrides", {}))
+        return {"tasks": [self.describe(task)], "failures": []}
+
+    def describetasks(self, request):
+        if len(request.get("tasks", [])) > 100:
+            raise ValueError("Tasks cannot be longer than 100")
+        tasks, failures = [], []
+        for task_arn in request.get("tasks", []):
+            if task_arn in self.tasks:
+                tasks.append(self.describe(self.tasks[task_arn]))
+            else:
+                failures.append({"arn": task_arn, "reason": "MISSING"})
+        return {"tasks": tasks, "failures": failures}
+
+    def stoptask(self, request):
+        task = self.tasks[request["task"]]
+        task["stopped"] = True
+        return {"task": self.describe(task)}
+
+    def tagresource(self, request):
+        task = self.tasks[request["resourceArn"]]
+        keys = {tag["key"] for tag in request["tags"]}
+        task["tags"] = [tag for tag in task["tags"] if tag["key"] not in keys] + request["tags"]
+        return {}
+
+    def listtasks(self, request):
+        return {"taskArns": [
+            task_arn for task_arn, task in self.tasks.items()
+            if not task.get("stopped")
+            and task["startedBy"] == request.get("startedBy", task["startedBy"])
+        ]}
+
+    def item_key(self, table, item):
+        return json.dumps(item[self.table_keys[table]], sort_keys=True)
+
+    def check_condition(self, request, item):
+        """Evaluate the ConditionExpression of a request against the current item."""
+        expression = request.get("ConditionExpression")
+        if not expression:
+            return
+        names = request.get("ExpressionAttributeNames", {})
+        values = request.get("ExpressionAttributeValues", {})
+        match = re.fullmatch(r"attribute_not_exists\((\S+)\)", expression)
+        if match:
+            holds = item is None or names.get(match[1], match[1]) not in item
+        else:
+            match = re.fullmatch(r"(\S+) = (\S+)", expression)
+            if not match:
+                raise ValueError(f"Unsupported condition expression: {expression}")
+            holds = item is not None and item.get(names.get(match[1], match[1])) == values[match[2]]
+        if not holds:
+            raise ConditionalCheckFailed("The conditional request failed")
+
+    def getitem(self, request):
+        table = request["TableName"]
+        item = self.items[table].get(self.item_key(table, request["Key"]))
+        return {"Item": item} if item else {}
+
+    def putitem(self, request):
+        table = request["TableName"]
+        key = self.item_key(table, request["Item"])
+        with self.lock:
+            self.check_condition(request, self.items[table].get(key))
+            self.items[table][key] = request["Item"]
+        return {}
+
+    def deleteitem(self, request):
+        table = request["TableName"]
+        key = self.item_key(table, request["Key"])
+        with self.lock:
+            self.check_condition(request, self.items[table].get(key))
+            self.items[table].pop(key, None)
+        return {}
+
+    def getsecretvalue(self, request):
+        return {"Name": request["SecretId"], "SecretString": self.secrets[request["SecretId"]]}
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,214 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import collections
+import itertools
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeGitlab:
+    """Minimal stand-in for the GitLab REST API, served on localhost.
+
+    Projects are given as a mapping of project id to a list of job
+    dictionaries (at least ``status`` and ``tag_list``).
+
+    The runner API is served as well: runners register with any registration
+    token, and request the jobs queued with ``add_job`` in order. The time a
+    job is queued, picked up and finished is recorded in ``jobs``.
+    """
+
+    def __init__(self, projects=None, token="glpat-test"):
+        self.projects = projects or {}
+        self.token = token
+        self.requests = []
+        self.runners = {}
+        self.jobs = {}
+        self.queue = collections.deque()
+        self.lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                fake.requests.append(self.path)
+                if self.headers.get("PRIVATE-TOKEN") != fake.token:
+                    return self.reply(401, {"message": "401 Unauthorized"})
+                url = urllib.parse.urlsplit(self.path)
+                parts = url.path.strip("/").split("/")
+                if parts[:3] != ["api", "v4", "projects"] or parts[-1] != "jobs":
+                    return self.reply(404, {"message": "404 Not Found"})
+                project = urllib.parse.unquote("/".join(parts[3:-1]))
+                if project not in fake.projects:
+                    return self.reply(404, {"message": "404 Project Not Found"})
+                self.list_jobs(fake.projects[project], urllib.parse.parse_qs(url.query))
+
+            def body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def do_POST(self):
+                fake.requests.append(self.path)
+                path = urllib.parse.urlsplit(self.path).path.rstrip("/")
+                body = self.body()
+                if path == "/api/v4/runners":
+                    return self.reply(201, fake.register_runner())
+                if path == "/api/v4/runners/verify":
+                    return self.reply(200, {})
+                if path == "/api/v4/jobs/request":
+                    job = fake.next_job(json.loads(body or b"{}").get("token"))
+                    return self.reply(201, job) if job else self.reply(204, None)
+                self.reply(404, {"message": "404 Not Found"})
+
+            def do_DELETE(self):
+                fake.requests.append(self.path)
+                self.body()
+                self.reply(204, None)
+
+            def do_PUT(self):
+                fake.requests.append(self.path)
+                job_id = self.job_id()
+                if job_id not in fake.jobs:
+                    return self.reply(404, {"message": "404 Not Found"})
+                fake.update_job(job_id, json.loads(self.body() or b"{}"))
+                self.reply(200, {}, {"Job-Status": fake.jobs[job_id]["state"]})
+
+            def do_PATCH(self):
+                job_id = self.job_id()
+                if job_id not in fake.jobs:
+                    return self.reply(404, {"message": "404 Not Found"})
+                job = fake.jobs[job_id]
+                job["trace"] += self.body()
+                self.reply(202, None, {
+                    "Job-Status": job["state"],
+                    "Range": f"0-{len(job['trace'])}",
+                    "X-GitLab-Trace-Update-Interval": "3",
+                })
+
+            def job_id(self):
+                parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+                return int(parts[3]) if parts[:3] == ["api", "v4", "jobs"] and len(parts) > 3 else None
+
+            def list_jobs(self, jobs, query):
+                scopes = query.get("scope[]")
+                if scopes:
+                    jobs = [job for job in jobs if job["status"] in scopes]
+                per_page = int(query.get("per_page", ["20"])[0])
+                page = int(query.get("page", ["1"])[0])
+                start = (page - 1) * per_page
+                next_page = str(page + 1) if start + per_page < len(jobs) else ""
+                self.reply(200, jobs[start:start + per_page], {"X-Next-Page": next_page})
+
+            def reply(self, code, body, headers=None):
+                payload = json.dumps(body).encode() if body is not None else b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+
+    def register_runner(self):
+        with self.lock:
+            runner_id = len(self.runners) + 1
+            token = f"fake-runner-token-{runner_id}"
+            self.runners[token] = {"id": runner_id, "registered_at": time.monotonic()}
+        return {"id": runner_id, "token": token}
+
+    def add_job(self, script=("echo ok",), variables=None):
+        """Queue a job running the script lines, return its id."""
+        job_id = next(self.job_ids)
+        self.jobs[job_id] = {
+            "id": job_id,
+            "script": list(script),
+            "variables": dict(variables or {}),
+            "state": "pending",
+            "queued_at": time.monotonic(),
+            "picked_at": None,
+            "finished_at": None,
+            "runner": None,
+            "trace": b"",
+        }
+        self.queue.append(job_id)
+        return job_id
+
+    def next_job(self, runner_token):
+        """Payload of the next queued job for the runner, None when the queue is empty."""
+        with self.lock:
+            if runner_token not in self.runners or not self.queue:
+                return None
+            job = self.jobs[self.queue.popleft()]
+            job.update(state="running", picked_at=time.monotonic(), runner=runner_token)
+        variables = {
+            "CI_JOB_ID": str(job["id"]),
+            "CI_JOB_NAME": "load-test",
+            "CI_JOB_URL": f"{self.url}/load-test/load-test/-/jobs/{job['id']}",
+            "CI_PIPELINE_ID": "1",
+            "CI_PROJECT_ID": "1",
+            "CI_PROJECT_PATH": "load-test/load-test",
+            "CI_SERVER_URL": self.url,
+            "GIT_STRATEGY": "none",
+            **job["variables"],
+        }
+        return {
+            "id": job["id"],
+            "token": f"fake-job-token-{job['id']}",
+            "allow_git_fetch": False,
+            "job_info": {"id": job["id"], "name": "load-test", "stage": "test",
+                         "project_id": 1, "project_name": "load-test"},
+            "git_info": {"repo_url": f"{self.url}/load-test/load-test.git", "ref": "main",
+                         "sha": "0" * 40, "before_sha": "0" * 40, "ref_type": "branch",
+                         "refspecs": [], "depth": 1},
+            "runner_info": {"timeout": 3600},
+            "variables": [{"key": key, "value": value, "public": True, "masked": False}
+                          for key, value in variables.items()],
+            "steps": [{"name": "script", "script": job["script"], "timeout": 3600,
+                       "when": "on_success", "allow_failure": False}],
+            "image": {"name": ""},
+            "services": [],
+            "artifacts": [],
+            "cache": [],
+            "credentials": [],
+            "dependencies": [],
+            "features": {"trace_sections": True},
+        }
+
+    def update_job(self, job_id, update):
+        job = self.jobs[job_id]
+        if update.get("state") in ("success", "failed") and job["finished_at"] is None:
+            job.update(state=update["state"], finished_at=time.monotonic())
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
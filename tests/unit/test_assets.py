@@ -0,0 +1,105 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import os
+
+import pytest
+
+from gitlab_ci_fargate_runner import assets
+
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+
+def make_images(tmp_path):
+    write(str(tmp_path / "docker_images" / "python" / "Dockerfile"), "FROM python")
+    write(str(tmp_path / "docker_images" / "nodejs" / "Dockerfile"), "FROM node")
+    write(str(tmp_path / "docker_images" / "common" / "docker-entrypoint.sh"), "exec sshd")
+    return str(tmp_path / "docker_images")
+
+
+def test_list_files_skips_excluded_entries(tmp_path):
+    directory = make_images(tmp_path)
+    assert assets.list_files(directory, ["nodejs"]) == [
+        os.path.join("common", "docker-entrypoint.sh"),
+        os.path.join("python", "Dockerfile"),
+    ]
+
+
+def test_source_hash_changes_with_content_and_build_args(tmp_path):
+    directory = make_images(tmp_path)
+    files = assets.list_files(directory, ["nodejs"])
+    digest = assets.source_hash(directory, files, {"GITLAB_RUNNER_VERSION": "14.5.1"})
+
+    assert digest == assets.source_hash(directory, files, {"GITLAB_RUNNER_VERSION": "14.5.1"})
+    assert digest != assets.source_hash(directory, files, {"GITLAB_RUNNER_VERSION": "14.6.0"})
+    write(str(tmp_path / "docker_images" / "python" / "Dockerfile"), "FROM python:slim")
+    assert digest != assets.source_hash(directory, files, {"GITLAB_RUNNER_VERSION": "14.5.1"})
+
+
+def test_excluded_changes_keep_the_source_hash(tmp_path):
+    directory = make_images(tmp_path)
+    manifest = assets.AssetManifest(str(tmp_path / "manifest.json"))
+    digest, _ = manifest.source_hash("stack/python", directory, ["nodejs"])
+    write(str(tmp_path / "docker_images" / "nodejs" / "Dockerfile"), "FROM node:slim")
+    assert manifest.source_hash("stack/python", directory, ["nodejs"])[0] == digest
+
+
+def test_published_tag_requires_a_confirmed_entry(tmp_path):
+    directory = make_images(tmp_path)
+    path = str(tmp_path / "manifest.json")
+    manifest = assets.AssetManifest(path)
+    options = {"build_args": {}, "file": None}
+    digest, stats = manifest.source_hash("stack/python", directory, ["nodejs"])
+    manifest.record("stack/python", digest, stats, options, "abc123")
+
+    assert manifest.published_tag("stack/python", digest) is None
+    manifest.confirm(["stack"])
+    manifest = assets.AssetManifest(path)
+    assert manifest.published_tag("stack/python", digest) == "abc123"
+
+    # Unchanged files reuse the hash of the manifest without reading them
+    assert manifest.source_hash("stack/python", directory, ["nodejs"])[0] == digest
+    write(str(tmp_path / "docker_images" / "common" / "docker-entrypoint.sh"), "exec /usr/sbin/sshd -D")
+    changed, _ = manifest.source_hash("stack/python", directory, ["nodejs"])
+    assert manifest.published_tag("stack/python", changed) is None
+
+
+def test_confirm_only_the_deployed_stacks(tmp_path):
+    directory = make_images(tmp_path)
+    path = str(tmp_path / "manifest.json")
+    manifest = assets.AssetManifest(path)
+    options = {"build_args": {}, "file": None}
+    digest, stats = manifest.source_hash("stack/python", directory, ["nodejs"])
+    manifest.record("stack/python", digest, stats, options, "abc123")
+    manifest.record("other/python", digest, stats, options, "abc123")
+
+    manifest.confirm(["stack"])
+    manifest = assets.AssetManifest(path)
+    assert manifest.published_tag("stack/python", digest) == "abc123"
+    # Synthesized but not deployed, its image may not be published
+    assert manifest.published_tag("other/python", digest) is None
+
+
+def test_docker_architecture():
+    assert assets.docker_architecture("x86_64") == "amd64"
+    assert assets.docker_architecture("arm64") == "arm64"
+    with pytest.raises(ValueError):
+        assets.docker_architecture("aarch64")
@@ -0,0 +1,559 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import json
+import os
+import shutil
+import signal
+import subprocess
+import time
+
+import pytest
+
+from tests.fakes.aws_api import FakeAws
+
+DRIVER_DIR = os.path.join(
+    os.path.dirname(__file__), "..", "..", "gitlab_ci_fargate_runner", "docker_fargate_driver")
+CLUSTER = "fake-cluster"
+RUNNER_TASK_ARN = "arn:aws:ecs:us-east-1:123456789012:task/fake-cluster/runner"
+
+pytestmark = pytest.mark.skipif(shutil.which("aws") is None, reason="the AWS CLI is not installed")
+
+
+def write_aws_shim(directory, aws_url):
+    """aws command sending the ECS calls to the fake AWS endpoint."""
+    path = os.path.join(directory, "aws")
+    with open(path, "w") as shim:
+        shim.write(f'#!/bin/sh\nexec {shutil.which("aws")} --endpoint-url {aws_url} "$@"\n')
+    os.chmod(path, 0o755)
+
+
+def run_tasks_function(aws, tmp_path, script, **environment):
+    """Run a bash script sourcing fargate-tasks.sh, against the fake AWS endpoint."""
+    write_aws_shim(tmp_path, aws.url)
+    env = {
+        "PATH": f'{tmp_path}:{os.environ["PATH"]}',
+        "AWS_ACCESS_KEY_ID": "fake",
+        "AWS_SECRET_ACCESS_KEY": "fake",
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "FARGATE_REGION": "us-east-1",
+        "FARGATE_CLUSTER": CLUSTER,
+        "TASK_ARN": RUNNER_TASK_ARN,
+        "RUNNER_STATE_DIR": str(tmp_path / "state"),
+        "METRICS_LOG": str(tmp_path / "metrics.log"),
+        **environment,
+    }
+    return subprocess.run(
+        ["bash", "-c", f'source {DRIVER_DIR}/metrics.sh; source {DRIVER_DIR}/fargate-tasks.sh; {script}'],
+        env=env, capture_output=True, text=True, timeout=120)
+
+
+def install_scripts(tmp_path):
+    """Copy the driver scripts to tmp_path/bin, calling each other there instead of in /usr/local/bin."""
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir(exist_ok=True)
+    for name in os.listdir(DRIVER_DIR):
+        if name.endswith(".sh"):
+            with open(os.path.join(DRIVER_DIR, name)) as script:
+                (bin_dir / name).write_text(script.read().replace("/usr/local/bin/", f"{bin_dir}/"))
+            (bin_dir / name).chmod(0o755)
+    return bin_dir
+
+
+def write_functions(tmp_path, name, main):
+    """Functions of a driver script, up to the line starting its main code."""
+    functions = (install_scripts(tmp_path) / name).read_text().split(f"\n{main}", 1)[0]
+    path = tmp_path / f"functions-{name}"
+    path.write_text(functions)
+    return path
+
+
+def write_entrypoint_functions(tmp_path):
+    """Functions of docker-entrypoint.sh and its handlers, without the bootstrap between them."""
+    path = write_functions(tmp_path, "docker-entrypoint.sh", "bootstrap_started_at=")
+    script = (tmp_path / "bin" / "docker-entrypoint.sh").read_text()
+    handlers = script.split("\n## Pre execution handler", 1)[1].split("\n## Setup signal trap", 1)[0]
+    with open(path, "a") as functions:
+        functions.write(handlers)
+    return path
+
+
+def write_driver_functions(tmp_path):
+    return write_functions(tmp_path, "fargate-driver.sh", 'args=("$@")')
+
+
+def start_task(aws, started_by, coordinator=None, state=None, last_status=None):
+    """Add a running task to the fake cluster, return its ARN."""
+    tags = []
+    if coordinator:
+        tags.append({"key": "gitlab-runner:coordinator", "value": coordinator})
+    if state:
+        tags.append({"key": "gitlab-runner:state", "value": state})
+    task = aws.runtask({
+        "taskDefinition": "python",
+        "startedBy": started_by,
+        "networkConfiguration": {"awsvpcConfiguration": {"subnets": ["subnet-a"]}},
+        "tags": tags,
+    })["tasks"][0]
+    if last_status:
+        aws.tasks[task["taskArn"]]["lastStatus"] = last_status
+    return task["taskArn"]
+
+
+def stopped(aws, task_arn):
+    return aws.tasks[task_arn].get("stopped", False)
+
+
+def test_orphaned_warm_tasks_stopped(tmp_path):
+    with FakeAws() as aws:
+        draining = start_task(aws, "ecs-svc", last_status="STOPPING")
+        gone = RUNNER_TASK_ARN + "-gone"
+        own = start_task(aws, "warm-pool", coordinator=RUNNER_TASK_ARN)
+        of_draining = start_task(aws, "warm-pool", coordinator=draining)
+        orphaned = start_task(aws, "warm-pool", coordinator=gone)
+        claimed = start_task(aws, "warm-pool", coordinator=gone, state="claimed")
+
+        result = run_tasks_function(aws, tmp_path, "stop_orphaned_ci_tasks warm-pool")
+
+        assert result.returncode == 0, result.stderr
+        assert stopped(aws, orphaned)
+        assert not stopped(aws, own)
+        assert not stopped(aws, of_draining)
+        assert not stopped(aws, claimed)
+        assert not stopped(aws, draining)
+
+
+def test_claimed_task_tagged(tmp_path):
+    with FakeAws() as aws:
+        task = start_task(aws, "warm-pool", coordinator=RUNNER_TASK_ARN)
+
+        result = run_tasks_function(aws, tmp_path, f"tag_ci_task {task} claimed")
+
+        assert result.returncode == 0, result.stderr
+        assert {"key": "gitlab-runner:state", "value": "claimed"} in aws.tasks[task]["tags"]
+
+
+def test_orphaned_idle_tasks_stopped(tmp_path):
+    with FakeAws() as aws:
+        draining = start_task(aws, "ecs-svc", last_status="DEACTIVATING")
+        gone = RUNNER_TASK_ARN + "-gone"
+        # More tasks than a DescribeTasks call accepts
+        running_jobs = [start_task(aws, "gitlab-runner", coordinator=draining) for _ in range(100)]
+        idle_of_draining = start_task(aws, "gitlab-runner", coordinator=draining, state="idle")
+        claimed = start_task(aws, "gitlab-runner", coordinator=gone, state="claimed")
+        orphaned = [start_task(aws, "gitlab-runner", coordinator=gone, state="idle") for _ in range(2)]
+
+        result = run_tasks_function(aws, tmp_path, "stop_orphaned_ci_tasks gitlab-runner idle")
+
+        assert result.returncode == 0, result.stderr
+        assert all(stopped(aws, task) for task in orphaned)
+        assert not any(stopped(aws, task) for task in running_jobs)
+        assert not stopped(aws, idle_of_draining)
+        assert not stopped(aws, claimed)
+
+
+def write_idle_task(tmp_path, task_arn, idle_since):
+    entry = tmp_path / "state" / "task-reuse" / "7-100" / "python" / task_arn.rsplit("/", 1)[1]
+    entry.mkdir(parents=True)
+    (entry / "task.json").write_text(json.dumps(
+        {"task_arn": task_arn, "task_definition": "python", "jobs": 1, "idle_since": idle_since}))
+    return entry
+
+
+@pytest.mark.parametrize("size,family", [
+    ("", "python"), ("medium", "python"), ("large", "python-large"), ("huge", None)])
+def test_task_size_selected(tmp_path, size, family):
+    functions = write_driver_functions(tmp_path)
+    result = subprocess.run(
+        ["bash", "-c", f'source {functions}; select_task_size; echo "${{CUSTOM_ENV_FARGATE_TASK_DEFINITION:-python}}"'],
+        env={**os.environ, "RUNNER_STATE_DIR": str(tmp_path / "state"), "BUILD_FAILURE_EXIT_CODE": "3",
+             "RUNNER_IMAGE": "python", "FARGATE_TASK_DEFINITION": "python", "FARGATE_DEFAULT_TASK_SIZE": "medium",
+             "FARGATE_TASK_SIZES": "small,medium,large", "CUSTOM_ENV_FARGATE_TASK_SIZE": size},
+        capture_output=True, text=True, timeout=60)
+
+    if family:
+        assert result.returncode == 0, result.stderr
+        assert result.stdout.strip() == family
+    else:
+        assert result.returncode == 3
+        assert "Unknown FARGATE_TASK_SIZE huge, the sizes of python are: small,medium,large" in result.stderr
+
+
+def run_sticky_function(aws, tmp_path, script, **environment):
+    functions = write_driver_functions(tmp_path)
+    # The SSH server of the idle task is reachable
+    return run_tasks_function(
+        aws, tmp_path, f"source {functions}; wait_ci_task_ssh() {{ return 0; }}; {script}",
+        TASK_REUSE_IDLE_TIMEOUT="300", CUSTOM_ENV_CI_PROJECT_ID="7", CUSTOM_ENV_CI_PIPELINE_ID="100",
+        CUSTOM_ENV_CI_JOB_ID="43", **environment)
+
+
+def test_sticky_task_claimed_and_released(tmp_path):
+    with FakeAws() as aws:
+        task = start_task(aws, "gitlab-runner", coordinator=RUNNER_TASK_ARN, state="idle")
+        entry = write_idle_task(tmp_path, task, int(time.time()) - 10)
+        job_dir = tmp_path / "state" / "jobs" / "43"
+
+        result = run_sticky_function(aws, tmp_path, "claim_sticky_task python")
+
+        assert result.returncode == 0, result.stderr
+        assert not entry.exists()
+        assert json.loads((job_dir / "task.json").read_text())["jobs"] == 2
+        assert {"key": "gitlab-runner:state", "value": "claimed"} in aws.tasks[task]["tags"]
+
+        result = run_sticky_function(aws, tmp_path, "release_sticky_task")
+
+        assert result.returncode == 0, result.stderr
+        assert not job_dir.exists()
+        released = entry.parent / "43" / "task.json"
+        assert json.loads(released.read_text())["idle_since"] >= int(time.time()) - 60
+        assert {"key": "gitlab-runner:state", "value": "idle"} in aws.tasks[task]["tags"]
+
+
+@pytest.mark.parametrize("reason,jobs", [("draining", 1), ("failed", 1), (None, 5)],
+                         ids=["draining", "failed", "max_jobs"])
+def test_sticky_task_not_released(tmp_path, reason, jobs):
+    with FakeAws() as aws:
+        task = start_task(aws, "gitlab-runner", coordinator=RUNNER_TASK_ARN, state="claimed")
+        job_dir = tmp_path / "state" / "jobs" / "43"
+        job_dir.mkdir(parents=True)
+        (job_dir / "task.json").write_text(json.dumps(
+            {"task_arn": task, "task_definition": "python", "jobs": jobs}))
+        if reason == "draining":
+            (tmp_path / "state" / "draining").touch()
+        elif reason == "failed":
+            (job_dir / "failed").touch()
+
+        result = run_sticky_function(aws, tmp_path, "release_sticky_task", TASK_REUSE_MAX_JOBS="5")
+
+        assert result.returncode == 1
+        assert (job_dir / "task.json").exists()
+        assert {"key": "gitlab-runner:state", "value": "claimed"} in aws.tasks[task]["tags"]
+
+
+def test_idle_tasks_expired_and_drained(tmp_path):
+    with FakeAws() as aws:
+        expired = start_task(aws, "gitlab-runner", coordinator=RUNNER_TASK_ARN, state="idle")
+        waiting = start_task(aws, "gitlab-runner", coordinator=RUNNER_TASK_ARN, state="idle")
+        expired_entry = write_idle_task(tmp_path, expired, int(time.time()) - 600)
+        waiting_entry = write_idle_task(tmp_path, waiting, int(time.time()))
+        write_aws_shim(tmp_path, aws.url)
+
+        env = {
+            "PATH": f'{tmp_path}:{os.environ["PATH"]}',
+            "AWS_ACCESS_KEY_ID": "fake",
+            "AWS_SECRET_ACCESS_KEY": "fake",
+            "FARGATE_REGION": "us-east-1",
+            "FARGATE_CLUSTER": CLUSTER,
+            "TASK_ARN": RUNNER_TASK_ARN,
+            "RUNNER_STATE_DIR": str(tmp_path / "state"),
+            "TASK_REUSE_IDLE_TIMEOUT": "300",
+            "TASK_REUSE_INTERVAL": "0.2",
+        }
+        process = subprocess.Popen(["bash", f"{DRIVER_DIR}/task-reuse.sh"], env=env)
+        try:
+            deadline = time.monotonic() + 60
+            while not stopped(aws, expired) and time.monotonic() < deadline:
+                time.sleep(0.2)
+            assert stopped(aws, expired) and not expired_entry.exists()
+            assert not stopped(aws, waiting) and waiting_entry.exists()
+
+            process.send_signal(signal.SIGTERM)
+            assert process.wait(timeout=60) == 0
+        finally:
+            process.kill()
+        assert stopped(aws, waiting) and not waiting_entry.exists()
+
+
+def write_active_job(tmp_path, task_arn):
+    active_jobs = tmp_path / "state" / "active-jobs"
+    active_jobs.mkdir(parents=True)
+    (active_jobs / "42.json").write_text(json.dumps({
+        "job_id": 42, "project_id": 7, "pipeline_id": 100, "image": "python",
+        "job_url": "https://gitlab.example.com/group/project/-/jobs/42", "task_arn": task_arn,
+    }))
+
+
+# gitlab-runner stand-ins, the first one finishes its jobs on SIGQUIT. They
+# touch their first argument once the signal is handled.
+RUNNER_DRAINED = ("import pathlib, signal, sys, time; signal.signal(signal.SIGQUIT, lambda *_: sys.exit(0)); "
+                  "pathlib.Path(sys.argv[1]).touch(); time.sleep(60)")
+RUNNER_STUCK = ("import pathlib, signal, sys, time; signal.signal(signal.SIGQUIT, signal.SIG_IGN); "
+                "pathlib.Path(sys.argv[1]).touch(); time.sleep(60)")
+
+
+@pytest.mark.parametrize("runner,interrupted", [(RUNNER_DRAINED, False), (RUNNER_STUCK, True)],
+                         ids=["drained", "interrupted"])
+def test_runner_drained(tmp_path, runner, interrupted):
+    with FakeAws() as aws:
+        task = start_task(aws, "gitlab-runner", coordinator=RUNNER_TASK_ARN)
+        write_active_job(tmp_path, task)
+        functions = write_entrypoint_functions(tmp_path)
+
+        result = run_tasks_function(
+            aws, tmp_path,
+            f'source {functions}; python3 -c "{runner}" {tmp_path}/ready & pid=$!; '
+            f'until [ -f {tmp_path}/ready ]; do sleep 0.1; done; '
+            'drain_runner; wait "${pid}"; echo "runner exited with $?"',
+            DRAIN_TIMEOUT="1", DRAIN_REPORT_TIMEOUT="1")
+
+        assert result.returncode == 0, result.stderr
+        assert (tmp_path / "state" / "draining").exists()
+        assert ("Interrupting job 42 of project 7" in result.stdout) == interrupted
+        assert stopped(aws, task) == interrupted
+        metrics = (tmp_path / "metrics.log").read_text() if interrupted else ""
+        assert ('"InterruptedJobs":1' in metrics) == interrupted
+        assert ("runner exited with 0" in result.stdout) != interrupted
+
+
+def lease(aws, slot):
+    item = aws.items["leases"].get(json.dumps({"S": slot}))
+    return item and item["owner"]["S"]
+
+
+def run_token_function(aws, tmp_path, script, **environment):
+    functions = write_entrypoint_functions(tmp_path)
+    return run_tasks_function(
+        aws, tmp_path, f"source {functions}; {script}",
+        **{"CLUSTER_ARN": CLUSTER, "RUNNER_TOKEN_LEASE_TABLE": "leases",
+           "RUNNER_TOKEN_SECRETS": "slot-0,slot-1,slot-2", "RUNNER_TOKEN_CLAIM_TIMEOUT": "0", **environment})
+
+
+def set_lease(aws, slot, owner):
+    aws.items["leases"][json.dumps({"S": slot})] = {"slot": {"S": slot}, "owner": {"S": owner}}
+
+
+def test_runner_tokens_leased(tmp_path):
+    with FakeAws(table_keys={"leases": "slot"}) as aws:
+        draining = start_task(aws, "ecs-svc", last_status="STOPPING")
+        stopped_runner = start_task(aws, "ecs-svc")
+        aws.tasks[stopped_runner]["stopped"] = True
+        set_lease(aws, "slot-0", draining)
+        set_lease(aws, "slot-1", stopped_runner)
+        aws.secrets["slot-1"] = '{"python": "glrt-1"}'
+
+        result = run_token_function(
+            aws, tmp_path, 'claim_runner_tokens && echo "${token_slot} ${runner_tokens}"')
+
+        assert result.returncode == 0, result.stderr
+        assert 'slot-1 {"python": "glrt-1"}' in result.stdout
+        assert lease(aws, "slot-0") == draining
+        assert lease(aws, "slot-1") == RUNNER_TASK_ARN
+        assert lease(aws, "slot-2") is None
+
+
+def test_runner_tokens_not_leased(tmp_path):
+    with FakeAws(table_keys={"leases": "slot"}) as aws:
+        runners = [start_task(aws, "ecs-svc", last_status=status)
+                   for status in ("RUNNING", "STOPPING", "DEACTIVATING")]
+        for index, runner in enumerate(runners):
+            set_lease(aws, f"slot-{index}", runner)
+
+        result = run_token_function(aws, tmp_path, "claim_runner_tokens")
+
+        assert result.returncode == 1
+        assert "No free slot" in result.stderr
+        assert [lease(aws, f"slot-{index}") for index in range(3)] == runners
+
+
+def test_warm_pool_stopped_without_runner_tokens(tmp_path):
+    with FakeAws(table_keys={"leases": "slot"}) as aws:
+        set_lease(aws, "slot-0", start_task(aws, "ecs-svc"))
+        warm = start_task(aws, "warm-pool", coordinator=RUNNER_TASK_ARN)
+        entry = tmp_path / "state" / "warm-pool" / "python" / "ready"
+        entry.mkdir(parents=True)
+        (entry / "task.json").write_text(json.dumps({"task_arn": warm, "task_definition": "python"}))
+
+        result = run_token_function(
+            aws, tmp_path, "get_from_metadata() { :; }; bootstrap_started_at=$(date +%s%3N); pre_execution_handler",
+            RUNNER_TOKEN_SECRETS="slot-0", RUNNER_TOKEN_CLAIM_TIMEOUT="2", WARM_POOL_SIZE="1",
+            WARM_POOL_TASK_DEFINITIONS=" ", WARM_POOL_INTERVAL="0.2")
+
+        assert result.returncode == 1
+        assert "No free slot" in result.stderr
+        assert stopped(aws, warm)
+
+
+def test_runner_token_released(tmp_path):
+    with FakeAws(table_keys={"leases": "slot"}) as aws:
+        other = start_task(aws, "ecs-svc")
+        set_lease(aws, "slot-0", RUNNER_TASK_ARN)
+        set_lease(aws, "slot-1", other)
+
+        result = run_token_function(
+            aws, tmp_path, "token_slot=slot-0 release_token_slot && token_slot=slot-1 release_token_slot")
+
+        assert result.returncode != 0
+        assert lease(aws, "slot-0") is None
+        assert lease(aws, "slot-1") == other
+
+
+def run_driver_function(tmp_path, script, **environment):
+    """Run a bash script sourcing the functions of fargate-driver.sh, without AWS calls."""
+    functions = write_driver_functions(tmp_path)
+    env = {
+        "PATH": os.environ["PATH"],
+        "RUNNER_STATE_DIR": str(tmp_path / "state"),
+        "METRICS_LOG": str(tmp_path / "metrics.log"),
+        **environment,
+    }
+    return subprocess.Popen(
+        ["bash", "-c", f"source {functions}; {script}"],
+        env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def read_metrics(tmp_path):
+    with open(tmp_path / "metrics.log") as log:
+        return [json.loads(line) for line in log]
+
+
+@pytest.mark.parametrize("stage,exit_code,step", [("prepare", 0, "prepare"), ("run", 1, "get_sources")])
+def test_stage_metrics_emitted(tmp_path, stage, exit_code, step):
+    process = run_driver_function(
+        tmp_path,
+        f'stage={stage}; stage_args=(script get_sources); stage_started_at=$(($(date +%s%3N) - 1500)); '
+        f'emit_stage_metrics {exit_code}',
+        task_arn=RUNNER_TASK_ARN, RUNNER_IMAGE="python", FARGATE_TASK_DEFINITION="python",
+        CUSTOM_ENV_CI_JOB_ID="42", CUSTOM_ENV_CI_PROJECT_ID="7", CUSTOM_ENV_CI_PIPELINE_ID="100")
+    assert process.wait(timeout=60) == 0, process.stderr.read()
+
+    [record] = read_metrics(tmp_path)
+    [directive] = record["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "GitlabRunner"
+    assert directive["Dimensions"] == [["Stage", "Image"], ["Step", "Image"], ["Stage"]]
+    assert directive["Metrics"] == [
+        {"Name": "StageDuration", "Unit": "Milliseconds"}, {"Name": "StageFailed", "Unit": "Count"}]
+    # CloudWatch drops the records missing a member of their dimensions
+    assert {"Stage": stage, "Step": step, "Image": "python"}.items() <= record.items()
+    assert record["TaskArn"] == RUNNER_TASK_ARN
+    assert (record["JobId"], record["ProjectId"], record["PipelineId"]) == ("42", "7", "100")
+    assert record["ExitCode"] == exit_code
+    assert record["StageFailed"] == (exit_code != 0)
+    assert 1500 <= record["StageDuration"] < 60000
+
+
+def test_first_job_metrics_emitted_once(tmp_path):
+    state = tmp_path / "state"
+    state.mkdir()
+    (state / "bootstrap_started_at").write_text("1700000000000")
+
+    process = run_driver_function(
+        tmp_path, "stage_started_at=1700000012500; emit_first_job_metrics && emit_first_job_metrics",
+        RUNNER_IMAGE="python", CUSTOM_ENV_CI_JOB_ID="42")
+    assert process.wait(timeout=60) == 0, process.stderr.read()
+
+    [record] = read_metrics(tmp_path)
+    assert record["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Image"]]
+    assert (record["Image"], record["JobId"], record["TimeToFirstJob"]) == ("python", "42", 12500)
+
+
+# Stand-in of the wrapped driver, exits with 3 on SIGTERM. It touches its first
+# argument once the signal handler is set, and its second one on SIGTERM.
+DRIVER_CANCELED = ("import pathlib, signal, sys, time; "
+                   "signal.signal(signal.SIGTERM, lambda *_: (pathlib.Path(sys.argv[2]).touch(), sys.exit(3))); "
+                   "pathlib.Path(sys.argv[1]).touch(); time.sleep(60)")
+
+
+def test_signals_forwarded(tmp_path):
+    process = run_driver_function(
+        tmp_path, f'forward_signals python3 -c "{DRIVER_CANCELED}" {tmp_path}/ready {tmp_path}/terminated; '
+        'echo "driver exited with $?"')
+    deadline = time.monotonic() + 30
+    while not (tmp_path / "ready").exists() and time.monotonic() < deadline:
+        time.sleep(0.1)
+
+    process.send_signal(signal.SIGTERM)
+    stdout, stderr = process.communicate(timeout=30)
+
+    assert process.returncode == 0, stderr
+    assert (tmp_path / "terminated").exists()
+    assert "driver exited with 3" in stdout
+
+
+# restore_cache script of gitlab-runner 14.5.1 restoring two caches, the
+# messages are printed by the script itself
+RESTORE_CACHE_SCRIPT = r"""
+for key in default missing; do
+  echo $'\x1b[32;1mChecking cache for '"${key}"$'...\x1b[0;m'
+  if 'gitlab-runner-helper' 'cache-extractor' '--file' "../cache/${key}/cache.zip" '--timeout' '10'; then
+    echo $'\x1b[32;1mSuccessfully extracted cache\x1b[0;m'
+  else
+    echo $'\x1b[0;33mWARNING: Failed to extract cache\x1b[0;m'
+  fi
+done
+"""
+
+
+@pytest.mark.parametrize("script,hits,misses,warning", [
+    (RESTORE_CACHE_SCRIPT, 1, 1, False),
+    (RESTORE_CACHE_SCRIPT.replace("extracted cache", "restored cache"), None, None, True),
+    ("echo 'No cache to restore'", None, None, False),
+], ids=["runner", "other-runner", "no-cache"])
+def test_cache_metrics_emitted(tmp_path, script, hits, misses, warning):
+    (tmp_path / "restore_cache").write_text(script)
+    # Cache extractor stand-in, the missing key is not in the bucket
+    helper = tmp_path / "gitlab-runner-helper"
+    helper.write_text('#!/bin/sh\n[ "$3" != "../cache/missing/cache.zip" ]\n')
+    helper.chmod(0o755)
+    (tmp_path / "metrics.log").touch()
+
+    process = run_driver_function(
+        tmp_path, f'capture_cache_output {tmp_path}/restore_cache; bash {tmp_path}/restore_cache; '
+        '[ -z "${cache_log}" ] || emit_cache_metrics',
+        PATH=f'{tmp_path}:{os.environ["PATH"]}', RUNNER_IMAGE="python", CUSTOM_ENV_CI_JOB_ID="42",
+        CUSTOM_ENV_CI_PROJECT_ID="7")
+    stdout, stderr = process.communicate(timeout=60)
+
+    assert process.returncode == 0, stderr
+    # The output of the step still reaches the runner
+    assert stdout.count("Checking cache for") == script.count("Checking cache for") * 2
+    assert ("Unknown cache messages" in stderr) == warning
+    records = read_metrics(tmp_path)
+    if hits is None:
+        assert records == []
+    else:
+        [record] = records
+        assert record["_aws"]["CloudWatchMetrics"][0]["Dimensions"] == [["Image"]]
+        assert (record["Image"], record["CacheHits"], record["CacheMisses"]) == ("python", hits, misses)
+
+
+# ssh stand-ins: the login shell of the task runs the command, or the
+# connection fails
+SSH_CONNECTED = 'ssh_ci_task() { shift 2; sh -c "$*"; }'
+SSH_FAILED = "ssh_ci_task() { cat >/dev/null; return 255; }"
+
+
+@pytest.mark.parametrize("ssh,script,code", [
+    (SSH_CONNECTED, "true", 0),
+    (SSH_CONNECTED, "exit 2", 1),
+    (SSH_CONNECTED, "exit 255", 1),
+    (SSH_FAILED, "true", 2),
+], ids=["succeeded", "failed", "failed-255", "ssh-failed"])
+def test_job_script_exit_code(tmp_path, ssh, script, code):
+    job = tmp_path / "state" / "jobs" / "42"
+    job.mkdir(parents=True)
+    (job / "task.json").write_text(json.dumps({"task_arn": RUNNER_TASK_ARN, "ip": "10.0.0.1"}))
+    (tmp_path / "script").write_text(f"echo running\n{script}\n")
+
+    process = run_driver_function(
+        tmp_path, f"{ssh}; run_job_script {tmp_path}/script",
+        CUSTOM_ENV_CI_JOB_ID="42", BUILD_FAILURE_EXIT_CODE="1", SYSTEM_FAILURE_EXIT_CODE="2")
+    stdout, stderr = process.communicate(timeout=60)
+
+    assert process.returncode == code, stderr
+    assert ("running" in stdout) == (ssh == SSH_CONNECTED)
+    assert (job / "failed").exists() == (code != 0)
@@ -19,6 +19,7 @@ import json
 import sys
 import yaml
 import os
+import pytest
 import aws_cdk as cdk
 from aws_cdk import Stack
 from aws_cdk import assertions
@@ -26,8 +27,10 @@ from aws_cdk import assertions
 from gitlab_ci_fargate_runner.gitlab_ci_fargate_runner_stack import (
     GitlabCiFargateRunnerStack,
 )
+from gitlab_ci_fargate_runner.log_configuration import log_retention
 from task_definitions.task_definition_stack import (
     TaskDefinitionStack,
+    sidecar_sets,
 )
 
 
@@ -51,6 +54,23 @@ def get_bastion_stack():
     )
     return json.dumps(assertions.Template.from_stack(stack).to_json())
 
+def synth_bastion_stack(**overrides):
+    """Template of the runner stack, with some settings of bastion overridden."""
+    app = cdk.App()
+    stack = GitlabCiFargateRunnerStack(
+        app, "GitlabrunnerBastionStack", env=env, props={**props.get("bastion"), **overrides}
+    )
+    return assertions.Template.from_stack(stack)
+
+def synth_task_definition_stack(**overrides):
+    """Template of the task definition stack, with some settings of task_definition overridden."""
+    app = cdk.App()
+    task_definition_props = {**props.get("task_definition"), **overrides}
+    stack = TaskDefinitionStack(
+        app, f"{task_definition_props['docker_image_name']}TaskDefinitionStack", env=env, props=task_definition_props
+    )
+    return assertions.Template.from_stack(stack)
+
 def get_task_definition_stack():
     app = cdk.App()
     stack = TaskDefinitionStack(
@@ -82,7 +102,9 @@ def test_SecurityGroup_created():
 
 
 def test_ecs_service_created():
-    assert "AWS::ECS::Service" in get_bastion_stack()
+    template = get_bastion_stack()
+    assert "AWS::ECS::Service" in template
+    assert '"DesiredCount": 1' in template
 
 
 def test_ecs_cluster_created():
@@ -91,3 +113,398 @@ def test_ecs_cluster_created():
 
 def test_ecs_cluster_created():
     assert "AWS::ECS::TaskDefinition" in get_task_definition_stack()
+
+
+def test_queue_depth_autoscaling_created():
+    template = json.dumps(synth_bastion_stack(autoscaling={
+        "enabled": True,
+        "gitlab_api_token_secret_name": "GitlabApiToken",
+        "project_ids": [1],
+    }).to_json())
+    assert "AWS::ApplicationAutoScaling::ScalableTarget" in template
+    assert "AWS::ApplicationAutoScaling::ScalingPolicy" in template
+    assert "AWS::Lambda::Function" in template
+    assert '"DesiredCount"' not in template
+
+
+def test_queue_poller_runner_tags_passed():
+    template = synth_bastion_stack(
+        autoscaling={"enabled": True, "gitlab_api_token_secret_name": "GitlabApiToken", "project_ids": [1]},
+        runner_images=[
+            {"name": "python", "task_definition": "python", "tags": "python, py"},
+            {"name": "debian", "task_definition": "debian"},
+        ],
+    )
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Environment": {"Variables": assertions.Match.object_like({
+            "RUNNER_TAG_LIST": json.dumps([["python", "py"], []]),
+        })},
+    })
+
+
+def test_task_definition_sizes_created():
+    template = synth_task_definition_stack(default_size="small", sizes={
+        "small": {"cpu": "256", "memory": "512"},
+        "large": {"cpu": "2048", "memory": "4096", "ephemeral_storage": 50},
+    })
+    template.resource_count_is("AWS::ECS::TaskDefinition", 2)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": f"{props['task_definition']['docker_image_name']}-large",
+        "EphemeralStorage": {"SizeInGiB": 50},
+    })
+
+
+def test_vpc_endpoints_created():
+    template = synth_bastion_stack(vpc_endpoints=True)
+    template.resource_count_is("AWS::EC2::VPCEndpoint", 6)
+    template.has_resource_properties("AWS::EC2::VPCEndpoint", {
+        "VpcEndpointType": "Gateway",
+    })
+
+
+def test_cache_bucket_lifecycle_created():
+    template = synth_bastion_stack()
+    template.has_resource_properties("AWS::S3::Bucket", {
+        "LifecycleConfiguration": {
+            "Rules": assertions.Match.array_with([
+                assertions.Match.object_like({"ExpirationInDays": 30}),
+            ]),
+        },
+    })
+
+
+def test_efs_workspace_created():
+    template = synth_task_definition_stack(
+        VpcId=props["bastion"]["VpcId"], efs={"enabled": True, "projects": [42]})
+    template.resource_count_is("AWS::EFS::FileSystem", 1)
+    template.resource_count_is("AWS::EFS::AccessPoint", 2)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": f"{props['task_definition']['docker_image_name']}-project-42",
+    })
+
+
+def test_git_bundles_schedule_created():
+    template = synth_bastion_stack(git_bundles={
+        "enabled": True,
+        "gitlab_api_token_secret_name": "GitlabApiToken",
+        "repositories": ["group/monorepo"],
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-git-bundles",
+    })
+    template.has_resource_properties("AWS::Events::Rule", {
+        "ScheduleExpression": "rate(1 hour)",
+    })
+
+
+def test_arm64_task_definition_created():
+    template = synth_task_definition_stack(architecture="arm64")
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "RuntimePlatform": {
+            "CpuArchitecture": "ARM64",
+            "OperatingSystemFamily": "LINUX",
+        },
+    })
+
+
+def test_on_demand_coordinator_drained():
+    template = synth_bastion_stack(
+        capacity_strategy="on_demand_coordinator", drain={"timeout": 90, "report_timeout": 15})
+    template.has_resource_properties("AWS::ECS::Service", {
+        "CapacityProviderStrategy": [{"CapacityProvider": "FARGATE", "Weight": 1}],
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-runner",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "StopTimeout": 120,
+            "Environment": assertions.Match.array_with([
+                {"Name": "DRAIN_TIMEOUT", "Value": "90"},
+                {"Name": "DRAIN_REPORT_TIMEOUT", "Value": "15"},
+            ]),
+        })],
+    })
+
+
+def test_runner_tokens_leased():
+    template = synth_bastion_stack(desired_count=2, runner_tokens={
+        "enabled": True,
+        "secret_names": ["GitlabRunnerSlot0", "GitlabRunnerSlot1"],
+    })
+    template.resource_count_is("AWS::DynamoDB::Table", 1)
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-runner",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "RUNNER_TOKEN_SECRETS", "Value": "GitlabRunnerSlot0,GitlabRunnerSlot1"},
+            ]),
+        })],
+    })
+
+
+def test_runner_subnet_map_passed():
+    template = synth_bastion_stack()
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-runner",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                assertions.Match.object_like({"Name": "FARGATE_SUBNET_MAP"}),
+            ]),
+        })],
+    })
+
+
+def test_non_blocking_logs_created():
+    template = synth_task_definition_stack(
+        logging={"retention_days": 14, "max_buffer_size": "10m"})
+    template.has_resource_properties("AWS::Logs::LogGroup", {
+        "RetentionInDays": 14,
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "LogConfiguration": {
+                "LogDriver": "awslogs",
+                "Options": assertions.Match.object_like({
+                    "mode": "non-blocking",
+                    "max-buffer-size": "10m",
+                }),
+            },
+        })],
+    })
+
+
+def test_kaniko_cache_repository_created():
+    template = synth_task_definition_stack(
+        docker_image_name="kaniko",
+        VpcId=props["bastion"]["VpcId"],
+        efs={"enabled": True},
+        kaniko_cache={"base_images": ["python:3.9-slim"]},
+    )
+    template.has_resource_properties("AWS::ECR::Repository", {
+        "RepositoryName": "gitlab-runner/kaniko-cache",
+        "LifecyclePolicy": assertions.Match.any_value(),
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "kaniko",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "KANIKO_WARM_IMAGES", "Value": "python:3.9-slim"},
+            ]),
+        })],
+    })
+
+
+def test_task_lifecycle_events_recorded():
+    template = synth_bastion_stack(task_events={"enabled": True, "retention_days": 30})
+    template.has_resource_properties("AWS::Logs::LogGroup", {
+        "LogGroupName": "/aws/events/GitlabrunnerBastionStack/task-lifecycle",
+        "RetentionInDays": 30,
+    })
+    template.has_resource_properties("AWS::Events::Rule", {
+        "EventPattern": assertions.Match.object_like({
+            "source": ["aws.ecs"],
+            "detail-type": ["ECS Task State Change"],
+        }),
+    })
+
+
+def test_multi_subnet_placement_passed():
+    template = synth_bastion_stack(placement={"enabled": True, "strategy": "least_loaded"})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-runner",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "FARGATE_PLACEMENT", "Value": "least_loaded"},
+                {"Name": "FARGATE_CAPACITY_PROVIDERS", "Value": "FARGATE_SPOT,FARGATE"},
+            ]),
+        })],
+    })
+
+def test_warmed_images_build_scheduled():
+    template = synth_task_definition_stack(
+        VpcId=props["bastion"]["VpcId"],
+        gitlab_server=props["bastion"]["gitlab_server"],
+        warmed_images={
+            "enabled": True,
+            "gitlab_api_token_secret_name": "GitlabApiToken",
+            "projects": [{"name": "app", "project": "group/app", "files": ["requirements.txt"]}],
+        },
+    )
+    image_name = props["task_definition"]["docker_image_name"]
+    template.has_resource_properties("AWS::ECR::Repository", {
+        "RepositoryName": f"gitlab-runner/{image_name}-warmed",
+    })
+    template.has_resource_properties("AWS::CodeBuild::Project", {
+        "Environment": assertions.Match.object_like({
+            "PrivilegedMode": True,
+            "EnvironmentVariables": assertions.Match.array_with([
+                {"Name": "BASE_TASK_DEFINITION", "Type": "PLAINTEXT", "Value": image_name},
+                {"Name": "WARMED_PROJECTS", "Type": "PLAINTEXT", "Value": json.dumps([{
+                    "name": "app", "project": "group/app", "ref": "HEAD",
+                    "files": ["requirements.txt"],
+                }])},
+            ]),
+        }),
+    })
+    template.has_resource_properties("AWS::Events::Rule", {
+        "ScheduleExpression": "cron(0 2 * * ? *)",
+    })
+
+def test_ssh_host_key_secret_passed():
+    template = synth_task_definition_stack(ssh={
+        "host_keys": "secret",
+        "host_key_secret_name": "GitlabRunnerSshHostKey",
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": props["task_definition"]["docker_image_name"],
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": [{"Name": "SSH_HOST_KEYS", "Value": "secret"}],
+            "Secrets": [assertions.Match.object_like({"Name": "SSH_HOST_KEY"})],
+        })],
+    })
+
+def test_capacity_profiles_scheduled():
+    template = synth_bastion_stack(concurrent_jobs=4, capacity_profiles=[
+        {"name": "emea-morning", "schedule": "cron(0 7 ? * MON-FRI *)",
+         "timezone": "Europe/Paris", "desired_count": 3, "concurrent_jobs": 20},
+        {"name": "night", "schedule": "cron(0 20 * * ? *)", "desired_count": 1},
+    ])
+    template.has_resource_properties("AWS::ApplicationAutoScaling::ScalableTarget", {
+        "ScheduledActions": [
+            {
+                "ScheduledActionName": "GitlabrunnerBastionStack-emea-morning",
+                "Schedule": "cron(0 7 ? * MON-FRI *)",
+                "Timezone": "Europe/Paris",
+                "ScalableTargetAction": {"MinCapacity": 3, "MaxCapacity": 3},
+            },
+            assertions.Match.object_like({"ScheduledActionName": "GitlabrunnerBastionStack-night"}),
+        ],
+    })
+    template.has_resource_properties("AWS::ECS::Service", {
+        "DesiredCount": assertions.Match.absent(),
+    })
+    template.resource_count_is("AWS::Scheduler::Schedule", 1)
+    template.has_resource_properties("AWS::SSM::Parameter", {
+        "Name": "/GitlabrunnerBastionStack/runner/concurrent",
+        "Value": "4",
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "RUNNER_CONCURRENT", "Value": "4"},
+                {"Name": "RUNNER_CONCURRENT_PARAMETER",
+                 "Value": "/GitlabrunnerBastionStack/runner/concurrent"},
+            ]),
+        })],
+    })
+
+def test_sidecar_task_definition_created():
+    template = synth_task_definition_stack(sidecars={
+        "postgres": [{
+            "name": "postgres",
+            "image": "postgres:14-alpine",
+            "environment": {"POSTGRES_PASSWORD": "postgres"},
+            "health_check": "pg_isready -U postgres",
+            "cpu": 128,
+            "memory_reservation": 256,
+        }],
+    })
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": f'{props["task_definition"]["docker_image_name"]}-sidecars-postgres',
+        "ContainerDefinitions": [
+            assertions.Match.object_like({
+                "Name": "ci-coordinator",
+                "DependsOn": [{"ContainerName": "postgres", "Condition": "HEALTHY"}],
+            }),
+            assertions.Match.object_like({
+                "Name": "postgres",
+                "Essential": False,
+                "HealthCheck": assertions.Match.object_like(
+                    {"Command": ["CMD-SHELL", "pg_isready -U postgres"]}),
+                "Cpu": 128,
+                "MemoryReservation": 256,
+            }),
+        ],
+        "Tags": [{"Key": "gitlab-runner:sidecars", "Value": "postgres"}],
+    })
+
+def test_task_reuse_passed():
+    template = synth_bastion_stack(
+        task_reuse={"enabled": True, "idle_timeout": 300, "workspace": "clean"})
+    template.has_resource_properties("AWS::ECS::TaskDefinition", {
+        "Family": "gitlab-runner",
+        "ContainerDefinitions": [assertions.Match.object_like({
+            "Environment": assertions.Match.array_with([
+                {"Name": "TASK_REUSE_IDLE_TIMEOUT", "Value": "300"},
+                {"Name": "TASK_REUSE_MAX_JOBS", "Value": "5"},
+                {"Name": "TASK_REUSE_WORKSPACE", "Value": "clean"},
+            ]),
+        })],
+    })
+
+@pytest.mark.parametrize("drain", [
+    {"timeout": 0},
+    {"timeout": 120},
+    {"stop_timeout": 150},
+    {"timeout": 60, "stop_timeout": 60},
+    {"timeout": 101},
+    {"timeout": 90, "report_timeout": 25},
+    {"report_timeout": 0},
+])
+def test_drain_timeout_rejected(drain):
+    with pytest.raises(ValueError, match="drain timeout"):
+        synth_bastion_stack(drain=drain)
+
+@pytest.mark.parametrize("task_reuse,message", [
+    ({"max_jobs": 1}, "max_jobs"),
+    ({"idle_timeout": 0}, "idle_timeout"),
+    ({"idle_timeout": -60}, "idle_timeout"),
+    ({"workspace": "wipe"}, "workspace policy"),
+])
+def test_task_reuse_rejected(task_reuse, message):
+    with pytest.raises(ValueError, match=message):
+        GitlabCiFargateRunnerStack.task_reuse_environment(task_reuse)
+
+@pytest.mark.parametrize("placement,message", [
+    ({"strategy": "binpack"}, "placement strategy"),
+    ({"capacity_providers": ["FARGATE", "EC2"]}, "capacity provider"),
+])
+def test_placement_rejected(placement, message):
+    with pytest.raises(ValueError, match=message):
+        GitlabCiFargateRunnerStack.placement_environment(placement, "spot", {})
+
+@pytest.mark.parametrize("capacity_profiles,message", [
+    ([{"name": "emea morning", "schedule": "cron(0 7 * * ? *)"}], "must be letters"),
+    ([{"name": "night", "schedule": "cron(0 20 * * ? *)"},
+      {"name": "night", "schedule": "cron(0 22 * * ? *)"}], "not unique"),
+    ([{"name": "night"}], "requires a schedule"),
+])
+def test_capacity_profiles_rejected(capacity_profiles, message):
+    with pytest.raises(ValueError, match=message):
+        GitlabCiFargateRunnerStack.capacity_profiles({"capacity_profiles": capacity_profiles})
+
+@pytest.mark.parametrize("retention_days", [0, 10, 4000])
+def test_retention_days_rejected(retention_days):
+    with pytest.raises(ValueError, match="retention_days"):
+        log_retention({"retention_days": retention_days})
+
+@pytest.mark.parametrize("sizes,default_size,message", [
+    ({"small": {"cpu": "256", "memory": "512"}}, "large", "default_size large"),
+    ({"small": {"cpu": "256", "memory": "512", "ephemeral_storage": 20}}, "small", "ephemeral_storage"),
+    ({"small": {"cpu": "256", "memory": "512", "ephemeral_storage": 201}}, "small", "ephemeral_storage"),
+])
+def test_task_definition_sizes_rejected(sizes, default_size, message):
+    with pytest.raises(ValueError, match=message):
+        synth_task_definition_stack(sizes=sizes, default_size=default_size)
+
+@pytest.mark.parametrize("sidecars,message", [
+    ({"Postgres": [{"name": "postgres", "image": "postgres:14-alpine"}]}, "set name"),
+    ({"postgres": []}, "no container"),
+    ({"postgres": [{"name": "ci-coordinator", "image": "postgres:14-alpine"}]}, "not unique"),
+    ({"postgres": [{"name": "postgres"}]}, "requires an image"),
+    ({"postgres": [{"name": "postgres", "image": "postgres:14-alpine", "cpu": 256}]}, "leaves no cpu"),
+    ({"postgres": [{"name": "postgres", "image": "postgres:14-alpine", "memory_reservation": 512}]},
+     "leaves no cpu"),
+])
+def test_sidecar_sets_rejected(sidecars, message):
+    with pytest.raises(ValueError, match=message):
+        sidecar_sets({"sidecars": sidecars, "cpu": 256, "memory": 512})
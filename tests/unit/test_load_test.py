@@ -0,0 +1,117 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import json
+import urllib.request
+
+from benchmarks import load_test
+from tests.fakes.aws_api import ECS_TARGET_PREFIX, FakeAws
+from tests.fakes.gitlab_api import FakeGitlab
+
+
+def ecs(aws, action, request):
+    http_request = urllib.request.Request(
+        aws.url, data=json.dumps(request).encode(), method="POST",
+        headers={"X-Amz-Target": ECS_TARGET_PREFIX + action,
+                 "Content-Type": "application/x-amz-json-1.1"})
+    with urllib.request.urlopen(http_request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def run_task_request(subnet):
+    return {
+        "taskDefinition": "python",
+        "startedBy": "gitlab-runner",
+        "networkConfiguration": {"awsvpcConfiguration": {"subnets": [subnet]}},
+        "overrides": {"containerOverrides": [{"name": "ci-coordinator", "environment": [
+            {"name": "SSH_PUBLIC_KEY", "value": "ssh-ed25519 AAAA"}]}]},
+    }
+
+
+def gitlab_request(gitlab, method, path, body):
+    request = urllib.request.Request(
+        f"{gitlab.url}{path}", data=json.dumps(body).encode(), method=method,
+        headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status, response.read()
+
+
+def test_fake_ecs_task_lifecycle():
+    keys = []
+    with FakeAws(full_subnets=["subnet-full"],
+                 on_run_task=lambda task, overrides: keys.append(overrides)) as aws:
+        failure = ecs(aws, "RunTask", run_task_request("subnet-full"))
+        assert failure["tasks"] == [] and "Capacity is unavailable" in failure["failures"][0]["reason"]
+
+        task = ecs(aws, "RunTask", run_task_request("subnet-a"))["tasks"][0]
+        described = ecs(aws, "DescribeTasks", {"tasks": [task["taskArn"]]})["tasks"][0]
+        assert described["lastStatus"] == "RUNNING"
+        assert {"name": "privateIPv4Address", "value": "127.0.0.1"} in described["attachments"][0]["details"]
+        assert ecs(aws, "ListTasks", {"startedBy": "gitlab-runner"})["taskArns"] == [task["taskArn"]]
+
+        ecs(aws, "StopTask", {"task": task["taskArn"]})
+        assert ecs(aws, "DescribeTasks", {"tasks": [task["taskArn"]]})["tasks"][0]["lastStatus"] == "STOPPED"
+        assert len(keys) == 1
+
+        with urllib.request.urlopen(f"{aws.metadata_url}/task", timeout=5) as response:
+            assert json.loads(response.read())["TaskARN"] == aws.runner_task_arn
+
+
+def test_fake_ecs_task_provisioning():
+    with FakeAws(provisioning_seconds=60) as aws:
+        task = ecs(aws, "RunTask", run_task_request("subnet-a"))["tasks"][0]
+        assert task["lastStatus"] == "PROVISIONING"
+
+
+def test_fake_s3_objects():
+    with FakeAws() as aws:
+        urllib.request.urlopen(urllib.request.Request(
+            f"{aws.url}/cache/git-bundles/group/app.bundle", data=b"bundle", method="PUT"), timeout=5)
+        with urllib.request.urlopen(f"{aws.url}/cache/git-bundles/group/app.bundle", timeout=5) as response:
+            assert response.read() == b"bundle"
+
+
+def test_fake_gitlab_runner_jobs():
+    with FakeGitlab() as gitlab:
+        status, body = gitlab_request(gitlab, "POST", "/api/v4/runners", {"token": "registration"})
+        token = json.loads(body)["token"]
+        assert gitlab_request(gitlab, "POST", "/api/v4/jobs/request", {"token": token})[0] == 204
+
+        job_id = gitlab.add_job(script=["sleep 1"])
+        status, body = gitlab_request(gitlab, "POST", "/api/v4/jobs/request", {"token": token})
+        payload = json.loads(body)
+        assert status == 201
+        assert {"key": "CI_JOB_ID", "value": str(job_id), "public": True, "masked": False} in payload["variables"]
+        assert payload["steps"][0]["script"] == ["sleep 1"]
+
+        gitlab_request(gitlab, "PUT", f"/api/v4/jobs/{job_id}", {"token": payload["token"], "state": "success"})
+        pickup, duration = load_test.job_latencies(gitlab.jobs.values())
+        assert len(pickup) == 1 and len(duration) == 1
+        assert gitlab.jobs[job_id]["state"] == "success"
+
+
+def test_stage_metrics_and_stats_parsed():
+    lines = [
+        "Checking for jobs... received",
+        json.dumps({"_aws": {}, "Stage": "prepare", "Step": "prepare", "StageDuration": 12000}),
+        json.dumps({"_aws": {}, "Stage": "run", "Step": "step_script", "StageDuration": 5000}),
+        json.dumps({"_aws": {}, "Stage": "run", "Step": "step_script", "StageDuration": 7000}),
+    ]
+    assert load_test.parse_stage_metrics(lines) == {"prepare": [12.0], "step_script": [5.0, 7.0]}
+    assert load_test.parse_stats_line("12.50%\t48.3MiB / 512MiB") == (12.5, 48.3)
+    assert load_test.parse_stats_line("3.00%\t1.5GiB / 2GiB") == (3.0, 1536.0)
+    assert load_test.percentiles([3, 1, 2]) == {"p50": 2, "p95": 3, "max": 3}
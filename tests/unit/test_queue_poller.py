@@ -0,0 +1,84 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import urllib.error
+
+import pytest
+
+from gitlab_ci_fargate_runner.functions.queue_poller import index as poller
+from tests.fakes.gitlab_api import FakeGitlab
+
+TOKEN = "glpat-test"
+
+
+def job(status, *tags):
+    return {"status": status, "tag_list": list(tags)}
+
+
+def test_count_jobs_filters_on_runner_tags():
+    projects = {
+        "1": [job("pending", "my_tag"), job("pending", "other"), job("running", "my_tag"),
+              job("success", "my_tag"), job("pending")],
+        "group/app": [job("pending", "my_tag"), job("running", "my_tag", "docker")],
+    }
+    with FakeGitlab(projects, TOKEN) as gitlab:
+        counts = poller.count_jobs(gitlab.url, TOKEN, ["1", "group/app"], [["my_tag"]])
+    assert counts == {"pending": 3, "running": 1}
+
+
+def test_count_jobs_of_runner_without_tags():
+    projects = {"1": [job("pending"), job("pending", "python"), job("running")]}
+    with FakeGitlab(projects, TOKEN) as gitlab:
+        counts = poller.count_jobs(gitlab.url, TOKEN, ["1"], [[]])
+    assert counts == {"pending": 1, "running": 1}
+
+
+def test_count_jobs_matches_any_runner_of_the_coordinator():
+    projects = {
+        "1": [job("pending", "python"), job("pending", "nodejs"),
+              job("pending", "python", "nodejs"), job("running", "kaniko")],
+    }
+    with FakeGitlab(projects, TOKEN) as gitlab:
+        counts = poller.count_jobs(gitlab.url, TOKEN, ["1"], [["python"], ["nodejs"], []])
+    assert counts == {"pending": 2, "running": 0}
+
+
+def test_count_jobs_without_runner_tags_counts_everything():
+    projects = {"1": [job("pending"), job("pending", "other"), job("running")]}
+    with FakeGitlab(projects, TOKEN) as gitlab:
+        counts = poller.count_jobs(gitlab.url, TOKEN, ["1"])
+    assert counts == {"pending": 2, "running": 1}
+
+
+def test_count_jobs_follows_pagination():
+    projects = {"1": [job("pending", "my_tag")] * 7}
+    with FakeGitlab(projects, TOKEN) as gitlab:
+        counts = poller.count_jobs(gitlab.url, TOKEN, ["1"], [["my_tag"]], per_page=3)
+        pages = [path for path in gitlab.requests if "scope%5B%5D=pending" in path]
+    assert counts["pending"] == 7
+    assert len(pages) == 3
+
+
+def test_count_jobs_rejects_bad_token():
+    with FakeGitlab({"1": []}, TOKEN) as gitlab:
+        with pytest.raises(urllib.error.HTTPError):
+            poller.count_jobs(gitlab.url, "wrong", ["1"])
+
+
+def test_jobs_per_coordinator():
+    assert poller.jobs_per_coordinator({"pending": 3, "running": 3}, 2) == 3
+    assert poller.jobs_per_coordinator({"pending": 4, "running": 0}, 0) == 4
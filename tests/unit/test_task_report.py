@@ -0,0 +1,126 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+import io
+import json
+
+import pytest
+
+from tools import task_report
+
+CLUSTER = "arn:aws:ecs:eu-west-1:123456789012:cluster/GitlabRunnerBastionStack-cluster"
+
+
+def task_event(task_id, family="python", capacity_provider="FARGATE_SPOT", az="eu-west-1a",
+               last_status="STOPPED", version=5, **times):
+    detail = {
+        "clusterArn": CLUSTER,
+        "taskArn": f"arn:aws:ecs:eu-west-1:123456789012:task/cluster/{task_id}",
+        "taskDefinitionArn": f"arn:aws:ecs:eu-west-1:123456789012:task-definition/{family}:3",
+        "capacityProviderName": capacity_provider,
+        "availabilityZone": az,
+        "attributes": [{"name": "ecs.cpu-architecture", "value": "x86_64"}],
+        "cpu": "1024",
+        "memory": "2048",
+        "lastStatus": last_status,
+        "version": version,
+    }
+    detail.update(times)
+    return {"detail-type": "ECS Task State Change", "source": "aws.ecs", "detail": detail}
+
+
+STOPPED_TIMES = {
+    "createdAt": "2021-12-01T10:00:00.000Z",
+    "pullStartedAt": "2021-12-01T10:00:20.000Z",
+    "pullStoppedAt": "2021-12-01T10:00:50.000Z",
+    "startedAt": "2021-12-01T10:01:00.000Z",
+    "stoppingAt": "2021-12-01T11:00:00.000Z",
+    "stoppedAt": "2021-12-01T11:00:20.000Z",
+}
+
+
+@pytest.mark.parametrize("value", [
+    "2021-12-01T10:00:00.5Z",
+    "2021-12-01T10:00:00.50Z",
+    "2021-12-01T10:00:00.500000000Z",
+    "2021-12-01T10:00:00.5+00:00",
+    "2021-12-01T11:30:00.5+01:30",
+    "2021-12-01T08:00:00.5-0200",
+    "2021-12-01T10:00:00.5",
+])
+def test_timestamps_parsed(value):
+    assert task_report.parse_time(value) == 1638352800.5
+
+
+def test_invalid_timestamp_rejected():
+    with pytest.raises(ValueError, match="Invalid timestamp"):
+        task_report.parse_time("2021-12-01 10:00")
+
+
+def test_durations_of_a_stopped_task():
+    record = task_report.task_record(task_event("a", **STOPPED_TIMES))
+    assert task_report.durations(record) == {
+        "provisioning": 20, "image_pull": 30, "run": 3540}
+
+
+def test_latest_event_of_a_task_wins():
+    events = [
+        task_event("a", last_status="STOPPED", version=5, **STOPPED_TIMES),
+        task_event("a", last_status="RUNNING", version=3, createdAt=STOPPED_TIMES["createdAt"]),
+        task_event("b", last_status="RUNNING", version=3, createdAt=STOPPED_TIMES["createdAt"]),
+    ]
+    records = {r["task_arn"].split("/")[-1]: r for r in task_report.task_records(events)}
+    assert records["a"]["last_status"] == "STOPPED"
+    assert task_report.task_cost(records["b"]) is None
+
+
+def test_spot_savings_and_minimum_billing():
+    spot = task_report.task_record(task_event("a", **STOPPED_TIMES))
+    on_demand = task_report.task_cost(spot, capacity_provider="FARGATE")
+    # One hour of 1 vCPU and 2 GB, billed from the image pull
+    assert on_demand == pytest.approx(0.04048 + 2 * 0.004445)
+    assert task_report.task_cost(spot) < on_demand
+
+    short = task_report.task_record(task_event(
+        "b", capacity_provider="FARGATE", createdAt=STOPPED_TIMES["createdAt"],
+        pullStartedAt=STOPPED_TIMES["createdAt"], stoppedAt="2021-12-01T10:00:10.000Z"))
+    assert task_report.task_cost(short) == pytest.approx(on_demand / 60)
+
+
+def test_report_reads_exported_log_events(capsys, tmp_path):
+    export = {"events": [
+        {"message": json.dumps(task_event("a", **STOPPED_TIMES))},
+        {"message": json.dumps(task_event("b", az="eu-west-1b", **STOPPED_TIMES))},
+        {"message": json.dumps(task_event("c", capacity_provider="FARGATE", **STOPPED_TIMES))},
+    ]}
+    path = tmp_path / "events.json"
+    path.write_text(json.dumps(export))
+
+    task_report.main(["--by", "capacity_provider", "--format", "json", str(path)])
+    rows = {row["capacity_provider"]: row for row in json.loads(capsys.readouterr().out)}
+    assert rows["FARGATE_SPOT"]["tasks"] == 2
+    assert rows["FARGATE_SPOT"]["spot_savings"] > 0
+    assert rows["FARGATE"]["spot_savings"] == 0
+    assert rows["FARGATE"]["image_pull_p50"] == 30
+
+
+def test_report_reads_json_lines():
+    lines = "\n".join(json.dumps(task_event(task_id, **STOPPED_TIMES)) for task_id in "abc")
+    events = list(task_report.read_events(io.StringIO(lines)))
+    rows = task_report.report(task_report.task_records(events))
+    assert [(row["image"], row["az"], row["tasks"]) for row in rows] == [
+        ("python", "eu-west-1a", 3)]
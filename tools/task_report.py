@@ -0,0 +1,278 @@
+#
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+"""Latency and cost report of the Fargate tasks, from their ECS Task State Change events.
+
+Usage: python tools/task_report.py [--by image,capacity_provider,az] [--format table]
+                                   [--prices prices.json] EVENT_FILE [EVENT_FILE ...]
+
+The bastion stack records the STOPPED event of every task of the cluster in
+the task events log group (see `task_events` in config/app.yml), export them
+with:
+
+    aws logs filter-log-events --log-group-name <log group> > events.json
+
+The tool works offline: it reads exported log events, JSON arrays or JSON
+lines of EventBridge events ("-" reads the standard input). Each task is
+reduced to a lifecycle record, its latest event wins, and the records are
+grouped by task definition family, capacity provider and availability zone:
+
+- provisioning: createdAt to the start of the image pull
+- image_pull: pullStartedAt to pullStoppedAt
+- run: startedAt to stoppingAt (stoppedAt when the task did not stop gracefully)
+- cost: billed from the image pull to stoppedAt, one minute minimum, with the
+  Fargate prices of --prices (us-east-1 Linux list prices by default)
+- spot_savings: on demand cost of the Fargate Spot tasks minus their cost
+"""
+import argparse
+import calendar
+import csv
+import json
+import re
+import sys
+import time
+
+# Price per vCPU hour and GB hour by cpu architecture and capacity provider,
+# ephemeral storage per GB hour above the 20 GiB included in every task
+DEFAULT_PRICES = {
+    "x86_64": {
+        "FARGATE": {"vcpu": 0.04048, "memory": 0.004445},
+        "FARGATE_SPOT": {"vcpu": 0.01334053, "memory": 0.00146489},
+    },
+    "arm64": {
+        "FARGATE": {"vcpu": 0.03238, "memory": 0.00356},
+        "FARGATE_SPOT": {"vcpu": 0.01067206, "memory": 0.00117226},
+    },
+    "ephemeral_storage": 0.000111,
+}
+INCLUDED_EPHEMERAL_STORAGE = 20
+MINIMUM_BILLED_SECONDS = 60
+GROUP_KEYS = ("image", "capacity_provider", "az")
+DURATIONS = ("provisioning", "image_pull", "run")
+# ISO 8601 timestamp of ECS, the fraction has 1 to 9 digits (ex: 10:00:00.5Z),
+# which datetime.fromisoformat rejects before Python 3.11
+TIMESTAMP = re.compile(
+    r"(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|([+-])(\d{2}):?(\d{2}))?$")
+
+
+def parse_time(value):
+    """Seconds since the epoch of an ECS timestamp, None when it is not set.
+
+    A timestamp without offset is in UTC, like the ones of ECS.
+    """
+    if not value:
+        return None
+    match = TIMESTAMP.match(value)
+    if not match:
+        raise ValueError(f"Invalid timestamp: {value}")
+    moment, fraction, _, sign, hours, minutes = match.groups()
+    seconds = calendar.timegm(time.strptime(moment, "%Y-%m-%dT%H:%M:%S"))
+    if fraction:
+        seconds += int(fraction) / 10 ** len(fraction)
+    if sign:
+        seconds -= int(f"{sign}1") * (int(hours) * 3600 + int(minutes) * 60)
+    return seconds
+
+
+def iter_events(document):
+    """Yield the events of a decoded file: log export, log event, list or event."""
+    if isinstance(document, list):
+        for item in document:
+            yield from iter_events(item)
+    elif isinstance(document, dict):
+        if "events" in document:
+            yield from iter_events(document["events"])
+        elif "message" in document:
+            yield from iter_events(json.loads(document["message"]))
+        elif "detail" in document:
+            yield document
+
+
+def read_events(stream):
+    """Yield the events of a JSON document or of JSON lines."""
+    content = stream.read()
+    try:
+        documents = [json.loads(content)]
+    except json.JSONDecodeError:
+        documents = [json.loads(line) for line in content.splitlines() if line.strip()]
+    for document in documents:
+        yield from iter_events(document)
+
+
+def task_record(event):
+    """Compact lifecycle record of the task of an ECS Task State Change event."""
+    detail = event["detail"]
+    attributes = {attribute.get("name"): attribute.get("value")
+                  for attribute in detail.get("attributes", [])}
+    return {
+        "task_arn": detail["taskArn"],
+        "version": detail.get("version", 0),
+        "image": detail.get("taskDefinitionArn", "").split("/")[-1].split(":")[0],
+        "capacity_provider": detail.get("capacityProviderName", "FARGATE"),
+        "az": detail.get("availabilityZone", "unknown"),
+        "architecture": attributes.get("ecs.cpu-architecture", "x86_64"),
+        "cpu": int(detail.get("cpu", 256)),
+        "memory": int(detail.get("memory", 512)),
+        "ephemeral_storage": int(
+            detail.get("ephemeralStorage", {}).get("sizeInGiB", INCLUDED_EPHEMERAL_STORAGE)),
+        "last_status": detail.get("lastStatus"),
+        "stop_code": detail.get("stopCode"),
+        **{name: parse_time(detail.get(name)) for name in (
+            "createdAt", "pullStartedAt", "pullStoppedAt", "startedAt", "stoppingAt", "stoppedAt")},
+    }
+
+
+def task_records(events):
+    """Latest record of each task."""
+    records = {}
+    for event in events:
+        if event.get("detail-type", "ECS Task State Change") != "ECS Task State Change":
+            continue
+        record = task_record(event)
+        previous = records.get(record["task_arn"])
+        if previous is None or record["version"] >= previous["version"]:
+            records[record["task_arn"]] = record
+    return list(records.values())
+
+
+def elapsed(start, end):
+    return end - start if start is not None and end is not None else None
+
+
+def durations(record):
+    """Provisioning, image pull and run durations of a task, in seconds."""
+    return {
+        "provisioning": elapsed(
+            record["createdAt"], record["pullStartedAt"] or record["startedAt"]),
+        "image_pull": elapsed(record["pullStartedAt"], record["pullStoppedAt"]),
+        "run": elapsed(record["startedAt"], record["stoppingAt"] or record["stoppedAt"]),
+    }
+
+
+def task_cost(record, prices=DEFAULT_PRICES, capacity_provider=None):
+    """Cost of a stopped task, None while it runs."""
+    billed = elapsed(record["pullStartedAt"] or record["createdAt"], record["stoppedAt"])
+    if billed is None:
+        return None
+    hours = max(billed, MINIMUM_BILLED_SECONDS) / 3600
+    price = prices[record["architecture"]][capacity_provider or record["capacity_provider"]]
+    extra_storage = max(record["ephemeral_storage"] - INCLUDED_EPHEMERAL_STORAGE, 0)
+    return hours * (
+        record["cpu"] / 1024 * price["vcpu"]
+        + record["memory"] / 1024 * price["memory"]
+        + extra_storage * prices["ephemeral_storage"]
+    )
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile, None without values."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(round(percent / 100 * len(values))) - 1, 0)]
+
+
+def report(records, by=GROUP_KEYS, prices=DEFAULT_PRICES):
+    """Aggregate the records by the `by` keys, one row per group."""
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record[key] for key in by), []).append(record)
+
+    rows = []
+    for group, group_records in sorted(groups.items()):
+        row = dict(zip(by, group))
+        row["tasks"] = len(group_records)
+        task_durations = [durations(record) for record in group_records]
+        for name in DURATIONS:
+            values = [d[name] for d in task_durations if d[name] is not None]
+            row[f"{name}_p50"] = percentile(values, 50)
+            row[f"{name}_p95"] = percentile(values, 95)
+        cost = spot_savings = 0.0
+        for record in group_records:
+            record_cost = task_cost(record, prices)
+            if record_cost is None:
+                continue
+            cost += record_cost
+            if record["capacity_provider"] == "FARGATE_SPOT":
+                spot_savings += task_cost(record, prices, "FARGATE") - record_cost
+        row["cost"] = round(cost, 6)
+        row["spot_savings"] = round(spot_savings, 6)
+        rows.append(row)
+    return rows
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.4f}" if value < 1 else f"{value:.1f}"
+    return str(value)
+
+
+def write_table(rows, stream):
+    if not rows:
+        return
+    columns = list(rows[0])
+    cells = [[format_value(row[column]) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells))
+              for i, column in enumerate(columns)]
+    stream.write("  ".join(c.ljust(w) for c, w in zip(columns, widths)).rstrip() + "\n")
+    for line in cells:
+        stream.write("  ".join(c.ljust(w) for c, w in zip(line, widths)).rstrip() + "\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("files", nargs="+", help="exported event files, - for stdin")
+    parser.add_argument(
+        "--by", default=",".join(GROUP_KEYS),
+        help=f"comma separated grouping keys among {', '.join(GROUP_KEYS)}")
+    parser.add_argument("--format", choices=("table", "csv", "json"), default="table")
+    parser.add_argument("--prices", help="JSON file of prices, same keys as DEFAULT_PRICES")
+    args = parser.parse_args(argv)
+
+    by = [key for key in args.by.split(",") if key]
+    unknown = set(by) - set(GROUP_KEYS)
+    if unknown:
+        parser.error(f"unknown grouping keys: {', '.join(sorted(unknown))}")
+    prices = DEFAULT_PRICES
+    if args.prices:
+        with open(args.prices) as stream:
+            prices = json.load(stream)
+
+    events = []
+    for name in args.files:
+        if name == "-":
+            events += read_events(sys.stdin)
+        else:
+            with open(name) as stream:
+                events += read_events(stream)
+
+    rows = report(task_records(events), by, prices)
+    if args.format == "json":
+        json.dump(rows, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    elif args.format == "csv" and rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        write_table(rows, sys.stdout)
+
+
+if __name__ == "__main__":
+    main()